@@ -65,14 +65,17 @@ def setLED(newstatus):
     if newstatus == status:
         return
         
+    # CircuitPython can't change both pins in one operation, so clear bits
+    # before setting them.  A change between two colors (e.g. red -> green)
+    # then blinks off rather than briefly showing the third color.
+    if not newstatus & 1:
+        status0.value = False
+    if not newstatus & 2:
+        status1.value = False
     if newstatus & 1:
         status0.value = True
-    else:
-        status0.value = False
     if newstatus & 2:
         status1.value = True
-    else:
-        status1.value = False
     status = newstatus
     return
 
@@ -0,0 +1,432 @@
+# Local stand-in for dweet.io, for a fleet of CO2 SAO badges
+#
+# Each badge posts its readings with basicdweet.dweet_for(thing, payload),
+# which is a POST to https://dweet.io/dweet/for/<thing> with the payload as
+# JSON.  dweet.io is rate limited, only keeps a few dweets per thing, and
+# can go away at any time, which doesn't work for a room full of badges.
+# This is a small asyncio HTTP server that speaks the same protocol, so a
+# badge only needs its dweet URL pointed here, and keeps each thing's
+# readings in a ring (see ringstore.py):
+#
+#   POST /dweet/for/<thing>           JSON object (or form fields) -> stored,
+#                                     answered the way dweet.io does.  A JSON
+#                                     array stores each object in it, for a
+#                                     batch of queued readings.
+#   GET  /dweet/for/<thing>?co2=612   the same, from query parameters
+#   POST /dweet/quietly/for/<thing>   stored, with an empty 204 answer
+#   POST /dweets                      JSON array of {"thing", "content",
+#                                     "created"} from any number of badges
+#   GET  /get/latest/dweet/for/<thing>
+#   GET  /get/dweets/for/<thing>?seconds=3600&limit=100
+#                                     recent readings, newest first
+#   GET  /get/stored/dweets/for/<thing>?date=2024-11-01&hour=13
+#   GET  /get/stored/dweets/for/<thing>?from=2024-11-01T13:00&to=...
+#                                     readings from the on-disk store (only
+#                                     with --data, see segments.py), oldest
+#                                     first
+#   GET  /get/downsampled/dweets/for/<thing>?from=...&to=...&points=500
+#                                     &method=minmax|lttb&field=co2
+#                                     about points of min, mean and max
+#                                     buckets, or LTTB-picked readings, for
+#                                     a chart (with --data, see downsample.py)
+#   GET  /alerts                      alerts firing now (only with --alerts,
+#                                     see alerts.py)
+#   GET  /things                      every thing with its last reading time
+#   GET  /stats                       posts, readings and server CPU time
+#
+# "created" may be given as seconds since the epoch or dweet.io's ISO form;
+# otherwise readings are stamped when they arrive.  A post with a created
+# time outside 2000 to 2100 is refused whole, and numbers a ring can't hold
+# (NaN, infinities, beyond a float32's range) are left out.  With --data every
+# reading is written to disk as well, and flushed every FLUSH_SECONDS.
+# With --alerts RULES.json each reading also goes through the alert rules,
+# and alerts are printed as they fire and clear.
+#
+# HTTP handling is a bare asyncio.Protocol -- keep-alive, pipelining and
+# Content-Length bodies, which is all a badge or a dashboard needs -- since
+# the parsing is most of the work per post.  Everything runs on one event
+# loop on one core.
+#
+#     python3 aggregator.py [--host 0.0.0.0] [--port 8080] [--capacity 2880]
+#                           [--data DIR] [--partition hour|day]
+#                           [--alerts alerts.json]
+
+import argparse
+import asyncio
+import calendar
+import json
+import math
+import signal
+import time
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+from ringstore import Store, CAPACITY
+from segments import FIELDS, SegmentStore, parse_time
+from downsample import Rollups, width_for
+import alerts as alerting
+
+PORT = 8080
+FLUSH_SECONDS = 1
+ALERT_SECONDS = 5       # How often we look for badges that have gone silent
+MAX_HEADER = 8192       # Bytes of request line and headers we'll accept
+MAX_BODY = 1 << 20
+FLOAT32_MAX = 3.4028234663852886e38     # Largest number a ring (array "f") holds
+EARLIEST = 946684800    # 2000-01-01: "created" times before this or
+LATEST = 4102444800     # after 2100-01-01 can't be real
+
+_REASONS = {200: "OK", 204: "No Content", 400: "Bad Request", 404: "Not Found",
+            405: "Method Not Allowed", 411: "Length Required", 413: "Payload Too Large",
+            431: "Request Header Fields Too Large", 500: "Internal Server Error"}
+
+def iso(t):
+    return "%s.%03dZ" % (time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(t)), int(t * 1000) % 1000)
+
+# A reading's "created" time in seconds since the epoch, or None if it
+# hasn't one.  Raises ValueError if it isn't a time from EARLIEST to LATEST.
+def parse_created(value):
+    if value is None:
+        return None
+    t = None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        t = value
+    elif isinstance(value, str):
+        try:
+            (whole, _, fraction) = value.rstrip("Z").partition(".")
+            t = calendar.timegm(time.strptime(whole, "%Y-%m-%dT%H:%M:%S"))
+            t += float("0." + fraction) if fraction.isdigit() else 0.0
+        except ValueError:
+            pass
+    if t is None or not EARLIEST <= t <= LATEST:
+        raise ValueError("created should be a time from 2000 to 2100")
+    return float(t)
+
+# A reading without the numbers a ring can't hold: NaN, infinities and
+# anything beyond a float32's range
+def _clean(content):
+    return dict((k, v) for (k, v) in content.items()
+                if type(v) not in (int, float) or
+                (abs(v) <= FLOAT32_MAX and not (type(v) is float and math.isnan(v))))
+
+# Query string and form values come in as text, but readings are numbers
+def _number(text):
+    for kind in (int, float):
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+    return text
+
+# The time range a stored readings query asks for, from either date (and
+# hour) or from and to.  Raises ValueError if they aren't times.
+def _range(query):
+    if "date" in query:
+        start = parse_time(query["date"]) + 3600 * int(query.get("hour", 0))
+        return (start, start + (3600 if "hour" in query else 86400))
+    return (parse_time(query["from"]) if "from" in query else None,
+            parse_time(query["to"]) if "to" in query else None)
+
+# Print alerts as they fire and clear
+def report(alerts):
+    for alert in alerts:
+        print("%s  %s %s %s%s" % (iso(alert["t"]), alert["rule"], alert["key"], alert["state"],
+                                  "" if alert["value"] is None else " at %.0f ppm" % alert["value"]))
+
+def _failed(status, because):
+    return {"this": "failed", "with": status, "because": because}
+
+class Aggregator:
+    def __init__(self, store=None, archive=None, alerts=None):
+        self.store = store if store is not None else Store()
+        self.archive = archive          # A segments.SegmentStore, or None
+        self.rollups = Rollups(archive) if archive is not None else None
+        self.alerts = alerts            # An alerts.Engine, or None
+        self.posts = 0
+        self.started = time.time()
+
+    def _dweet(self, thing, content, created=None):
+        t = time.time() if created is None else created
+        content = _clean(content)
+        self.store.add(thing, content, t)
+        if self.archive is not None:
+            self.archive.add(thing, content, t)
+        if self.alerts is not None:
+            co2 = content.get("co2")
+            if type(co2) in (int, float):
+                room = content.get("room")
+                report(self.alerts.reading(thing, t, co2, room if isinstance(room, str) else None,
+                                           time.time()))
+        return {"thing": thing, "created": iso(t), "content": content}
+
+    # Store one post's worth of readings for thing.  Returns the dweet.io
+    # answer, or None if the body wasn't readings.  Raises ValueError,
+    # having stored nothing, if any reading's "created" time is no good.
+    def post(self, thing, body, ctype="application/json"):
+        if "json" in ctype or body[:1] in (b"{", b"["):
+            try:
+                content = json.loads(body)
+            except ValueError:
+                return None
+        else:
+            content = dict((k, _number(v)) for (k, v) in parse_qsl(body.decode("utf-8", "replace")))
+        self.posts += 1
+        if isinstance(content, dict):
+            return self._dweet(thing, content)
+        if isinstance(content, list):
+            batch = [(c, parse_created(c.pop("created", None))) for c in content if isinstance(c, dict)]
+            dweets = [self._dweet(thing, c, t) for (c, t) in batch]
+            return dweets[-1] if len(dweets) == 1 else dweets
+        return None
+
+    # A batch from any number of things: [{"thing", "content", "created"}].
+    # Like post(), stores nothing if any "created" time is no good.
+    def post_many(self, body):
+        try:
+            items = json.loads(body)
+        except ValueError:
+            return None
+        if not isinstance(items, list):
+            return None
+        batch = [(str(item["thing"]), item["content"], parse_created(item.get("created")))
+                 for item in items
+                 if isinstance(item, dict) and isinstance(item.get("content"), dict) and item.get("thing")]
+        self.posts += 1
+        for (thing, content, t) in batch:
+            self._dweet(thing, content, t)
+        return {"stored": len(batch)}
+
+    def stats(self):
+        return {"things": len(self.store.things), "posts": self.posts,
+                "readings": self.store.readings, "uptime": time.time() - self.started,
+                "cpu": time.process_time()}
+
+    # Answer one request.  Returns (status, JSON-able answer or None).
+    def handle(self, method, target, body=b"", ctype=""):
+        url = urlsplit(target)
+        parts = [unquote(p) for p in url.path.strip("/").split("/")]
+        query = dict(parse_qsl(url.query))
+        ok = {"this": "succeeded"}
+
+        if parts[:2] == ["dweet", "for"] and len(parts) == 3 or \
+           parts[:3] == ["dweet", "quietly", "for"] and len(parts) == 4:
+            thing = parts[-1]
+            if method == "GET":
+                self.posts += 1
+                answer = self._dweet(thing, dict((k, _number(v)) for (k, v) in query.items()))
+            elif method == "POST":
+                try:
+                    answer = self.post(thing, body, ctype)
+                except ValueError as e:
+                    return (400, _failed(400, str(e)))
+                if answer is None:
+                    return (400, _failed(400, "we couldn't read any readings in that"))
+            else:
+                return (405, _failed(405, "only GET and POST here"))
+            if parts[1] == "quietly":
+                return (204, None)
+            return (200, dict(ok, by="dweeting", the="dweet", **{"with": answer}))
+
+        if parts == ["dweets"] and method == "POST":
+            try:
+                answer = self.post_many(body)
+            except ValueError as e:
+                return (400, _failed(400, str(e)))
+            if answer is None:
+                return (400, _failed(400, "expected a JSON array of dweets"))
+            return (200, dict(ok, by="dweeting", the="dweets", **{"with": answer}))
+
+        if method != "GET":
+            return (405, _failed(405, "only GET here"))
+
+        if parts[:4] == ["get", "latest", "dweet", "for"] and len(parts) == 5:
+            latest = self.store.latest(parts[4])
+            if latest is None:
+                return (404, _failed(404, "we couldn't find this"))
+            (t, content) = latest
+            return (200, dict(ok, by="getting", the="dweets",
+                              **{"with": [{"thing": parts[4], "created": iso(t), "content": content}]}))
+
+        if parts[:3] == ["get", "dweets", "for"] and len(parts) == 4:
+            try:
+                seconds = float(query["seconds"]) if "seconds" in query else None
+                limit = int(query["limit"]) if "limit" in query else None
+            except ValueError:
+                return (400, _failed(400, "seconds and limit should be numbers"))
+            found = self.store.history(parts[3], seconds, limit)
+            if not found and parts[3] not in self.store.things:
+                return (404, _failed(404, "we couldn't find this"))
+            return (200, dict(ok, by="getting", the="dweets",
+                              **{"with": [{"thing": parts[3], "created": iso(t), "content": c}
+                                          for (t, c) in found]}))
+
+        if parts[:4] == ["get", "stored", "dweets", "for"] and len(parts) == 5:
+            if self.archive is None:
+                return (404, _failed(404, "readings aren't being stored here"))
+            try:
+                (start, end) = _range(query)
+            except ValueError:
+                return (400, _failed(400, "date, hour, from and to should be times"))
+            found = [{"thing": parts[4], "created": iso(t),
+                      "content": {"co2": co2, "temperatureF": round(temp, 2), "humidity": round(rh, 2)}}
+                     for (t, co2, temp, rh) in self.archive.query(parts[4], start, end)]
+            return (200, dict(ok, by="getting", the="dweets", **{"with": found}))
+
+        if parts[:4] == ["get", "downsampled", "dweets", "for"] and len(parts) == 5:
+            if self.rollups is None:
+                return (404, _failed(404, "readings aren't being stored here"))
+            try:
+                (start, end) = self.rollups.extent(parts[4], *_range(query))
+                points = int(query.get("points", 500))
+            except ValueError:
+                return (400, _failed(400, "date, hour, from and to should be times, and points a number"))
+            field = query.get("field", "co2")
+            method = query.get("method", "minmax")
+            if field not in FIELDS or method not in ("minmax", "lttb") or points < 1:
+                return (400, _failed(400, "field should be one of %s, method minmax or lttb, and points "
+                                          "more than 0" % ", ".join(FIELDS)))
+            if method == "lttb":
+                found = [{"thing": parts[4], "created": iso(t), "content": {field: round(value, 2)}}
+                         for (t, value) in self.rollups.lttb(parts[4], start, end, points, field)]
+            else:
+                found = [{"thing": parts[4], "created": iso(t),
+                          "content": {"readings": count, "min": round(low, 2), "mean": round(mean, 2),
+                                      "max": round(high, 2)}}
+                         for (t, count, low, mean, high) in
+                         self.rollups.buckets(parts[4], start, end, width_for(start, end, points), field)]
+            return (200, dict(ok, by="getting", the="dweets", **{"with": found}))
+
+        if parts == ["alerts"]:
+            if self.alerts is None:
+                return (404, _failed(404, "there are no alert rules here"))
+            return (200, dict(ok, by="getting", the="alerts",
+                              **{"with": [dict(a, created=iso(a["t"])) for a in self.alerts.firing.values()],
+                                 "stats": self.alerts.stats()}))
+
+        if parts == ["things"]:
+            return (200, dict(ok, by="getting", the="things",
+                              **{"with": [{"thing": name, "created": iso(s.latest_time), "readings": len(s)}
+                                          for (name, s) in sorted(self.store.things.items())]}))
+
+        if parts == ["stats"]:
+            return (200, self.stats())
+
+        return (404, _failed(404, "there's nothing at %s" % url.path))
+
+class HTTP(asyncio.Protocol):
+    def __init__(self, app):
+        self.app = app
+        self.buffer = bytearray()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        while self.transport is not None:
+            end = self.buffer.find(b"\r\n\r\n")
+            if end < 0:
+                if len(self.buffer) > MAX_HEADER:
+                    self._respond(431, _failed(431, "headers too long"), close=True)
+                return
+            lines = bytes(self.buffer[:end]).decode("latin-1").split("\r\n")
+            try:
+                (method, target, version) = lines[0].split(" ", 2)
+            except ValueError:
+                self._respond(400, _failed(400, "that's not HTTP"), close=True)
+                return
+            length = 0
+            ctype = ""
+            close = version == "HTTP/1.0"
+            for line in lines[1:]:
+                (name, _, value) = line.partition(":")
+                name = name.strip().lower()
+                if name == "content-length":
+                    length = int(value) if value.strip().isdigit() else -1
+                elif name == "content-type":
+                    ctype = value.strip().lower()
+                elif name == "connection":
+                    close = value.strip().lower() == "close"
+                elif name == "transfer-encoding":
+                    length = -1
+            if length < 0:
+                self._respond(411, _failed(411, "we need a Content-Length"), close=True)
+                return
+            if length > MAX_BODY:
+                self._respond(413, _failed(413, "that's too big"), close=True)
+                return
+            if len(self.buffer) < end + 4 + length:
+                return
+            body = bytes(self.buffer[end + 4:end + 4 + length])
+            del self.buffer[:end + 4 + length]
+            try:
+                (status, answer) = self.app.handle(method, target, body, ctype)
+            except Exception as e:
+                # Whatever went wrong, the client gets an answer and the
+                # connection carries on
+                print("%s %s failed: %r" % (method, target, e))
+                (status, answer) = (500, _failed(500, "something went wrong here"))
+            self._respond(status, answer, close)
+
+    def _respond(self, status, answer, close=False):
+        body = b"" if answer is None else json.dumps(answer).encode()
+        head = "HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n%s\r\n" % (
+            status, _REASONS.get(status, ""), len(body), "Connection: close\r\n" if close else "")
+        self.transport.write(head.encode() + body)
+        if close:
+            self.transport.close()
+            self.transport = None
+
+    def connection_lost(self, exc):
+        self.transport = None
+
+async def _flusher(archive):
+    while True:
+        await asyncio.sleep(FLUSH_SECONDS)
+        archive.flush()
+
+async def _watcher(engine):
+    while True:
+        await asyncio.sleep(ALERT_SECONDS)
+        report(engine.tick(time.time()))
+
+async def serve(host="0.0.0.0", port=PORT, capacity=CAPACITY, data=None, partition="hour", rules=None):
+    archive = SegmentStore(data, partition) if data else None
+    engine = alerting.load(rules) if rules else None
+    app = Aggregator(Store(capacity), archive, engine)
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(lambda: HTTP(app), host, port)
+    print("Fleet aggregator listening on %s:%d, keeping %d readings per thing" % (host, port, capacity))
+    if archive is not None:
+        print("Storing readings in %s, a segment per %s" % (data, partition))
+        flusher = asyncio.ensure_future(_flusher(archive))
+    if engine is not None:
+        print("Alert rules from %s (warning %d, alarm %d, hysteresis %d)" % ((rules,) + engine.thresholds))
+        watcher = asyncio.ensure_future(_watcher(engine))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if archive is not None:
+            flusher.cancel()
+            archive.close()
+        if engine is not None:
+            watcher.cancel()
+
+def main():
+    parser = argparse.ArgumentParser(description="dweet.io-compatible aggregator for CO2 SAO badges")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--capacity", type=int, default=CAPACITY, help="readings kept per thing")
+    parser.add_argument("--data", help="also store every reading in this folder")
+    parser.add_argument("--partition", choices=("hour", "day"), default="hour")
+    parser.add_argument("--alerts", help="alert rules file, like alerts.json")
+    args = parser.parse_args()
+    # Stop the same way on a kill as on ^C, so stored readings are flushed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        asyncio.run(serve(args.host, args.port, args.capacity, args.data, args.partition, args.alerts))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
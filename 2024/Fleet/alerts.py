@@ -0,0 +1,364 @@
+# Fleet-wide CO2 alerts, worked out as readings arrive
+#
+# With a venue full of badges we want to hear about things like "the median
+# CO2 in a room has been over the alarm level for 10 minutes" or "a badge
+# hasn't reported for 5 minutes".  Rescanning every badge's history on a
+# timer gets slower with every badge, so instead each rule keeps a little
+# state per badge (or room) and updates it with each reading:
+#
+#   Level    a badge's own CO2, or the median of the latest CO2 from each
+#            badge in a room, has been at "warning" or "alarm" for minutes.
+#            The state is the current stoplight status, when it got to the
+#            rule's level, and whether we've said so.
+#   Silent   a badge hasn't been heard from for minutes.  Badges are kept in
+#            the order we last heard from them, so each reading moves one to
+#            the back and tick() only looks at the front, at the ones that
+#            have gone quiet.
+#
+# Statuses come from co2status() below, the same green/yellow/red with
+# hysteresis the badge's stoplight uses (see badge_co2sao.py), and the
+# thresholds from the badge's own co2sao.json by default, so an alert goes
+# off when the stoplights would have been red (or yellow) the whole time.
+# An alert is "firing" once the condition has held for the rule's minutes,
+# and "cleared" when it stops -- for a Level rule, when the status drops
+# below the level, hysteresis included.
+#
+# Rules, and which room each badge is in, come from a JSON file like
+# alerts.json here.  A badge can also say which room it's in with a "room"
+# field in its dweets.  A badge moving out of a room stops counting towards
+# it, and a room left empty is forgotten and its alerts cleared, the same as
+# when its last badge goes silent.
+#
+#     engine = Engine([Level("room-alarm", "alarm", 10, over="room"), Silent("silent", 5)])
+#     engine.place("co2sao-017", "hall-a")
+#     for alert in engine.reading("co2sao-017", t, co2):
+#         ...
+#     for alert in engine.tick(time.time()):      # every few seconds
+#         ...
+#
+#     python3 alerts.py bench [--badges 10000] [--rooms 500] [--minutes 20]
+
+import argparse
+import bisect
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BADGE_CONFIG = os.path.join(os.path.dirname(HERE), "MicroPython", "co2sao.json")
+
+# Stoplight statuses, with the codes badge_co2sao.py uses
+OFF = 0
+GREEN = 1
+YELLOW = 3
+RED = 2
+
+# How bad each status is, and the status each rule level means
+_RANK = {OFF: 0, GREEN: 1, YELLOW: 2, RED: 3}
+LEVELS = {"warning": YELLOW, "alarm": RED}
+
+# badge_co2sao.co2status(), with the thresholds passed in
+def co2status(co2value, current, warning, alarm, hysteresis):
+    if current == RED and co2value >= alarm - hysteresis:
+        return RED
+    if current == YELLOW and warning - hysteresis <= co2value < alarm:
+        return YELLOW
+    if co2value < warning:
+        return GREEN
+    if co2value < alarm:
+        return YELLOW
+    return RED
+
+def _alert(rule, key, state, t, value):
+    return {"rule": rule, "key": key, "state": state, "t": t, "value": value}
+
+class Level:
+    def __init__(self, name, level="alarm", minutes=10, over="badge"):
+        if level not in LEVELS or over not in ("badge", "room"):
+            raise ValueError("%s: level should be warning or alarm, and over badge or room" % name)
+        self.name = name
+        self.level = level
+        self.rank = _RANK[LEVELS[level]]
+        self.seconds = 60 * minutes
+        self.over = over
+        self.state = {}         # badge or room -> [status, since, firing]
+
+    # Take the latest value for key.  Returns an alert, or None.
+    def update(self, key, t, value, thresholds):
+        state = self.state.get(key)
+        if state is None:
+            state = self.state[key] = [OFF, None, False]
+        status = state[0] = co2status(value, state[0], *thresholds)
+        if _RANK[status] >= self.rank:
+            if state[1] is None:
+                state[1] = t
+            if not state[2] and t - state[1] >= self.seconds:
+                state[2] = True
+                return _alert(self.name, key, "firing", t, value)
+        elif state[1] is not None:
+            state[1] = None
+            if state[2]:
+                state[2] = False
+                return _alert(self.name, key, "cleared", t, value)
+        return None
+
+    # Forget key, e.g. a room with no badges reporting any more
+    def drop(self, key, t):
+        state = self.state.pop(key, None)
+        if state is not None and state[2]:
+            return _alert(self.name, key, "cleared", t, None)
+        return None
+
+class Silent:
+    def __init__(self, name, minutes=5):
+        self.name = name
+        self.seconds = 60 * minutes
+        self.heard = OrderedDict()      # badge -> when we last heard from it, oldest first
+        self.silent = set()
+
+    # Returns a cleared alert if thing had been silent, or None
+    def reading(self, thing, now):
+        heard = self.heard
+        if thing in heard:
+            heard.move_to_end(thing)
+        heard[thing] = now
+        if thing in self.silent:
+            self.silent.discard(thing)
+            return _alert(self.name, thing, "cleared", now, None)
+        return None
+
+    # Badges that have just gone silent
+    def tick(self, now):
+        heard = self.heard
+        quiet = []
+        while heard:
+            (thing, last) = next(iter(heard.items()))
+            if now - last < self.seconds:
+                break
+            del heard[thing]
+            self.silent.add(thing)
+            quiet.append(thing)
+        return quiet
+
+# The latest CO2 from each badge in a room, kept sorted for the median
+class _Room:
+    def __init__(self):
+        self.latest = {}
+        self.sorted = []
+
+    def set(self, thing, co2):
+        old = self.latest.get(thing)
+        if old is not None:
+            del self.sorted[bisect.bisect_left(self.sorted, old)]
+        self.latest[thing] = co2
+        bisect.insort(self.sorted, co2)
+
+    def remove(self, thing):
+        old = self.latest.pop(thing, None)
+        if old is not None:
+            del self.sorted[bisect.bisect_left(self.sorted, old)]
+
+    def median(self):
+        values = self.sorted
+        n = len(values)
+        return values[n // 2] if n % 2 else (values[n // 2 - 1] + values[n // 2]) / 2
+
+class Engine:
+    def __init__(self, rules, warning=800, alarm=1000, hysteresis=25):
+        self.thresholds = (warning, alarm, hysteresis)
+        self.badge_rules = [r for r in rules if isinstance(r, Level) and r.over == "badge"]
+        self.room_rules = [r for r in rules if isinstance(r, Level) and r.over == "room"]
+        self.silent_rules = [r for r in rules if isinstance(r, Silent)]
+        self.room_of = {}               # badge -> room
+        self.rooms = {}                 # room -> _Room
+        self.firing = {}                # (rule, key) -> the alert that fired
+        self.readings = 0
+        self.fired = 0
+        self.cleared = 0
+
+    # Put thing in room (from now on, or as of now).  Returns the alerts
+    # cleared if that left its old room empty.
+    def place(self, thing, room, now=None):
+        alerts = []
+        old = self.room_of.get(thing)
+        if old == room:
+            return alerts
+        self.room_of[thing] = room
+        self._leave(alerts, thing, old, time.time() if now is None else now)
+        return alerts
+
+    # thing's reading no longer counts towards room's median.  If nobody's
+    # left, forget the room and clear any alerts firing for it.
+    def _leave(self, alerts, thing, room, now):
+        members = self.rooms.get(room)
+        if members is None or thing not in members.latest:
+            return
+        members.remove(thing)
+        if not members.latest:
+            del self.rooms[room]
+            for level in self.room_rules:
+                self._note(alerts, level.drop(room, now))
+
+    def _note(self, alerts, alert):
+        if alert is not None:
+            key = (alert["rule"], alert["key"])
+            if alert["state"] == "firing":
+                self.firing[key] = alert
+                self.fired += 1
+            else:
+                self.firing.pop(key, None)
+                self.cleared += 1
+            alerts.append(alert)
+
+    # Take one reading.  now is when it arrived, if that's not t (a queued
+    # reading from a batch, say).  Returns the alerts it set off or cleared.
+    def reading(self, thing, t, co2, room=None, now=None):
+        self.readings += 1
+        alerts = []
+        for rule in self.silent_rules:
+            self._note(alerts, rule.reading(thing, t if now is None else now))
+        for rule in self.badge_rules:
+            self._note(alerts, rule.update(thing, t, co2, self.thresholds))
+        if room is not None:
+            alerts += self.place(thing, room, t if now is None else now)
+        if self.room_rules:
+            room = self.room_of.get(thing)
+            if room is not None:
+                members = self.rooms.get(room)
+                if members is None:
+                    members = self.rooms[room] = _Room()
+                members.set(thing, co2)
+                median = members.median()
+                for rule in self.room_rules:
+                    self._note(alerts, rule.update(room, t, median, self.thresholds))
+        return alerts
+
+    # Check for badges that have gone silent.  Their last readings no longer
+    # count towards their room's median.  Returns the alerts set off.
+    def tick(self, now):
+        alerts = []
+        for rule in self.silent_rules:
+            for thing in rule.tick(now):
+                self._note(alerts, _alert(rule.name, thing, "firing", now, None))
+                self._leave(alerts, thing, self.room_of.get(thing), now)
+        return alerts
+
+    def stats(self):
+        state = sum(len(r.state) for r in self.badge_rules + self.room_rules) + \
+                sum(len(r.heard) + len(r.silent) for r in self.silent_rules)
+        return {"readings": self.readings, "fired": self.fired, "cleared": self.cleared,
+                "firing": len(self.firing), "state": state}
+
+# The warning and alarm levels and hysteresis from a badge config file,
+# checked the same way the badge checks it
+def badge_thresholds(path=BADGE_CONFIG):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(path)))
+    import co2config
+    with open(path) as f:
+        config = co2config.validate(json.load(f))
+    return (config.co2Warning, config.co2Alarm, config.hysteresis)
+
+# An Engine from a rules file (see alerts.json)
+def load(path, badge_config=BADGE_CONFIG):
+    with open(path) as f:
+        data = json.load(f)
+    rules = []
+    for spec in data.get("rules", []):
+        spec = dict(spec)
+        kind = spec.pop("kind", "level")
+        if kind == "level":
+            rules.append(Level(**spec))
+        elif kind == "silent":
+            rules.append(Silent(**spec))
+        else:
+            raise ValueError("%s: rule kind should be level or silent" % path)
+    engine = Engine(rules, *badge_thresholds(badge_config))
+    for (thing, room) in data.get("rooms", {}).items():
+        engine.place(thing, room)
+    return engine
+
+# Synthetic badges reporting every CADENCE seconds: most rooms sit in the
+# green, every twentieth goes over the alarm level from minute 2, and about
+# one badge in a hundred (spread over the rooms) stops reporting at minute
+# 5.  We check that exactly those rooms and badges set off alerts.
+CADENCE = 5
+
+def bench(badges, rooms, minutes):
+    import random
+    rng = random.Random(1)
+    engine = Engine([Level("room-alarm", "alarm", 10, over="room"),
+                     Level("badge-warning", "warning", 10),
+                     Silent("silent", 5)])
+    things = ["co2sao-%05d" % i for i in range(badges)]
+    for (i, thing) in enumerate(things):
+        engine.place(thing, "room-%03d" % (i % rooms))
+    stuffy = set("room-%03d" % r for r in range(0, rooms, 20))
+    quiet = set(things[::101])
+    start = 1730419200.0
+    fired = {}
+    began = time.perf_counter()
+    for step in range(int(minutes * 60 / CADENCE)):
+        t0 = start + step * CADENCE
+        late = step * CADENCE >= 5 * 60
+        for (i, thing) in enumerate(things):
+            if late and thing in quiet:
+                continue
+            t = t0 + i * CADENCE / badges
+            room = "room-%03d" % (i % rooms)
+            co2 = 1150 if room in stuffy and step * CADENCE >= 120 else 600
+            for alert in engine.reading(thing, t, co2 + rng.randint(-60, 60)):
+                fired.setdefault((alert["rule"], alert["key"]), alert["t"])
+        for alert in engine.tick(t0 + CADENCE):
+            fired.setdefault((alert["rule"], alert["key"]), alert["t"])
+    took = time.perf_counter() - began
+    n = engine.readings
+    print("%d badges in %d rooms, a reading every %d s for %d minutes, 3 rules" %
+          (badges, rooms, CADENCE, minutes))
+    print("Readings: %d in %.2f s, %.0f a second, %.2f us each (10k badges every %d s need %d a second)" %
+          (n, took, n / took, 1e6 * took / n, CADENCE, 10000 // CADENCE))
+    stats = engine.stats()
+    print("State: %d entries for %d badges and %d rooms" % (stats["state"], badges, rooms))
+
+    want_rooms = stuffy if minutes >= 12.5 else set()
+    want_quiet = quiet if minutes > 10 else set()
+    got_rooms = set(k for (r, k) in fired if r == "room-alarm")
+    got_badges = set(k for (r, k) in fired if r == "badge-warning")
+    got_quiet = set(k for (r, k) in fired if r == "silent")
+    want_badges = set(t for (i, t) in enumerate(things)
+                      if "room-%03d" % (i % rooms) in want_rooms and t not in quiet)
+    room_times = [fired[("room-alarm", r)] - start for r in got_rooms]
+    ok = got_rooms == want_rooms and got_quiet == want_quiet and got_badges == want_badges
+    print("Alerts: %d rooms over the alarm level (%s), %d badges silent (%s), %d badges over warning" %
+          (len(got_rooms), "as expected" if got_rooms == want_rooms else "EXPECTED %d" % len(want_rooms),
+           len(got_quiet), "as expected" if got_quiet == want_quiet else "EXPECTED %d" % len(want_quiet),
+           len(got_badges)))
+    if room_times:
+        print("Room alarms fired %.0f-%.0f s in (over the level from 120 s, for 600 s)" %
+              (min(room_times), max(room_times)))
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="Fleet-wide CO2 alert rules")
+    commands = parser.add_subparsers(dest="command", required=True)
+    p = commands.add_parser("bench", help="time the rules over synthetic badges")
+    p.add_argument("--badges", type=int, default=10000)
+    p.add_argument("--rooms", type=int, default=500)
+    p.add_argument("--minutes", type=float, default=20)
+    p = commands.add_parser("check", help="load a rules file and show what it sets up")
+    p.add_argument("rules")
+    args = parser.parse_args()
+    if args.command == "check":
+        engine = load(args.rules)
+        print("Thresholds: warning %d, alarm %d, hysteresis %d" % engine.thresholds)
+        for rule in engine.badge_rules + engine.room_rules:
+            print("%s: %s %s for %d minutes" % (rule.name, rule.over, rule.level, rule.seconds // 60))
+        for rule in engine.silent_rules:
+            print("%s: badge silent for %d minutes" % (rule.name, rule.seconds // 60))
+        print("%d badges placed in %d rooms" % (len(engine.room_of), len(set(engine.room_of.values()))))
+        return 0
+    return 0 if bench(args.badges, args.rooms, args.minutes) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
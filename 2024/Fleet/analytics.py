@@ -0,0 +1,335 @@
+# After-the-event statistics from a folder of badge traces
+#
+# Each badge that ran with recordTrace on leaves a co2trace.bin (see
+# tracelog.py) -- every raw reading the SCD40 gave it.  Collect them in a
+# folder, one file per badge named for it, and this works out for each badge
+# and each field (CO2, temperature F, humidity):
+#
+#   - the count, min, average and max that measure.Measure reports on the
+#     badge, plus percentiles
+#   - how long CO2 was at or above CO2_WARNING and CO2_ALARM (each reading
+#     counts until the next one, up to GAP_READINGS reading intervals, so
+#     the badge being off doesn't count as time at its last value; a trace
+#     too short to tell the interval from uses the sensor cadence its
+#     sampleDelay sets, as loadgen.py does)
+#   - the same per hour of the day it was in (UTC), and per hour across the
+#     whole fleet
+#
+# The warning and alarm levels and the cadence come from the badges'
+# co2sao.json, as in alerts.py.
+#
+# Rather than feed every reading through Measure one at a time, a trace is
+# read straight into NumPy arrays and everything is worked out on whole
+# arrays: the raw words are converted the way scd4x.py converts them, and
+# the hourly rollups are reductions over the hours' slices of the arrays
+# (percentiles too, from one sort by hour and value).  Badges are
+# independent, so they're spread over a pool of worker processes -- each
+# worker reads and reduces its own files and hands back only the small
+# results -- which scales with the number of cores.  Fleet-wide hours are
+# then made by merging the badges' hours, which only needs counts, totals,
+# minimums and maximums.
+#
+# This one needs NumPy (pip install numpy).
+#
+#     python3 analytics.py TRACES [--jobs N] [--csv OUTDIR] [--percentiles 5,50,95]
+#     python3 analytics.py --bench [--badges 64] [--hours 24]
+
+import argparse
+import csv
+import os
+import struct
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from alerts import badge_thresholds
+from loadgen import badge_cadence
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MICROPYTHON = os.path.join(os.path.dirname(HERE), "MicroPython")
+
+FIELDS = ("co2", "temperatureF", "humidity")
+PERCENTILES = (5, 50, 95)
+GAP_READINGS = 3        # Longest a reading counts for, in typical reading intervals
+
+# tracelog.py's file layout
+_MAGIC = b"CO2T"
+_HEADER = struct.Struct(">4sI")
+if np is not None:
+    _RECORDS = np.dtype([("ms", ">u4"), ("co2", ">u2"), ("temp", ">u2"), ("rh", ">u2")])
+
+# A trace's start time and readings as arrays: seconds since the epoch,
+# then each of FIELDS, converted as scd4x.py and co2sao.update() do
+def load(path):
+    with open(path, "rb") as f:
+        blob = f.read()
+    if len(blob) < _HEADER.size or blob[:4] != _MAGIC:
+        raise ValueError("%s: not a CO2 trace" % path)
+    started = _HEADER.unpack_from(blob)[1]
+    usable = (len(blob) - _HEADER.size) // _RECORDS.itemsize * _RECORDS.itemsize
+    records = np.frombuffer(blob, _RECORDS, usable // _RECORDS.itemsize, _HEADER.size)
+    t = started + records["ms"] / 1000.0
+    co2 = records["co2"].astype(np.float64)
+    tempF = (-45 + 175 * (records["temp"] / 2**16)) * 1.8 + 32.0
+    rh = 100 * (records["rh"] / 2**16)
+    # A trace carried on after a deep sleep keeps its timeline, but make sure
+    if len(t) > 1 and (np.diff(t) < 0).any():
+        order = np.argsort(t, kind="stable")
+        (t, co2, tempF, rh) = (t[order], co2[order], tempF[order], rh[order])
+    return (started, t, (co2, tempF, rh))
+
+# How long each reading counts for: until the next one, but no longer than
+# GAP_READINGS typical intervals (and the last one gets a typical interval).
+# With a lone reading, or readings all at the same time, there's no telling
+# the typical interval, so it's interval.
+def durations(t, interval):
+    gaps = np.diff(t)
+    typical = float(np.median(gaps)) if len(gaps) else 0.0
+    if typical <= 0:
+        typical = float(interval)
+    return np.minimum(np.append(gaps, typical), GAP_READINGS * typical)
+
+# Percentiles of each group of a sorted-by-group array, with NumPy's
+# default (linear) interpolation.  starts and counts give each group's
+# slice of values, which is sorted within each group.
+def _grouped_percentiles(values, starts, counts, q):
+    position = starts + (q / 100.0) * (counts - 1)
+    below = np.floor(position).astype(np.int64)
+    above = np.minimum(below + 1, starts + counts - 1)
+    return values[below] + (values[above] - values[below]) * (position - below)
+
+# Statistics for one badge's trace.  Runs in a worker process.
+def analyse(path, warning, alarm, percentiles=PERCENTILES, interval=5):
+    (started, t, values) = load(path)
+    thing = os.path.splitext(os.path.basename(path))[0]
+    result = {"thing": thing, "started": started, "readings": len(t), "fields": {}, "hours": {}}
+    if not len(t):
+        return result
+    held = durations(t, interval)
+    co2 = values[0]
+    result["seconds"] = float(held.sum())
+    result["warning"] = float(held[co2 >= warning].sum())
+    result["alarm"] = float(held[co2 >= alarm].sum())
+    for (name, v) in zip(FIELDS, values):
+        stats = {"count": len(v), "min": float(v.min()), "average": float(v.sum() / len(v)),
+                 "max": float(v.max())}
+        for (q, p) in zip(percentiles, np.percentile(v, percentiles)):
+            stats["p%g" % q] = float(p)
+        result["fields"][name] = stats
+
+    # Hours: the readings are in time order, so each hour is one slice
+    hour = (t // 3600).astype(np.int64)
+    starts = np.flatnonzero(np.r_[True, hour[1:] != hour[:-1]])
+    counts = np.diff(np.r_[starts, len(t)])
+    hours = {"hour": hour[starts] * 3600, "count": counts,
+             "seconds": np.add.reduceat(held, starts),
+             "warning": np.add.reduceat(np.where(co2 >= warning, held, 0.0), starts),
+             "alarm": np.add.reduceat(np.where(co2 >= alarm, held, 0.0), starts)}
+    for (name, v) in zip(FIELDS, values):
+        hours[name + ".total"] = np.add.reduceat(v, starts)
+        hours[name + ".min"] = np.minimum.reduceat(v, starts)
+        hours[name + ".max"] = np.maximum.reduceat(v, starts)
+        ordered = v[np.lexsort((v, hour))]
+        for q in percentiles:
+            hours[name + ".p%g" % q] = _grouped_percentiles(ordered, starts, counts, q)
+    result["hours"] = hours
+    return result
+
+def _analyse(job):
+    return analyse(*job)
+
+# Every badge's results, from a pool of jobs worker processes (or in this
+# process for jobs=1)
+def analyse_all(paths, warning, alarm, jobs=None, percentiles=PERCENTILES, interval=5):
+    work = [(path, warning, alarm, percentiles, interval) for path in paths]
+    if jobs == 1:
+        return [_analyse(job) for job in work]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(_analyse, work, chunksize=max(1, len(work) // (4 * (jobs or os.cpu_count() or 1)))))
+
+# Fleet-wide hours, merged from every badge's: (hour, readings, seconds,
+# warning seconds, alarm seconds, then min, average and max of each field)
+def fleet_hours(results):
+    parts = [r["hours"] for r in results if r["readings"]]
+    if not parts:
+        return []
+    merged = dict((key, np.concatenate([p[key] for p in parts])) for key in parts[0])
+    hour = merged["hour"]
+    order = np.argsort(hour, kind="stable")
+    hour = hour[order]
+    starts = np.flatnonzero(np.r_[True, hour[1:] != hour[:-1]])
+    add = lambda key: np.add.reduceat(merged[key][order], starts)
+    counts = add("count")
+    columns = [hour[starts], counts, add("seconds"), add("warning"), add("alarm")]
+    for name in FIELDS:
+        columns += [np.minimum.reduceat(merged[name + ".min"][order], starts), add(name + ".total") / counts,
+                    np.maximum.reduceat(merged[name + ".max"][order], starts)]
+    return list(zip(*(c.tolist() for c in columns)))
+
+def _stamp(t):
+    return time.strftime("%Y-%m-%d %H:00", time.gmtime(t))
+
+def report(results, percentiles, warning, alarm):
+    print("%-20s %8s %9s %6s %6s %6s %s %8s %8s" %
+          (("badge", "readings", "hours", "min", "avg", "max") +
+           (" ".join("%6s" % ("p%g" % q) for q in percentiles), ">=%d" % warning, ">=%d" % alarm)))
+    for r in results:
+        if not r["readings"]:
+            print("%-20s %8d" % (r["thing"], 0))
+            continue
+        c = r["fields"]["co2"]
+        print("%-20s %8d %9.1f %6.0f %6.0f %6.0f %s %7.1f%% %7.1f%%" %
+              (r["thing"], r["readings"], r["seconds"] / 3600, c["min"], c["average"], c["max"],
+               " ".join("%6.0f" % c["p%g" % q] for q in percentiles),
+               100 * r["warning"] / r["seconds"], 100 * r["alarm"] / r["seconds"]))
+
+def write_csv(folder, results, fleet, percentiles):
+    os.makedirs(folder, exist_ok=True)
+    stats = ["count", "min", "average", "max"] + ["p%g" % q for q in percentiles]
+    with open(os.path.join(folder, "badges.csv"), "w", newline="") as f:
+        out = csv.writer(f)
+        out.writerow(["badge", "readings", "seconds", "warningSeconds", "alarmSeconds"] +
+                     ["%s.%s" % (name, s) for name in FIELDS for s in stats])
+        for r in results:
+            if r["readings"]:
+                out.writerow([r["thing"], r["readings"], "%.0f" % r["seconds"], "%.0f" % r["warning"],
+                              "%.0f" % r["alarm"]] +
+                             [("%d" if s == "count" else "%.2f") % r["fields"][name][s]
+                              for name in FIELDS for s in stats])
+    with open(os.path.join(folder, "hours.csv"), "w", newline="") as f:
+        out = csv.writer(f)
+        out.writerow(["badge", "hour", "readings", "seconds", "warningSeconds", "alarmSeconds"] +
+                     ["%s.%s" % (name, s) for name in FIELDS for s in stats[1:]])
+        for r in results:
+            h = r["hours"]
+            for i in range(len(h.get("hour", ()))):
+                out.writerow([r["thing"], _stamp(h["hour"][i]), h["count"][i], "%.0f" % h["seconds"][i],
+                              "%.0f" % h["warning"][i], "%.0f" % h["alarm"][i]] +
+                             ["%.2f" % (h[name + ".total"][i] / h["count"][i] if s == "average" else h[name + "." + s][i])
+                              for name in FIELDS for s in stats[1:]])
+    with open(os.path.join(folder, "fleet_hours.csv"), "w", newline="") as f:
+        out = csv.writer(f)
+        out.writerow(["hour", "readings", "seconds", "warningSeconds", "alarmSeconds"] +
+                     ["%s.%s" % (name, s) for name in FIELDS for s in ("min", "average", "max")])
+        for row in fleet:
+            out.writerow([_stamp(row[0]), row[1]] + ["%.0f" % x for x in row[2:5]] + ["%.2f" % x for x in row[5:]])
+
+# Synthetic traces: badges at a 5 second cadence, some in a room that
+# fills up in the afternoon
+def make_traces(folder, badges, hours):
+    os.makedirs(folder, exist_ok=True)
+    started = int(time.time()) // 86400 * 86400
+    n = int(hours * 720)
+    for b in range(badges):
+        rng = np.random.default_rng(b)
+        ms = np.arange(n, dtype=np.int64) * 5000 + rng.integers(0, 50, n)
+        hour_of_day = (ms / 3.6e6) % 24
+        co2 = 480 + (600 if b % 4 == 0 else 200) * np.exp(-((hour_of_day - 15) / 2.5) ** 2)
+        co2 = co2 + rng.normal(0, 10, n)
+        tempC = 22 + 2 * np.sin(ms / 4e7) + rng.normal(0, 0.05, n)
+        rh = 45 + 5 * np.cos(ms / 5e7) + rng.normal(0, 0.2, n)
+        records = np.zeros(n, _RECORDS)
+        records["ms"] = ms
+        records["co2"] = np.clip(co2, 0, 40000)
+        records["temp"] = np.clip((tempC + 45) * 65536 / 175, 0, 65535)
+        records["rh"] = np.clip(rh * 65536 / 100, 0, 65535)
+        with open(os.path.join(folder, "co2sao-%03d.bin" % b), "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, started))
+            f.write(records.tobytes())
+
+# Time the whole fleet at 1, 2, 4... workers, and one badge against feeding
+# Measure a reading at a time, checking they agree
+def bench(badges, hours):
+    import tempfile
+    sys.path.insert(0, MICROPYTHON)
+    import measure
+    import tracelog
+    (warning, alarm, _) = badge_thresholds()
+    folder = tempfile.mkdtemp(prefix="co2traces-")
+    make_traces(folder, badges, hours)
+    paths = sorted(os.path.join(folder, name) for name in os.listdir(folder))
+    print("%d badges, %g hours each at a 5 s cadence (%d readings), %d cores" %
+          (badges, hours, badges * int(hours * 720), os.cpu_count() or 1))
+
+    # What the badge's Measure would take: overall and hourly measures of
+    # each field, a reading at a time
+    began = time.perf_counter()
+    (started, records) = tracelog.load(paths[0])
+    overall = [measure.Measure() for _ in FIELDS]
+    hourly = {}
+    for record in records:
+        (co2, tempC, rh) = tracelog.convert(record)
+        hour = (started + record[0] // 1000) // 3600
+        if hour not in hourly:
+            hourly[hour] = [measure.Measure() for _ in FIELDS]
+        for (value, m, h) in zip((co2, tempC * 1.8 + 32.0, rh), overall, hourly[hour]):
+            m.include(value)
+            h.include(value)
+    looped = time.perf_counter() - began
+    analyse(paths[-1], warning, alarm)
+    began = time.perf_counter()
+    one = analyse(paths[0], warning, alarm)
+    vectorized = time.perf_counter() - began
+    agree = True
+    for (name, m) in zip(FIELDS, overall):
+        f = one["fields"][name]
+        agree = agree and m.getCount() == f["count"] and abs(m.getMinimum() - f["min"]) < 1e-9 and \
+                abs(m.getMaximum() - f["max"]) < 1e-9 and abs(m.getAverage() - f["average"]) < 1e-9
+    agree = agree and len(hourly) == len(one["hours"]["hour"])
+    print("One badge: Measure a reading at a time %.1f ms, vectorized %.1f ms (with percentiles and "
+          "time above), %.0fx faster, results %s" %
+          (1000 * looped, 1000 * vectorized, looped / vectorized, "agree" if agree else "DIFFER"))
+
+    jobs = 1
+    first = None
+    while True:
+        began = time.perf_counter()
+        results = analyse_all(paths, warning, alarm, jobs)
+        fleet_hours(results)
+        took = time.perf_counter() - began
+        first = first or took
+        print("%2d worker%s: %.2f s, %.0f badges a second, %.1fx one worker" %
+              (jobs, " " if jobs == 1 else "s", took, badges / took, first / took))
+        if jobs >= (os.cpu_count() or 1):
+            break
+        jobs = min(2 * jobs, os.cpu_count() or 1)
+    for path in paths:
+        os.remove(path)
+    os.rmdir(folder)
+    return agree
+
+def main():
+    if np is None:
+        print("analytics.py needs NumPy: pip install numpy")
+        return 1
+    parser = argparse.ArgumentParser(description="Per-badge and per-hour statistics from badge traces")
+    parser.add_argument("traces", nargs="?", help="folder of trace files, one per badge, named for it")
+    parser.add_argument("--jobs", type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument("--csv", help="also write badges.csv, hours.csv and fleet_hours.csv here")
+    parser.add_argument("--percentiles", default=",".join("%g" % q for q in PERCENTILES))
+    parser.add_argument("--bench", action="store_true", help="time it on synthetic traces instead")
+    parser.add_argument("--badges", type=int, default=64, help="badges for --bench")
+    parser.add_argument("--hours", type=float, default=24, help="hours of readings for --bench")
+    args = parser.parse_args()
+    if args.bench:
+        return 0 if bench(args.badges, args.hours) else 1
+    if args.traces is None:
+        parser.error("which folder of traces?")
+    percentiles = tuple(float(q) for q in args.percentiles.split(","))
+    (warning, alarm, _) = badge_thresholds()
+    paths = sorted(os.path.join(args.traces, name) for name in os.listdir(args.traces) if name.endswith(".bin"))
+    results = analyse_all(paths, warning, alarm, args.jobs, percentiles, badge_cadence())
+    report(results, percentiles, warning, alarm)
+    fleet = fleet_hours(results)
+    if args.csv:
+        write_csv(args.csv, results, fleet, percentiles)
+        print("Wrote badges.csv, hours.csv and fleet_hours.csv to %s" % args.csv)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
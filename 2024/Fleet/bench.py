@@ -0,0 +1,178 @@
+# Throughput benchmark for the fleet aggregator
+#
+# Starts aggregator.py in its own process and has a crowd of simulated
+# badges post readings to it as fast as it will take them, over a number of
+# keep-alive connections, the way basicdweet would (a POST of the JSON
+# payload loadgen.py makes: the readings plus the energy and loop
+# telemetry).  With --batch each post carries that many queued readings as a
+# JSON array instead.  loadgen.py is for posting on the badges' own
+# schedule; this is for finding how many posts a second the server takes.
+#
+# We report posts and readings per second and the latency of each post as
+# the badges saw it, and -- since the badges here share the machine with
+# the server -- how much CPU the server itself spent per post, which is
+# what decides how many posts a second one core can take.  At the end we
+# check the server counted every post and reading and that each badge's
+# latest value is the last one it sent.
+#
+# With --data the server stores every reading on disk too (see
+# segments.py), and afterwards we read each badge's readings back out of
+# the store, timing the range queries and checking none went missing.
+#
+#     python3 bench.py [--badges 200] [--connections 50] [--seconds 5]
+#                      [--batch 1] [--pipeline 1] [--data DIR]
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+from loadgen import Badge, read_response
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+TARGET = 2000           # Posts a second we want one core to take
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class Client:
+    def __init__(self, port, things, batch, pipeline, seed):
+        self.port = port
+        self.badges = [Badge(thing, random.Random(seed * 1000 + i), 5) for (i, thing) in enumerate(things)]
+        self.batch = batch
+        self.pipeline = pipeline
+        self.posts = 0
+        self.readings = 0
+        self.errors = 0
+        self.latencies = []
+        self.last = {}          # thing -> the last content it sent
+
+    def request(self, n):
+        badge = self.badges[n % len(self.badges)]
+        thing = badge.thing
+        readings = [badge.payload(5 * (n + i)) for i in range(self.batch)]
+        self.last[thing] = readings[-1]
+        body = json.dumps(readings[0] if self.batch == 1 else readings).encode()
+        head = ("POST /dweet/for/%s HTTP/1.1\r\nHost: fleet\r\nContent-Type: application/json\r\n"
+                "Content-Length: %d\r\n\r\n" % (thing, len(body))).encode()
+        return head + body
+
+    async def run(self, until):
+        (reader, writer) = await asyncio.open_connection("127.0.0.1", self.port)
+        n = 0
+        sent = []
+        while time.perf_counter() < until:
+            while len(sent) < self.pipeline:
+                writer.write(self.request(n))
+                sent.append(time.perf_counter())
+                n += 1
+            await writer.drain()
+            (status, _, _) = await read_response(reader)
+            if status != 200:
+                self.errors += 1
+            self.latencies.append(time.perf_counter() - sent.pop(0))
+            self.posts += 1
+            self.readings += self.batch
+        # Collect the answers still in flight, so the counts agree
+        while sent:
+            await read_response(reader)
+            self.latencies.append(time.perf_counter() - sent.pop(0))
+            self.posts += 1
+            self.readings += self.batch
+        writer.close()
+
+async def get(port, path):
+    (reader, writer) = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(("GET %s HTTP/1.1\r\nHost: fleet\r\nConnection: close\r\n\r\n" % path).encode())
+    data = await reader.read()
+    writer.close()
+    return json.loads(data.split(b"\r\n\r\n", 1)[1])
+
+async def bench(args, port):
+    things = ["co2sao-%03d" % i for i in range(args.badges)]
+    clients = [Client(port, things[i::args.connections], args.batch, args.pipeline, i)
+               for i in range(min(args.connections, args.badges))]
+    before = await get(port, "/stats")
+    began = time.perf_counter()
+    await asyncio.gather(*(c.run(began + args.seconds) for c in clients))
+    wall = time.perf_counter() - began
+    after = await get(port, "/stats")
+
+    posts = sum(c.posts for c in clients)
+    readings = sum(c.readings for c in clients)
+    errors = sum(c.errors for c in clients)
+    latencies = sorted(x for c in clients for x in c.latencies)
+    cpu = after["cpu"] - before["cpu"]
+    print("%d badges over %d connections for %.1f s, %d reading%s a post, %d in flight per connection" %
+          (args.badges, len(clients), wall, args.batch, "" if args.batch == 1 else "s", args.pipeline))
+    print("Posts: %d, %.0f a second (%.0f readings a second), %d errors" %
+          (posts, posts / wall, readings / wall, errors))
+    print("Latency ms: median %.2f, 99%% %.2f, max %.2f" %
+          (1000 * latencies[len(latencies) // 2], 1000 * latencies[int(0.99 * (len(latencies) - 1))],
+           1000 * latencies[-1]))
+    per_core = posts / cpu if cpu > 0 else 0
+    print("Server CPU: %.2f s, %.0f us a post, so one core takes about %.0f posts a second (%s %d)" %
+          (cpu, 1000000 * cpu / max(1, posts), per_core, "meets" if per_core >= TARGET else "BELOW",
+           TARGET))
+
+    counted = after["posts"] - before["posts"] == posts and after["readings"] - before["readings"] == readings
+    latest_ok = True
+    for c in clients:
+        for (thing, content) in list(c.last.items())[:3]:
+            got = await get(port, "/get/latest/dweet/for/%s" % thing)
+            latest_ok = latest_ok and got["with"][0]["content"] == content
+    print("Check: server counted %s, latest values %s" %
+          ("every post and reading" if counted else "DIFFERENT TOTALS",
+           "match" if latest_ok else "DON'T MATCH"))
+
+    stored_ok = True
+    if args.data:
+        began = time.perf_counter()
+        stored = 0
+        for thing in things:
+            stored += len((await get(port, "/get/stored/dweets/for/%s" % thing))["with"])
+        took = time.perf_counter() - began
+        stored_ok = stored == readings
+        print("Stored: %d readings read back for %d badges in %.2f s (%.1f ms a badge), %s" %
+              (stored, len(things), took, 1000 * took / len(things),
+               "none missing" if stored_ok else "SOME MISSING"))
+    return counted and latest_ok and stored_ok and errors == 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the fleet aggregator")
+    parser.add_argument("--badges", type=int, default=200)
+    parser.add_argument("--connections", type=int, default=50)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--batch", type=int, default=1, help="readings per post")
+    parser.add_argument("--pipeline", type=int, default=1, help="posts in flight per connection")
+    parser.add_argument("--data", help="have the server store readings in this (empty) folder")
+    args = parser.parse_args()
+
+    port = free_port()
+    command = [sys.executable, os.path.join(HERE, "aggregator.py"), "--host", "127.0.0.1", "--port", str(port)]
+    if args.data:
+        command += ["--data", args.data]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+        ok = asyncio.run(bench(args, port))
+    finally:
+        server.terminate()
+        server.wait()
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
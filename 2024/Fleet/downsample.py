@@ -0,0 +1,449 @@
+# Downsampled views of stored readings, for charts
+#
+# A week of 5-second readings is 120,000 points per badge, for a chart a few
+# hundred pixels wide.  This answers range queries on a SegmentStore (see
+# segments.py) at the resolution the chart wants, two ways:
+#
+#   buckets()   count, min, mean and max in each bucket of width seconds.
+#               Buckets sit on multiples of width since the epoch (like a
+#               database's time_bucket), so the range is widened out to
+#               whole buckets and the same chart asked for again gets the
+#               same buckets.
+#   lttb()      Largest-Triangle-Three-Buckets: picks the readings
+#               that keep the shape of the line, so a plotted spike stays a
+#               spike.  Returns real (t, value) readings.
+#
+# Repeated dashboard queries are answered from rollups.  The first time a
+# segment is asked for, we reduce it to one row per minute -- readings,
+# total, min and max of each field -- and keep that both in memory (the
+# last CACHED segments) and next to the segment as <segment>.rup, marked
+# with how many records it covered.  When the segment grows (it's the
+# current hour, or a late batch arrived) the record count no longer matches
+# and just that segment is rolled up again.  Any bucket width that's a whole
+# number of minutes is then made from minute rows: a week is 10,080 of them
+# instead of 120,960 readings.  lttb() works from the minute means too once
+# each point it returns covers LTTB_MINUTES or more, or from the readings
+# themselves when asked for raw=True or zoomed in closer than that.
+#
+# Everything is vectorized with NumPy when it's installed; without it the
+# same results come from plain Python loops, just more slowly.
+#
+#     rollups = Rollups(SegmentStore("data"))
+#     width = width_for(start, end, 500)
+#     for (t, count, low, mean, high) in rollups.buckets(thing, start, end, width):
+#         ...
+#     for (t, co2) in rollups.lttb(thing, start, end, 500):
+#         ...
+#
+# From the command line, for a folder of stored readings:
+#
+#     python3 downsample.py DIR query THING [--from ...] [--to ...]
+#                           [--points 500] [--method minmax|lttb] [--field co2]
+#     python3 downsample.py DIR bench [--badges 4] [--days 7]
+
+import argparse
+import math
+import os
+import struct
+import sys
+import time
+from collections import OrderedDict
+
+from segments import FIELDS, RECORD, SegmentStore, parse_time, read_span
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MINUTE = 60
+CACHED = 512            # Segment rollups kept in memory
+LTTB_MINUTES = 10       # Minutes per returned point before lttb() uses minute means
+
+# Bucket widths width_for() picks from, in seconds
+STEPS = (5, 10, 15, 30, 60, 120, 300, 600, 900, 1800, 3600, 7200, 10800, 21600, 43200, 86400)
+
+# A rollup row: the minute, then readings, total, min and max of each field
+ROLLUP = struct.Struct("<d" + "Idff" * len(FIELDS))
+HEADER = struct.Struct("<I")        # Records in the segment when rolled up
+
+NAN = float("nan")
+INF = float("inf")
+
+if np is not None:
+    RECORDS = np.dtype([("t", "<f8")] + [(name, "<f4") for name in FIELDS])
+    ROWS = np.dtype([("minute", "<f8")] +
+                    [(name + "." + part, kind) for name in FIELDS
+                     for (part, kind) in (("count", "<u4"), ("total", "<f8"), ("min", "<f4"), ("max", "<f4"))])
+
+# The narrowest bucket width from STEPS that gives at most points buckets
+def width_for(start, end, points):
+    for width in STEPS:
+        if (end - start) / width <= points:
+            return width
+    return STEPS[-1] * math.ceil((end - start) / points / STEPS[-1])
+
+# Rollups are kept as columns: the minutes, then readings, total, min and
+# max for each field in turn -- NumPy arrays, or lists without NumPy.
+# Column 1 + 4 * f is the first one for FIELDS[f].
+
+def _rollup(data):
+    if np is not None:
+        records = np.frombuffer(data, RECORDS)
+        if not len(records):
+            return [np.zeros(0, ROWS[name]) for name in ROWS.names]
+        minutes = records["t"] // MINUTE * MINUTE
+        order = np.argsort(minutes, kind="stable")
+        minutes = minutes[order]
+        starts = np.flatnonzero(np.r_[True, minutes[1:] != minutes[:-1]])
+        columns = [minutes[starts]]
+        for name in FIELDS:
+            values = records[name][order]
+            valid = ~np.isnan(values)
+            columns += [np.add.reduceat(valid.astype(np.uint32), starts),
+                        np.add.reduceat(np.where(valid, values, 0).astype(np.float64), starts),
+                        np.fmin.reduceat(values, starts), np.fmax.reduceat(values, starts)]
+        return columns
+    rows = {}
+    for record in RECORD.iter_unpack(data):
+        minute = record[0] // MINUTE * MINUTE
+        row = rows.get(minute)
+        if row is None:
+            row = rows[minute] = [0, 0.0, INF, -INF] * len(FIELDS)
+        for (f, value) in enumerate(record[1:]):
+            if value == value:
+                i = 4 * f
+                row[i] += 1
+                row[i + 1] += value
+                if value < row[i + 2]:
+                    row[i + 2] = value
+                if value > row[i + 3]:
+                    row[i + 3] = value
+    columns = [[] for _ in range(1 + 4 * len(FIELDS))]
+    for minute in sorted(rows):
+        row = rows[minute]
+        columns[0].append(minute)
+        for (i, value) in enumerate(row):
+            # A field with no readings that minute has NaN min and max, as fmin gives
+            columns[i + 1].append(NAN if row[i - i % 4] == 0 and i % 4 >= 2 else value)
+    return columns
+
+def _pack(columns):
+    if np is not None:
+        rows = np.zeros(len(columns[0]), ROWS)
+        for (name, column) in zip(ROWS.names, columns):
+            rows[name] = column
+        return rows.tobytes()
+    return b"".join(ROLLUP.pack(*row) for row in zip(*columns))
+
+def _unpack(data):
+    if np is not None:
+        rows = np.frombuffer(data, ROWS)
+        return [rows[name] for name in ROWS.names]
+    columns = [[] for _ in range(1 + 4 * len(FIELDS))]
+    for row in ROLLUP.iter_unpack(data):
+        for (column, value) in zip(columns, row):
+            column.append(value)
+    return columns
+
+# Reduce partial aggregates (bucket, readings, total, min, max) to one
+# (bucket, readings, min, mean, max) per bucket, in time order, leaving out
+# buckets with no readings
+def _combine(keys, counts, totals, lows, highs):
+    if np is not None:
+        if not len(keys):
+            return []
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        counts = np.add.reduceat(counts[order].astype(np.int64), starts)
+        totals = np.add.reduceat(totals[order], starts)
+        lows = np.fmin.reduceat(lows[order], starts)
+        highs = np.fmax.reduceat(highs[order], starts)
+        keep = counts > 0
+        counts = counts[keep]
+        return list(zip(keys[starts][keep].tolist(), counts.tolist(), lows[keep].tolist(),
+                        (totals[keep] / counts).tolist(), highs[keep].tolist()))
+    buckets = {}
+    for (key, count, total, low, high) in zip(keys, counts, totals, lows, highs):
+        if not count:
+            continue
+        bucket = buckets.get(key)
+        if bucket is None:
+            buckets[key] = [count, total, low, high]
+        else:
+            bucket[0] += count
+            bucket[1] += total
+            if low < bucket[2]:
+                bucket[2] = low
+            if high > bucket[3]:
+                bucket[3] = high
+    return [(key, b[0], b[2], b[1] / b[0], b[3]) for (key, b) in sorted(buckets.items())]
+
+def _concat(parts, kind="d"):
+    if np is not None:
+        return np.concatenate(parts) if parts else np.zeros(0, kind)
+    return [value for part in parts for value in part]
+
+# Largest-Triangle-Three-Buckets (Steinarsson, 2013): the first and last
+# points, and from each of points - 2 equal-count buckets in between the
+# one making the largest triangle with the point picked before it and the
+# average of the next bucket.  times and values are in time order.
+def lttb(times, values, points):
+    n = len(times)
+    if n <= points:
+        return list(zip(times, values))
+    if points < 3:
+        return [(times[0], values[0]), (times[-1], values[-1])][:points]
+    every = (n - 2) / (points - 2)
+    picked = [0]
+    a = 0
+    if np is not None:
+        times = np.asarray(times, np.float64)
+        values = np.asarray(values, np.float64)
+        for b in range(points - 2):
+            lo = int(b * every) + 1
+            hi = int((b + 1) * every) + 1
+            nxt = min(int((b + 2) * every) + 1, n)
+            (ct, cv) = (times[hi:nxt].mean(), values[hi:nxt].mean()) if nxt > hi else (times[-1], values[-1])
+            (at, av) = (times[a], values[a])
+            areas = np.abs((at - ct) * (values[lo:hi] - av) - (at - times[lo:hi]) * (cv - av))
+            a = lo + int(areas.argmax())
+            picked.append(a)
+        picked.append(n - 1)
+        return list(zip(times[picked].tolist(), values[picked].tolist()))
+    for b in range(points - 2):
+        lo = int(b * every) + 1
+        hi = int((b + 1) * every) + 1
+        nxt = min(int((b + 2) * every) + 1, n)
+        if nxt > hi:
+            ct = sum(times[hi:nxt]) / (nxt - hi)
+            cv = sum(values[hi:nxt]) / (nxt - hi)
+        else:
+            (ct, cv) = (times[-1], values[-1])
+        (at, av) = (times[a], values[a])
+        best = -1.0
+        for i in range(lo, hi):
+            area = abs((at - ct) * (values[i] - av) - (at - times[i]) * (cv - av))
+            if area > best:
+                (best, a) = (area, i)
+        picked.append(a)
+    picked.append(n - 1)
+    return [(times[i], values[i]) for i in picked]
+
+class Rollups:
+    def __init__(self, store, cached=CACHED):
+        self.store = store
+        self.cached = cached
+        self._cache = OrderedDict()     # segment path -> (records, columns)
+        self.hits = 0                   # Segment rollups found in memory,
+        self.loaded = 0                 # read from a .rup file,
+        self.computed = 0               # and worked out from the readings
+
+    # The minute rollup of one segment
+    def segment(self, path):
+        count = os.path.getsize(path) // RECORD.size
+        cached = self._cache.get(path)
+        if cached is not None and cached[0] == count:
+            self._cache.move_to_end(path)
+            self.hits += 1
+            return cached[1]
+        columns = None
+        saved = path[:-4] + ".rup"
+        try:
+            with open(saved, "rb") as f:
+                data = f.read()
+            if len(data) >= HEADER.size and HEADER.unpack_from(data)[0] == count and \
+               (len(data) - HEADER.size) % ROLLUP.size == 0:
+                columns = _unpack(data[HEADER.size:])
+                self.loaded += 1
+        except OSError:
+            pass
+        if columns is None:
+            columns = _rollup(read_span(path, 0, count))
+            with open(saved, "wb") as f:
+                f.write(HEADER.pack(count) + _pack(columns))
+            self.computed += 1
+        self._cache[path] = (count, columns)
+        if len(self._cache) > self.cached:
+            self._cache.popitem(last=False)
+        return columns
+
+    # A thing's whole stored time range, for queries that leave either end open
+    def extent(self, thing, start, end):
+        if start is None or end is None:
+            found = self.store.segments(thing)
+            if not found:
+                return (0.0, 0.0)
+            if start is None:
+                start = found[0][0]
+            if end is None:
+                end = found[-1][0] + self.store.span
+        return (start, end)
+
+    # Minute rows of field with lo <= minute < hi, as (minutes, readings,
+    # total, min, max) columns
+    def minutes(self, thing, lo, hi, field="co2"):
+        f = 1 + 4 * FIELDS.index(field)
+        parts = [[] for _ in range(5)]
+        self.store.flush(thing)
+        for (began, path) in self.store.segments(thing):
+            if began + self.store.span <= lo or began >= hi:
+                continue
+            columns = self.segment(path)
+            selected = [columns[0]] + columns[f:f + 4]
+            if began < lo or began + self.store.span > hi:
+                if np is not None:
+                    keep = (columns[0] >= lo) & (columns[0] < hi)
+                    selected = [column[keep] for column in selected]
+                else:
+                    keep = [i for (i, m) in enumerate(columns[0]) if lo <= m < hi]
+                    selected = [[column[i] for i in keep] for column in selected]
+            for (part, column) in zip(parts, selected):
+                part.append(column)
+        return [_concat(part) for part in parts]
+
+    # Readings of field with lo <= t < hi, as (times, values) in time order
+    def readings(self, thing, lo, hi, field="co2"):
+        times = []
+        values = []
+        for (_, path, first, last) in self.store.spans(thing, lo, hi):
+            data = read_span(path, first, last)
+            if np is not None:
+                records = np.frombuffer(data, RECORDS)
+                keep = (records["t"] >= lo) & (records["t"] < hi) & ~np.isnan(records[field])
+                times.append(records["t"][keep])
+                values.append(records[field][keep].astype(np.float64))
+            else:
+                f = 1 + FIELDS.index(field)
+                kept = [r for r in RECORD.iter_unpack(data) if lo <= r[0] < hi and r[f] == r[f]]
+                times.append([r[0] for r in kept])
+                values.append([r[f] for r in kept])
+        (times, values) = (_concat(times), _concat(values))
+        # Segments are in order, but a late batch can be out of order within one
+        if np is not None:
+            if len(times) and (np.diff(times) < 0).any():
+                order = np.argsort(times, kind="stable")
+                (times, values) = (times[order], values[order])
+        elif any(b < a for (a, b) in zip(times, times[1:])):
+            (times, values) = map(list, zip(*sorted(zip(times, values), key=lambda p: p[0])))
+        return (times, values)
+
+    # (bucket start, readings, min, mean, max) of field for each bucket of
+    # width seconds with readings in it, covering start to end
+    def buckets(self, thing, start=None, end=None, width=60, field="co2"):
+        (start, end) = self.extent(thing, start, end)
+        lo = start // width * width
+        hi = -(-end // width) * width
+        if width % MINUTE == 0:
+            (keys, counts, totals, lows, highs) = self.minutes(thing, lo, hi, field)
+        else:
+            (keys, values) = self.readings(thing, lo, hi, field)
+            if np is not None:
+                counts = np.ones(len(keys), np.int64)
+            else:
+                counts = [1] * len(keys)
+            (totals, lows, highs) = (values, values, values)
+        if np is not None:
+            keys = keys // width * width
+        else:
+            keys = [k // width * width for k in keys]
+        return _combine(keys, counts, totals, lows, highs)
+
+    # About points (t, value) readings of field from start to end, picked by
+    # LTTB.  From minute means (timed at the middle of the minute) when each
+    # point covers LTTB_MINUTES or more, unless raw.
+    def lttb(self, thing, start=None, end=None, points=500, field="co2", raw=False):
+        (start, end) = self.extent(thing, start, end)
+        if not raw and (end - start) / max(points, 1) >= LTTB_MINUTES * MINUTE:
+            (minutes, counts, totals, _, _) = self.minutes(thing, start // MINUTE * MINUTE, end, field)
+            if np is not None:
+                keep = counts > 0
+                (times, values) = (minutes[keep] + MINUTE / 2, totals[keep] / counts[keep])
+            else:
+                kept = [(m + MINUTE / 2, t / c) for (m, c, t) in zip(minutes, counts, totals) if c]
+                times = [p[0] for p in kept]
+                values = [p[1] for p in kept]
+        else:
+            (times, values) = self.readings(thing, start, end, field)
+        return lttb(times, values, points)
+
+# A week (or days) of 5-second readings for badges things, drifting the way
+# a room's CO2 does over a day, with a few spikes
+def fill(store, things, days, start):
+    import random
+    for (i, thing) in enumerate(things):
+        rng = random.Random(i)
+        co2 = 600.0
+        for n in range(int(days * 86400 / 5)):
+            t = start + n * 5
+            hour = (t % 86400) / 3600
+            target = 450 + (700 if 9 <= hour < 17 else 100) + (900 if rng.random() < 0.0005 else 0)
+            co2 += (target - co2) * 0.01 + rng.gauss(0, 4)
+            store.append(thing, t, round(co2), 72 + math.sin(t / 5000), 40 + 3 * math.sin(t / 7000))
+    store.flush()
+
+def bench(store, badges, days):
+    things = ["co2sao-%03d" % i for i in range(badges)]
+    end = time.time() // 86400 * 86400
+    start = end - days * 86400
+    if not all(store.segments(thing) for thing in things):
+        began = time.perf_counter()
+        fill(store, [t for t in things if not store.segments(t)], days, start)
+        print("Stored %d days of 5 s readings for %d badges in %.1f s" % (days, badges, time.perf_counter() - began))
+    print("Vectorized with %s" % ("NumPy " + np.__version__ if np is not None else "plain Python (no NumPy)"))
+    rollups = Rollups(store)
+    width = width_for(start, end, 500)
+    for (label, query) in (("min/mean/max, %d s buckets" % width,
+                            lambda thing: rollups.buckets(thing, start, end, width)),
+                           ("LTTB from minute means", lambda thing: rollups.lttb(thing, start, end, 500)),
+                           ("LTTB from readings", lambda thing: rollups.lttb(thing, start, end, 500, raw=True))):
+        for attempt in ("first", "again"):
+            began = time.perf_counter()
+            points = sum(len(query(thing)) for thing in things)
+            took = time.perf_counter() - began
+            print("%-32s %-5s %7.1f ms a badge, %d points each" %
+                  (label, attempt, 1000 * took / badges, points // badges))
+    print("Segment rollups: %d worked out, %d read from disk, %d from memory" %
+          (rollups.computed, rollups.loaded, rollups.hits))
+
+def main():
+    parser = argparse.ArgumentParser(description="Downsampled range queries on stored CO2 readings")
+    parser.add_argument("root", help="storage folder (see segments.py)")
+    parser.add_argument("--partition", choices=("hour", "day"), default="hour")
+    commands = parser.add_subparsers(dest="command", required=True)
+    p = commands.add_parser("query", help="print a downsampled range as CSV")
+    p.add_argument("thing")
+    p.add_argument("--from", dest="start", type=parse_time)
+    p.add_argument("--to", dest="end", type=parse_time)
+    p.add_argument("--points", type=int, default=500)
+    p.add_argument("--method", choices=("minmax", "lttb"), default="minmax")
+    p.add_argument("--field", choices=FIELDS, default="co2")
+    p = commands.add_parser("bench", help="time queries over synthetic badges' readings")
+    p.add_argument("--badges", type=int, default=4)
+    p.add_argument("--days", type=int, default=7)
+    args = parser.parse_args()
+
+    store = SegmentStore(args.root, args.partition)
+    try:
+        if args.command == "bench":
+            bench(store, args.badges, args.days)
+            return 0
+        rollups = Rollups(store)
+        (start, end) = rollups.extent(args.thing, args.start, args.end)
+        stamp = lambda t: time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(t))
+        if args.method == "lttb":
+            print("time,%s" % args.field)
+            for (t, value) in rollups.lttb(args.thing, start, end, args.points, args.field):
+                print("%s,%.1f" % (stamp(t), value))
+        else:
+            print("time,readings,min,mean,max")
+            for (t, count, low, mean, high) in rollups.buckets(args.thing, start, end,
+                                                               width_for(start, end, args.points), args.field):
+                print("%s,%d,%.1f,%.1f,%.1f" % (stamp(t), count, low, mean, high))
+    finally:
+        store.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,275 @@
+# Load generator: a whole conference's badges reporting at once
+#
+# bench.py finds out how fast our own aggregator can go flat out.  This is
+# for the other question -- how does a collector, any collector, cope with N
+# badges each reporting on their own schedule, the way they really would?
+# Every simulated badge:
+#
+#   - reads its "sensor" on the badge's cadence: every 30 s in the SCD4X's
+#     low-power periodic mode, which co2sao uses when sampleDelay is over
+#     30 s, or every 5 s otherwise (from ../MicroPython/co2sao.json unless
+#     --cadence says), starting at a random point in the first interval
+#   - takes its readings from the Emulator's SCD4X sources (scd4x_sim.py),
+#     a meeting room for some badges and a quiet office for the rest, each
+#     at its own point in the day and with its own temperature and humidity,
+#     quantized to the sensor's 16-bit words and converted the way
+#     co2sao.update() does
+#   - posts them with the JSON postdweet() sends: co2, temperatureF and
+#     humidity, plus the energy and main loop telemetry fields.  With
+#     --batch it queues that many readings and posts them as a JSON array,
+#     each with its "created" time, the way a badge catching up after an
+#     upload window would.
+#
+# Posts go to --url, where {thing} becomes the badge's name, over a pool of
+# --connections keep-alive connections, or with --connections 0 a new
+# connection for every post (which is what the badges themselves do).
+# --speed runs the badges' clocks faster than real time to pack an hour of
+# reporting into a few minutes.
+#
+# Latency is measured from when a post was due, not when it was sent, so
+# time spent waiting for a free connection counts -- otherwise a collector
+# that falls behind would look as fast as one that doesn't.  At the end we
+# report the posts a second we offered and achieved, latency percentiles,
+# errors by kind, and how far behind schedule the generator itself got (if
+# that's large, the generator, not the collector, was the limit).
+#
+#     python3 loadgen.py [--url http://127.0.0.1:8080/dweet/for/{thing}]
+#                        [--badges 1000] [--seconds 60] [--cadence 30]
+#                        [--speed 1] [--batch 1] [--connections 100]
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from urllib.parse import urlsplit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MICROPYTHON = os.path.join(os.path.dirname(HERE), "MicroPython")
+sys.path.insert(0, os.path.join(MICROPYTHON, "Emulator"))
+import scd4x_sim
+
+URL = "http://127.0.0.1:8080/dweet/for/{thing}"
+MEETINGS = 0.25         # Share of badges in meeting rooms rather than offices
+TIMEOUT = 10            # Seconds before we give up on a post
+
+# The badges' sensor cadence, from the sampleDelay in their config file
+def badge_cadence(path=os.path.join(MICROPYTHON, "co2sao.json")):
+    try:
+        with open(path) as f:
+            delay = json.load(f).get("sampleDelay", 40)
+    except (OSError, ValueError):
+        delay = 40
+    return 30 if delay > 30 else 5
+
+def iso(t):
+    return "%s.%03dZ" % (time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(t)), int(t * 1000) % 1000)
+
+class Badge:
+    def __init__(self, thing, rng, cadence):
+        self.thing = thing
+        self.rng = rng
+        self.source = scd4x_sim.meeting if rng.random() < MEETINGS else scd4x_sim.office
+        self.offset = rng.uniform(0, 7200)      # Where in its day this badge starts
+        self.temp_bias = rng.uniform(-2.0, 2.0)
+        self.rh_bias = rng.uniform(-8.0, 8.0)
+        self.phase = rng.uniform(0, cadence)
+        self.mA = rng.uniform(1.8, 3.2)
+        self.samples = 0
+
+    # One reading seconds into the run, as co2sao.update() would have it:
+    # the sensor's words, then scd4x.py's conversions, then to F
+    def reading(self, seconds):
+        (co2, tempC, rh) = self.source(seconds + self.offset)
+        co2 = max(0, min(40000, int(co2)))
+        temp_word = max(0, min(65535, int((tempC + self.temp_bias + 45) * 65536 / 175)))
+        rh_word = max(0, min(65535, int((rh + self.rh_bias) * 65536 / 100)))
+        tempF = (-45 + 175 * (temp_word / 2**16)) * 1.8 + 32.0
+        return (co2, tempF, 100 * (rh_word / 2**16))
+
+    # What postdweet() sends for a reading seconds into the run
+    def payload(self, seconds):
+        (co2, tempF, rh) = self.reading(seconds)
+        self.samples += 1
+        hours = max(seconds, 1) / 3600
+        payload = {"co2": co2, "temperatureF": tempF, "humidity": rh}
+        payload.update({
+            "mA": round(self.mA, 2), "mAh": round(self.mA * hours, 3),
+            "mAhPerSample": round(self.mA * hours / self.samples, 5),
+            "sensorMA": round(0.4 * self.mA, 2), "radioMA": round(0.5 * self.mA, 2),
+        })
+        payload.update({
+            "loopMs": round(1000 + self.rng.gauss(0, 2), 1), "loopWorstLateMs": self.rng.randint(0, 12),
+            "loopMisses": self.samples // 500, "co2saoWorstMs": round(self.rng.uniform(4, 9), 1),
+            "co2saoOverruns": 0,
+        })
+        return payload
+
+# The status and body of one HTTP response: Content-Length, chunked, or
+# read until the connection closes
+async def read_response(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split()[1])
+    headers = {}
+    for line in lines[1:]:
+        (name, _, value) = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if "content-length" in headers:
+        body = await reader.readexactly(int(headers["content-length"]))
+    elif headers.get("transfer-encoding", "").lower() == "chunked":
+        body = b""
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+            if size == 0:
+                while await reader.readuntil(b"\r\n") != b"\r\n":
+                    pass            # Trailers
+                break
+            body += (await reader.readexactly(size + 2))[:-2]
+    elif status in (204, 304) or status < 200:
+        body = b""
+    else:
+        body = await reader.read()
+    return (status, headers, body)
+
+class Load:
+    def __init__(self, url, badges, cadence, speed=1.0, batch=1, connections=100, seed=1):
+        parts = urlsplit(url)
+        if parts.scheme != "http":
+            raise ValueError("only http:// URLs")
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path + ("?" + parts.query if parts.query else "")
+        self.cadence = cadence
+        self.speed = speed
+        self.batch = batch
+        self.connections = connections
+        self.keepalive = connections > 0
+        rng = random.Random(seed)
+        self.badges = [Badge("co2sao-%05d" % i, random.Random(rng.random()), cadence) for i in range(badges)]
+        self.pool = asyncio.Queue()
+        for _ in range(max(connections, 0) or badges):
+            self.pool.put_nowait(None)
+        self.posts = 0
+        self.readings = 0
+        self.attempts = 0
+        self.errors = {}            # kind -> count
+        self.latencies = []
+        self.lags = []
+
+    def _error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def request(self, badge, body):
+        return ("POST %s HTTP/1.1\r\nHost: %s:%d\r\nContent-Type: application/json\r\n"
+                "Content-Length: %d\r\n%s\r\n" %
+                (self.path.replace("{thing}", badge.thing), self.host, self.port, len(body),
+                 "" if self.keepalive else "Connection: close\r\n")).encode() + body
+
+    async def post(self, badge, readings, due):
+        self.attempts += 1
+        body = json.dumps(readings[0] if len(readings) == 1 else readings).encode()
+        conn = await self.pool.get()
+        try:
+            if conn is None:
+                conn = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), TIMEOUT)
+            (reader, writer) = conn
+            writer.write(self.request(badge, body))
+            (status, headers, _) = await asyncio.wait_for(read_response(reader), TIMEOUT)
+            self.latencies.append(time.perf_counter() - due)
+            if 200 <= status < 300:
+                self.posts += 1
+                self.readings += len(readings)
+            else:
+                self._error("HTTP %d" % status)
+            if not self.keepalive or headers.get("connection", "").lower() == "close":
+                writer.close()
+                conn = None
+        except asyncio.TimeoutError:
+            self._error("timeout")
+            conn = self._drop(conn)
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, IndexError) as e:
+            self._error(type(e).__name__)
+            conn = self._drop(conn)
+        finally:
+            self.pool.put_nowait(conn)
+
+    def _drop(self, conn):
+        if conn is not None:
+            conn[1].close()
+        return None
+
+    async def run_badge(self, badge, start, end, epoch):
+        interval = self.cadence / self.speed
+        due = start + badge.phase / self.speed
+        queued = []
+        while due < end:
+            now = time.perf_counter()
+            if due > now:
+                await asyncio.sleep(due - now)
+            self.lags.append(max(0.0, time.perf_counter() - due))
+            seconds = (due - start) * self.speed
+            reading = badge.payload(seconds)
+            if self.batch > 1:
+                reading["created"] = iso(epoch + seconds)
+            queued.append(reading)
+            if len(queued) >= self.batch:
+                await self.post(badge, queued, due)
+                queued = []
+            due += interval
+        # Whatever's still queued goes out at the end, as if the upload
+        # window had timed out
+        if queued:
+            await self.post(badge, queued, time.perf_counter())
+
+    async def run(self, seconds):
+        start = time.perf_counter() + 0.1
+        epoch = time.time() + 0.1
+        await asyncio.gather(*(self.run_badge(b, start, start + seconds, epoch) for b in self.badges))
+        return time.perf_counter() - start
+
+    def report(self, wall):
+        offered = len(self.badges) * self.speed / self.cadence / self.batch
+        print("%d badges reading every %g s%s, %d reading%s a post, %s" %
+              (len(self.badges), self.cadence, "" if self.speed == 1 else " at %gx speed" % self.speed,
+               self.batch, "" if self.batch == 1 else "s",
+               "%d keep-alive connections" % self.connections if self.keepalive else "a connection per post"))
+        print("Posts: %d of %d in %.1f s, %.0f a second (%.0f offered), %.0f readings a second" %
+              (self.posts, self.attempts, wall, self.posts / wall, offered, self.readings / wall))
+        failed = sum(self.errors.values())
+        print("Errors: %d (%.2f%%)%s" % (failed, 100.0 * failed / max(1, self.attempts),
+              "".join(", %d %s" % (n, kind) for (kind, n) in sorted(self.errors.items()))))
+        latencies = sorted(self.latencies)
+        if latencies:
+            pick = lambda q: 1000 * latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+            print("Latency ms: median %.1f, 90%% %.1f, 99%% %.1f, 99.9%% %.1f, max %.1f" %
+                  (pick(0.5), pick(0.9), pick(0.99), pick(0.999), 1000 * latencies[-1]))
+        lags = sorted(self.lags)
+        if lags:
+            print("Generator behind schedule: 99%% %.1f ms, max %.1f ms" %
+                  (1000 * lags[int(0.99 * (len(lags) - 1))], 1000 * lags[-1]))
+        return failed == 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a fleet of CO2 SAO badges posting readings")
+    parser.add_argument("--url", default=URL, help="where to post, {thing} is the badge's name")
+    parser.add_argument("--badges", type=int, default=1000)
+    parser.add_argument("--seconds", type=float, default=60, help="how long to run")
+    parser.add_argument("--cadence", type=float, default=None, help="seconds between readings")
+    parser.add_argument("--speed", type=float, default=1, help="run the badges' clocks this much faster")
+    parser.add_argument("--batch", type=int, default=1, help="readings per post")
+    parser.add_argument("--connections", type=int, default=100, help="0 for a connection per post")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    async def go():
+        load = Load(args.url, args.badges, args.cadence or badge_cadence(), args.speed, args.batch,
+                    args.connections, args.seed)
+        return (load, await load.run(args.seconds))
+    (load, wall) = asyncio.run(go())
+    return 0 if load.report(wall) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+# Per-badge time series in fixed-size rings
+#
+# Every badge (a "thing", in dweet.io terms) gets a Series: a ring of its
+# most recent readings, with the receive times in one array of doubles and
+# each numeric field -- co2, temperatureF, humidity, and whatever energy and
+# loop telemetry the badge sends along -- in its own array of floats.  The
+# arrays grow until they reach the ring's capacity and then wrap, so a badge
+# that only posts now and then doesn't cost a full ring, and memory is 4
+# bytes a number plus 8 for the time instead of a dict per reading.
+#
+# A field a badge starts sending later is given NaN for the readings before
+# it, and a reading without one of the known fields stores NaN there, so
+# every column lines up with the times.  Non-numeric values are only kept
+# in the latest reading.
+#
+#     store = Store(capacity=2880)
+#     store.add("orangemoose-co2sao", {"co2": 612, "temperatureF": 72.5})
+#     (t, content) = store.latest("orangemoose-co2sao")
+#     for (t, content) in store.history("orangemoose-co2sao", seconds=3600):
+#         ...
+
+from array import array
+import time
+
+CAPACITY = 2880         # Readings kept per badge: a day at 30 s, 4 hours at 5 s
+
+NAN = float("nan")
+
+class Series:
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self.times = array("d")
+        self.fields = {}            # name -> array("f") lined up with times
+        self.head = 0               # Next slot to overwrite once we're full
+        self.total = 0              # Readings ever added
+        self.latest = None          # The newest content as it was posted
+        self.latest_time = 0.0
+
+    def __len__(self):
+        return len(self.times)
+
+    def add(self, t, content):
+        fields = self.fields
+        if len(self.times) == self.capacity:
+            slot = self.head
+            self.head = (slot + 1) % self.capacity
+            self.times[slot] = t
+            for column in fields.values():
+                column[slot] = NAN
+        else:
+            slot = len(self.times)
+            self.times.append(t)
+            for column in fields.values():
+                column.append(NAN)
+        for (name, value) in content.items():
+            kind = type(value)
+            if kind is float or kind is int:
+                column = fields.get(name)
+                if column is None:
+                    column = fields[name] = array("f", [NAN]) * len(self.times)
+                column[slot] = value
+        self.total += 1
+        if t >= self.latest_time:
+            self.latest = content
+            self.latest_time = t
+
+    # Slot numbers from newest to oldest
+    def _newest_first(self):
+        n = len(self.times)
+        newest = (self.head - 1) % n if n == self.capacity else n - 1
+        for i in range(n):
+            yield (newest - i) % n
+
+    # Readings as (t, {field: value}), newest first (in the order they
+    # arrived), going back at most seconds from the newest and stopping
+    # after limit of them
+    def recent(self, seconds=None, limit=None):
+        if not self.times:
+            return []
+        result = []
+        oldest = None if seconds is None else self.latest_time - seconds
+        for slot in self._newest_first():
+            t = self.times[slot]
+            if oldest is not None and t < oldest:
+                break
+            content = {}
+            for (name, column) in self.fields.items():
+                value = column[slot]
+                if value == value:
+                    # Only as many digits as a float32 holds, so 72.1
+                    # comes back as 72.1
+                    content[name] = float("%.7g" % value)
+            result.append((t, content))
+            if limit is not None and len(result) >= limit:
+                break
+        return result
+
+class Store:
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self.things = {}
+        self.readings = 0
+
+    def add(self, thing, content, t=None):
+        series = self.things.get(thing)
+        if series is None:
+            series = self.things[thing] = Series(self.capacity)
+        series.add(time.time() if t is None else t, content)
+        self.readings += 1
+
+    # (t, content) of the newest reading, or None
+    def latest(self, thing):
+        series = self.things.get(thing)
+        if series is None or series.latest is None:
+            return None
+        return (series.latest_time, series.latest)
+
+    def history(self, thing, seconds=None, limit=None):
+        series = self.things.get(thing)
+        if series is None:
+            return []
+        return series.recent(seconds, limit)
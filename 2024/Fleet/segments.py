@@ -0,0 +1,301 @@
+# Durable, time-partitioned storage for CO2 readings
+#
+# ringstore.py only keeps each badge's recent readings in RAM.  For longer
+# history we write every reading to disk as well, in a layout that's cheap
+# to append to and quick to pull a time range back out of:
+#
+#   <root>/<thing>/<segment>.seg   fixed-width 20-byte records: the time
+#                                  (seconds since the epoch, a double),
+#                                  then CO2, temperature F and humidity
+#                                  as floats
+#   <root>/<thing>/<segment>.idx   sparse index: for every BLOCK records,
+#                                  their earliest and latest time and
+#                                  where they start
+#
+# Segments cover an hour ("2024110113") or a day ("20241101") of UTC time,
+# and a reading goes in the segment its own time falls in, so a late batch
+# still lands in the right place.  Within a segment records are in the
+# order they were written.
+#
+# A range query only looks at the segments whose names overlap the range.
+# In each one it reads the small index file, skips every block whose
+# earliest and latest times are both outside the range, and reads the rest
+# straight out of an mmap of the segment -- the segment file itself is never
+# read in full.  Records written since the last full block aren't in the
+# index yet, so they're always checked.
+#
+# Appends are buffered in memory, and written out a block at a time or when
+# flushed; query() flushes a thing's segments first, and flush() writes
+# everything out.  We don't keep files open between writes -- a fleet of
+# thousands of badges would need thousands of them -- but we do remember
+# where each segment being written to ends, so an append is no more than
+# packing a record.  Segments nothing was appended to between two flushes
+# are forgotten.  If a segment was left with a partial record, or its index
+# fell behind, that's fixed when it's next written to.
+#
+# The same store works from the aggregator (--data DIR) and on its own, for
+# readings from a badge's trace file (see tracelog.py):
+#
+#     python3 segments.py DIR import THING co2trace.bin
+#     python3 segments.py DIR query THING [--from 2024-11-01T10:00] [--to ...]
+#     python3 segments.py DIR things
+
+import argparse
+import calendar
+import mmap
+import os
+import struct
+import sys
+import time
+from urllib.parse import quote, unquote
+
+RECORD = struct.Struct("<dfff")     # time, co2, temperatureF, humidity
+INDEX = struct.Struct("<ddI")       # earliest, latest, first record
+BLOCK = 64                          # Records per index entry
+
+# Segment name format and length in seconds for each partitioning
+PARTITIONS = {"hour": ("%Y%m%d%H", 3600), "day": ("%Y%m%d", 86400)}
+
+# The readings we store, by their names in a badge's dweet
+FIELDS = ("co2", "temperatureF", "humidity")
+
+NAN = float("nan")
+
+# Thing names become directory names, so anything that isn't safe in one
+# is %-escaped (dots too, so "." and ".." can't happen)
+def _dirname(thing):
+    return quote(thing, safe="-_").replace(".", "%2E")
+
+def parse_time(text):
+    for fmt in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+        try:
+            return float(calendar.timegm(time.strptime(text.rstrip("Z"), fmt)))
+        except ValueError:
+            pass
+    return float(text)
+
+class _Segment:
+    # A segment being appended to
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path[:-4] + ".idx"
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        self.count = size // RECORD.size
+        if size % RECORD.size:
+            with open(path, "r+b") as f:
+                f.truncate(self.count * RECORD.size)
+        blocks = self.count // BLOCK
+        if (not os.path.exists(self.index_path) or
+                os.path.getsize(self.index_path) != blocks * INDEX.size):
+            _rebuild_index(path, self.index_path, blocks)
+        # Records and index entries not written out yet
+        self.data = bytearray()
+        self.index = bytearray()
+        self.touched = True
+        # Earliest and latest time in the block being filled
+        self.earliest = float("inf")
+        self.latest = float("-inf")
+        for (t, co2, temp, rh) in _records(path, blocks * BLOCK, self.count):
+            self.earliest = min(self.earliest, t)
+            self.latest = max(self.latest, t)
+
+    def append(self, t, co2, temp, rh):
+        self.data += RECORD.pack(t, co2, temp, rh)
+        self.count += 1
+        self.touched = True
+        if t < self.earliest:
+            self.earliest = t
+        if t > self.latest:
+            self.latest = t
+        if self.count % BLOCK == 0:
+            self.index += INDEX.pack(self.earliest, self.latest, self.count - BLOCK)
+            self.earliest = float("inf")
+            self.latest = float("-inf")
+            self.flush()
+
+    # The records go out before the index entries that point at them
+    def flush(self):
+        if self.data:
+            with open(self.path, "ab") as f:
+                f.write(self.data)
+            self.data = bytearray()
+        if self.index:
+            with open(self.index_path, "ab") as f:
+                f.write(self.index)
+            self.index = bytearray()
+
+# The bytes of records first to last-1 of the segment at path, read
+# through an mmap
+def read_span(path, first, last):
+    if last <= first:
+        return b""
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return mm[first * RECORD.size:last * RECORD.size]
+
+def _records(path, first, last):
+    return RECORD.iter_unpack(read_span(path, first, last))
+
+def _rebuild_index(path, index, blocks):
+    with open(index, "wb") as f:
+        for b in range(blocks):
+            times = [r[0] for r in _records(path, b * BLOCK, (b + 1) * BLOCK)]
+            f.write(INDEX.pack(min(times), max(times), b * BLOCK))
+
+class SegmentStore:
+    def __init__(self, root, partition="hour"):
+        if partition not in PARTITIONS:
+            raise ValueError("partition should be one of %s" % ", ".join(PARTITIONS))
+        self.root = root
+        self.partition = partition
+        (self._format, self.span) = PARTITIONS[partition]
+        self._writing = {}              # thing -> {segment name: _Segment}
+        self.appended = 0
+        os.makedirs(root, exist_ok=True)
+
+    def _segment(self, thing, name):
+        writing = self._writing.get(thing)
+        if writing is None:
+            writing = self._writing[thing] = {}
+        segment = writing.get(name)
+        if segment is None:
+            folder = os.path.join(self.root, _dirname(thing))
+            os.makedirs(folder, exist_ok=True)
+            segment = writing[name] = _Segment(os.path.join(folder, name + ".seg"))
+        return segment
+
+    def append(self, thing, t, co2, temp, rh):
+        name = time.strftime(self._format, time.gmtime(t))
+        self._segment(thing, name).append(t, co2, temp, rh)
+        self.appended += 1
+
+    # Store a reading the way a badge dweets it, like ringstore.Store.add().
+    # Anything without a CO2 reading isn't one of ours and is skipped.
+    def add(self, thing, content, t=None):
+        values = [content.get(name) for name in FIELDS]
+        if type(values[0]) not in (int, float):
+            return
+        for i in (1, 2):
+            if type(values[i]) not in (int, float):
+                values[i] = NAN
+        self.append(thing, time.time() if t is None else t, *values)
+
+    # Write out one thing's segments, or everyone's.  Flushing everyone
+    # also forgets the segments nothing was appended to since last time.
+    def flush(self, thing=None):
+        if thing is not None:
+            for segment in self._writing.get(thing, {}).values():
+                segment.flush()
+            return
+        for (thing, writing) in list(self._writing.items()):
+            for (name, segment) in list(writing.items()):
+                segment.flush()
+                if not segment.touched:
+                    del writing[name]
+                segment.touched = False
+            if not writing:
+                del self._writing[thing]
+
+    def close(self):
+        for writing in self._writing.values():
+            for segment in writing.values():
+                segment.flush()
+        self._writing.clear()
+
+    def things(self):
+        return sorted(unquote(d) for d in os.listdir(self.root)
+                      if os.path.isdir(os.path.join(self.root, d)))
+
+    # A thing's segments as (start time, path), oldest first
+    def segments(self, thing):
+        folder = os.path.join(self.root, _dirname(thing))
+        if not os.path.isdir(folder):
+            return []
+        found = []
+        for filename in os.listdir(folder):
+            if filename.endswith(".seg"):
+                try:
+                    start = calendar.timegm(time.strptime(filename[:-4], self._format))
+                except ValueError:
+                    continue
+                found.append((start, os.path.join(folder, filename)))
+        return sorted(found)
+
+    # The parts of a thing's segments that may hold readings with
+    # start <= t < end, as (segment start time, path, first, last) record
+    # numbers: the indexed blocks whose times overlap the range, and the
+    # records written since the last full block.  Segments come oldest
+    # first, and the caller still checks each record's time.
+    def spans(self, thing, start=None, end=None):
+        self.flush(thing)
+        lo = float("-inf") if start is None else start
+        hi = float("inf") if end is None else end
+        for (began, path) in self.segments(thing):
+            if began + self.span <= lo or began >= hi:
+                continue
+            count = os.path.getsize(path) // RECORD.size
+            with open(path[:-4] + ".idx", "rb") as f:
+                index = f.read()
+            indexed = 0
+            for (earliest, latest, first) in INDEX.iter_unpack(index):
+                indexed = first + BLOCK
+                if latest < lo or earliest >= hi:
+                    continue
+                yield (began, path, first, first + BLOCK)
+            if indexed < count:
+                yield (began, path, indexed, count)
+
+    # Readings (t, co2, temperatureF, humidity) with start <= t < end, in
+    # time order by segment and in the order they were written within each
+    def query(self, thing, start=None, end=None):
+        lo = float("-inf") if start is None else start
+        hi = float("inf") if end is None else end
+        for (_, path, first, last) in self.spans(thing, start, end):
+            for record in _records(path, first, last):
+                if lo <= record[0] < hi:
+                    yield record
+
+# Store the readings from a badge trace file (tracelog.py) as thing
+def import_trace(store, thing, path):
+    here = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.join(os.path.dirname(here), "MicroPython"))
+    import tracelog
+    (started, records) = tracelog.load(path)
+    for record in records:
+        (co2, tempC, rh) = tracelog.convert(record)
+        store.append(thing, started + record[0] / 1000, co2, tempC * 1.8 + 32.0, rh)
+    store.flush()
+    return len(records)
+
+def main():
+    parser = argparse.ArgumentParser(description="Time-partitioned CO2 reading storage")
+    parser.add_argument("root", help="storage folder")
+    parser.add_argument("--partition", choices=sorted(PARTITIONS), default="hour")
+    commands = parser.add_subparsers(dest="command", required=True)
+    p = commands.add_parser("import", help="store a badge trace file")
+    p.add_argument("thing")
+    p.add_argument("trace")
+    p = commands.add_parser("query", help="print a thing's readings as CSV")
+    p.add_argument("thing")
+    p.add_argument("--from", dest="start", type=parse_time)
+    p.add_argument("--to", dest="end", type=parse_time)
+    commands.add_parser("things", help="list the things stored")
+    args = parser.parse_args()
+
+    store = SegmentStore(args.root, args.partition)
+    try:
+        if args.command == "import":
+            print("Stored %d readings for %s" % (import_trace(store, args.thing, args.trace), args.thing))
+        elif args.command == "query":
+            print("time,co2,temperatureF,humidity")
+            for (t, co2, temp, rh) in store.query(args.thing, args.start, args.end):
+                print("%s,%.0f,%.1f,%.1f" % (time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(t)), co2, temp, rh))
+        else:
+            for thing in store.things():
+                print("%s  %d segments" % (thing, len(store.segments(thing))))
+    finally:
+        store.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
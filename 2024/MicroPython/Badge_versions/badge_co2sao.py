@@ -1,9 +1,22 @@
-import machine
-from machine import Pin
 import time
-import json
 import scd4x
-# import basicdweet
+import struct
+import co2config
+from stoplight import Stoplight
+import co2filter
+from trend import Trend
+from measure import Measure, RECORD_SIZE
+from history import History
+from pressure import PressureFeed, LPS22
+from tracelog import TraceRecorder
+from recovery import Recovery, FAILURES
+import adaptive
+import energy
+import loopstats
+try:
+    import basicdweet
+except ImportError:
+    basicdweet = None
 
 # Map LED control values (GPIO1 & GPIO2) to LED colors. Must agree with wiring
 # on Stoplight controller board.  We're using a Grey code scheme for green ->
@@ -34,36 +47,169 @@ TEMPERATURE_OFFSET = 0.0
 CO2_WARNING = 800
 CO2_ALARM = 1000
 
+# GPIO pins driving the low-order and high-order stoplight bits, and which
+# badge port the add-on is plugged into
+STOPLIGHT_LSB = 7
+STOPLIGHT_MSB = 6
+BADGE_PORT = 1
+
+# Stoplight LED brightness in percent.  Below 100 the LEDs are dimmed with
+# PWM, e.g. to save power at night.
+BRIGHTNESS = 100
+
+# Outlier filtering ahead of the stoplight (see co2filter.py): filter type
+# ("none", "median" or "hampel"), window size in samples, and the Hampel
+# filter's outlier threshold in scaled MADs
+FILTER = "median"
+FILTER_WINDOW = 5
+HAMPEL_K = 3.0
+
+# Once the stoplight has moved up to yellow or red, CO2 has to fall this many
+# ppm below the threshold before it moves back down
+HYSTERESIS = 25
+
+# CO2 trend is fitted over this many seconds of readings.  If it predicts
+# we'll reach the ALARM level within PREWARN_SECONDS the stoplight blinks
+# between its current color and the next one up (0 turns this off).
+TREND_WINDOW = 600
+PREWARN_SECONDS = 300
+
+# Sensor sampling: "fixed" uses SAMPLE_DELAY to pick one measurement mode at
+# boot, "adaptive" moves between modes as CO2 changes (see adaptive.py), in
+# which case quiet periods take one reading every CYCLE_PERIOD seconds
+SAMPLING = "fixed"
+CYCLE_PERIOD = 120
+
+# If there's a barometer, the sensor is told the ambient pressure whenever
+# the smoothed reading moves more than PRESSURE_DEADBAND hPa, or at least
+# every PRESSURE_MAX_AGE seconds (see pressure.py).  Without one the sensor
+# compensates using ALTITUDE only.
+PRESSURE_DEADBAND = 2.0
+PRESSURE_MAX_AGE = 3600
+
+# Set RECORD_TRACE to record every raw sensor reading to a trace file that
+# can be replayed through this code on Linux (see tracelog.py)
+RECORD_TRACE = 0
+
+# Keep the session's readings in a compressed history of this many KB (see
+# history.py), about 20000 readings in 32KB.  0 turns it off.  It's in RAM
+# only, so it starts again after a deep sleep.
+HISTORY_KB = 32
+
 haveCO2SAO = False
-def init(i2cbus):
-    global scd4x, _led_bit0, _led_bit1, _co2_status
+
+# Outbound readings go through a netpower.RadioManager if we're given one,
+# so the radio is only up when there's a batch to send
+_radio = None
+
+# How many times the stoplight would have changed if driven straight from
+# raw readings, versus how many times it actually changed
+_raw_status = OFF
+_raw_changes = 0
+_led_changes = 0
+
+# Whether the pre-warning blink is on, and which half of the blink we're in
+_prewarn = False
+_blink = False
+
+# Adaptive sampling policy, when SAMPLING is "adaptive"
+_sampler = None
+
+# Ambient pressure feed, when we have a barometer
+_pressure = None
+
+# Sensor trace recorder, when RECORD_TRACE is set
+_recorder = None
+
+# Retries, bus recovery and counts for the sensor's I2C (see recovery.py),
+# and how many updates in a row the sensor couldn't be reached
+_recovery = None
+_failures = 0
+
+# Where readings go for the UI when we're running on the second core (see
+# dualcore.py)
+_ring = None
+
+# Running statistics for the session, and when we last got a reading
+_co2data = Measure()
+_tempdata = Measure()
+_rhdata = Measure()
+_last_reading = 0
+
+# The readings themselves, when HISTORY_KB isn't 0
+_history = None
+
+# Saved state for deep sleep (see idle.py): LED status, the status raw
+# readings would give, the sampler's mode (255 for none) and ms until its
+# next reading, then the three Measures (Measure.pack())
+_STATE = ">BBBI"
+
+# Set up the add-on.  state is what saveState() returned before a deep
+# sleep, if we're waking from one, and slept is how long we were asleep in ms.
+def init(i2cbus, radio=None, state=None, slept=0):
+    global scd4x, _stoplight, _co2_status, _radio, _filter, _trend, _sampler, _last_reading, _recovery
+    global CO2_WARNING, CO2_ALARM, ALTITUDE, SAMPLE_DELAY, TEMPERATURE_OFFSET
+    global STOPLIGHT_LSB, STOPLIGHT_MSB, BADGE_PORT, BRIGHTNESS
+    global FILTER, FILTER_WINDOW, HAMPEL_K, HYSTERESIS, TREND_WINDOW, PREWARN_SECONDS
+    global SAMPLING, CYCLE_PERIOD, PRESSURE_DEADBAND, PRESSURE_MAX_AGE, RECORD_TRACE, _recorder
+    global HISTORY_KB, _history
+    _radio = radio
     
-    # load the CO2 SAO add-on config file from the filesystem
+    # Load the CO2 SAO add-on config file from the filesystem.  Settings are
+    # validated once and cached in compiled form (see co2config.py), and any
+    # that are present override the defaults above.
     try:
-        f = open("co2sao.json")
-        config = json.load(f)
-
-        # Read settings from the JSON data in the imported config file
-        co2Warning = config["co2Warning"]
-        co2Alarm = config["co2Alarm"]
-        siteAltitude = config["altitude"]
-        sampleDelay = config["sampleDelay"]
-        stoplightLSB = config["stoplightLSB"]
-        stoplightMSB = config["stoplightMSB"]
-        tempOffsetC = config["tempOffsetC"]
-        badgePort = config["badgePort"]
-    except:
-        pass
+        config = co2config.load()
+        CO2_WARNING = config.co2Warning
+        CO2_ALARM = config.co2Alarm
+        ALTITUDE = config.altitude
+        SAMPLE_DELAY = config.sampleDelay
+        STOPLIGHT_LSB = config.stoplightLSB
+        STOPLIGHT_MSB = config.stoplightMSB
+        TEMPERATURE_OFFSET = config.tempOffsetC
+        BADGE_PORT = config.badgePort
+        BRIGHTNESS = config.brightness
+        FILTER = config.filter
+        FILTER_WINDOW = config.filterWindow
+        HAMPEL_K = config.hampelK
+        HYSTERESIS = config.hysteresis
+        TREND_WINDOW = config.trendWindow
+        PREWARN_SECONDS = config.prewarnSeconds
+        SAMPLING = config.sampling
+        CYCLE_PERIOD = config.cyclePeriod
+        PRESSURE_DEADBAND = config.pressureDeadband
+        PRESSURE_MAX_AGE = config.pressureMaxAge
+        RECORD_TRACE = config.recordTrace
+        HISTORY_KB = config.historyKB
+    except (OSError, ValueError) as err:
+        print("CO2 SAO config not loaded, using defaults:", err)
 
     # Recap configuration settings found in the config file
     print("*** CO2 SAO Add-on Configuration ***")
-    print("Stoplight thresholds: Warning = %d, Alarm = %d" % (co2Warning,co2Alarm))
-    print("Site altitude = %d meters, Sample delay = %d seconds" % (siteAltitude,sampleDelay))
-    print("Enclosure temperature offset = %.2f degrees C" % (tempOffsetC))
-    print("Add-on connections: Low-order bit on GPIO%d, High-order bit on GPIO%d" % (stoplightLSB,stoplightMSB))
-    print("SAO is on badge port %d" % (badgePort))
+    print("Stoplight thresholds: Warning = %d, Alarm = %d" % (CO2_WARNING,CO2_ALARM))
+    print("Site altitude = %d meters, Sample delay = %d seconds" % (ALTITUDE,SAMPLE_DELAY))
+    print("Enclosure temperature offset = %.2f degrees C" % (TEMPERATURE_OFFSET))
+    print("Add-on connections: Low-order bit on GPIO%d, High-order bit on GPIO%d" % (STOPLIGHT_LSB,STOPLIGHT_MSB))
+    print("SAO is on badge port %d" % (BADGE_PORT))
+    print("Stoplight brightness = %d%%" % (BRIGHTNESS))
+    print("CO2 filter = %s, window = %d samples, hysteresis = %d ppm" % (FILTER,FILTER_WINDOW,HYSTERESIS))
 
-    scd4x = scd4x.SCD4X(i2cbus)
+    print("CO2 trend window = %d seconds, pre-warning %d seconds ahead of alarm" % (TREND_WINDOW,PREWARN_SECONDS))
+    print("Sampling = %s, quiet periods sampled every %d seconds" % (SAMPLING,CYCLE_PERIOD))
+
+    _filter = co2filter.make(FILTER, FILTER_WINDOW, HAMPEL_K)
+    _trend = Trend(TREND_WINDOW)
+    if HISTORY_KB:
+        _history = History(HISTORY_KB * 1024)
+
+    # Record the sensor's raw readings on their way past, if asked to
+    if RECORD_TRACE:
+        _recorder = TraceRecorder(i2cbus)
+        i2cbus = _recorder
+        print("Recording sensor readings to %s" % (_recorder.path))
+
+    _recovery = Recovery(i2cbus)
+    scd4x = scd4x.SCD4X(i2cbus, recovery=_recovery)
         
     # On-board LED, which isn't used normally but might be useful for debugging
     # led = Pin("LED", Pin.OUT)
@@ -77,13 +223,18 @@ def init(i2cbus):
     # pins identified as "5" (D5) and "6" (D6) on the Adafruit Feather RP2040
     # itself are actually GPIO7 and GPIO8 (so must be identified as "7" and "8" \
     # respectively in calls to the MicroPython Pin() class.
-    _led_bit0 = Pin(7, Pin.OUT)
-    _led_bit1 = Pin(6, Pin.OUT)
-
-    # Initialize LEDs to all off, overall CO2 status is off
-    _led_bit0.value(0)
-    _led_bit1.value(0)
+    #
+    # The Stoplight driver sets both bits in a single register write so the
+    # decoder never sees an in-between color (see stoplight.py).  It starts
+    # with LEDs all off, so overall CO2 status is off.
+    _stoplight = Stoplight(STOPLIGHT_LSB, STOPLIGHT_MSB)
     _co2_status = OFF
+    setBrightness(BRIGHTNESS)
+
+    # Carry on where we left off if we're waking from a deep sleep
+    resume_mode = None
+    if state is not None:
+        (resume_mode, due) = restoreState(state)
 
     # Connect to SCD40 and initialize
     # i2c = machine.I2C(1)  # For using the Feather RP2040 built-in STEMMA QT connector
@@ -100,31 +251,158 @@ def init(i2cbus):
     scd4x.temperature_offset = TEMPERATURE_OFFSET
     scd4x.altitude = ALTITUDE
 
-    # Can use low-power measurement mode for sampling longer than 30 seconds
-    if SAMPLE_DELAY > 30:
+    # Use a barometer SAO for pressure compensation if there's one on our bus
+    barometer = LPS22.find(i2cbus)
+    if barometer is not None:
+        print("Barometer found at address 0x%x, pressure deadband = %.1f hPa" % (barometer.address,PRESSURE_DEADBAND))
+        setPressureSource(barometer)
+
+    # Either let the adaptive sampler pick the measurement mode, or use
+    # low-power measurement mode for sampling longer than 30 seconds
+    if SAMPLING == "adaptive":
+        _sampler = adaptive.Sampler(scd4x, CO2_WARNING, CO2_ALARM, CYCLE_PERIOD)
+        if resume_mode is not None:
+            _sampler.resume(resume_mode, due - slept)
+        else:
+            _sampler.start()
+    else:
+        startMeasuring()
+    _last_reading = time.ticks_ms()
+
+# Start the sensor measuring in the mode we're using
+def startMeasuring():
+    if _sampler is not None:
+        _sampler.start(_sampler.mode)
+    elif SAMPLE_DELAY > 30:
         scd4x.start_low_periodic_measurement()
     else:
-        scd4x.start_periodic_measurement()    
+        scd4x.start_periodic_measurement()
 
+# Read the sensor if there's a reading and act on it.  The driver has
+# already retried anything that failed (see recovery.py), so if the sensor
+# still can't be reached we carry on without it, and after FAILURES
+# updates in a row like that, or if it's stopped delivering readings when it
+# should be measuring, we set it up again.
 def update():
-    global scd4x
+    global _failures
+    try:
+        _update()
+        _failures = 0
+        if _sensorQuiet():
+            print("CO2 sensor has gone quiet")
+            reinitSensor()
+    except RuntimeError as err:
+        _failures += 1
+        print("CO2 sensor failed %d time(s) in a row: %s" % (_failures,err))
+        if _failures >= FAILURES:
+            _failures = 0
+            reinitSensor()
+
+# Whether the sensor should have delivered a reading by now, three times
+# over, and hasn't
+def _sensorQuiet():
+    mode = energy.meter.current(energy.SENSOR)
+    if mode == energy.SENSOR_IDLE:
+        return False
+    since = _last_reading
+    if _sampler is not None and time.ticks_diff(_sampler.started, since) > 0:
+        since = _sampler.started
+    interval = 5000 if mode == energy.SENSOR_PERIODIC else 30000
+    return time.ticks_diff(time.ticks_ms(), since) > 3 * interval
+
+# Put the sensor back the way init() set it up, after a brownout or
+# whatever else has upset it
+def reinitSensor():
+    global _last_reading
+    print("Reinitializing CO2 sensor")
+    _recovery.reinitialized()
+    _last_reading = time.ticks_ms()
+    try:
+        scd4x.reinit()
+        scd4x.temperature_offset = TEMPERATURE_OFFSET
+        scd4x.altitude = ALTITUDE
+        if _pressure is not None:
+            _pressure.sent = None
+        startMeasuring()
+    except RuntimeError as err:
+        print("CO2 sensor reinit failed: %s" % (err))
+
+def _update():
+    global scd4x, _raw_status, _raw_changes, _prewarn, _last_reading
+    # Wake the sensor if the adaptive sampler has a reading due
+    if _sampler is not None:
+        _sampler.poll()
     if scd4x.data_ready:
-            tempF = (scd4x.temperature * 1.8) + 32.0
-            print("%d ppm CO2, %0.1f *F, %0.1f %%RH" % (scd4x.CO2,tempF,scd4x.relative_humidity))
-            
+            co2 = scd4x.CO2
+            tempF = scd4x.temperature_f
+            rh = scd4x.relative_humidity
+            energy.meter.sample()
+            _last_reading = time.ticks_ms()
+            _co2data.include(co2)
+            _tempdata.include(tempF)
+            _rhdata.include(rh)
+            if _history is not None:
+                _history.append(time.time(), co2, tempF, rh)
+
+            # Pass on ambient pressure changes, if we have a barometer
+            if _pressure is not None:
+                _pressure.update()
+
+            # Filter out one-off spikes before deciding on a color
+            filtered = _filter.add(co2) if _filter is not None else co2
+            print("%d ppm CO2 (filtered %d), %0.1f *F, %0.1f %%RH" % (co2,filtered,tempF,rh))
+
+            # Update the CO2 trend and see when we're heading for the alarm level
+            _trend.include(filtered)
+            eta = _trend.seconds_to(CO2_ALARM)
+            if eta is not None and eta > 0:
+                print("CO2 rising %.1f ppm/min, alarm level in about %d seconds" % (_trend.slope(),eta))
+
+            # Let the adaptive sampler speed up or slow down the sensor
+            if _sampler is not None:
+                _sampler.sampled(filtered, _trend.slope())
+
+            # Keep track of how often the raw readings alone would have
+            # changed the stoplight, for comparison
+            rawstatus = co2status(co2)
+            if rawstatus != _raw_status:
+                _raw_status = rawstatus
+                _raw_changes += 1
+
             # Calculate green/yellow/red CO2 air quality status from CO2 value
-            newstatus = co2status(scd4x.CO2)
+            newstatus = co2status(filtered, _co2_status)
             
             # Set status, which may result in updating stoplight LEDs
             setLED(newstatus)
+
+            # Pre-warn if the alarm level is coming up soon
+            _prewarn = (PREWARN_SECONDS > 0 and newstatus != RED and
+                        eta is not None and eta < PREWARN_SECONDS)
             
-            # Post latest readings via dweet.io (presuming we're connected to a network)
-            # postdweet(scd4x.CO2,tempF,scd4x.relative_humidity)
+            # Queue latest readings for posting via dweet.io next time the
+            # radio manager opens an upload window
+            if _radio is not None:
+                _radio.queue((co2,tempF,rh))
+
+            # Hand the reading to the UI on the other core, if there is one
+            if _ring is not None:
+                _ring.put(co2,tempF,rh)
+
+    # Blink the pre-warning pattern, one step per call
+    prewarnLED()
             
 # Determine air quality corresponding to CO2 reading, with thresholds
 # to establish green, yellow, and red status in overall PPM.  Note that
 # these thresholds are somewhat arbitrary and not based on firm guidance.
-def co2status(co2value):
+# Given the current status, applies HYSTERESIS so a reading hovering around
+# a threshold doesn't keep flipping the stoplight back and forth.
+def co2status(co2value, current=OFF):
+    # Stay red until CO2 falls HYSTERESIS below the ALARM level, and stay
+    # yellow until it falls HYSTERESIS below the WARNING level
+    if current == RED and co2value >= CO2_ALARM - HYSTERESIS:
+        return RED
+    if current == YELLOW and CO2_WARNING - HYSTERESIS <= co2value < CO2_ALARM:
+        return YELLOW
     # AQ status is green if CO2 < WARNING level
     if co2value < CO2_WARNING:
         return GREEN
@@ -135,28 +413,144 @@ def co2status(co2value):
     return RED
 
 # Set the stoplight LEDs based on CO2 status.  Attempts to minimize value
-# flickering by (a) not changing outputs if the value hasn't changed and
-# (b) using a gray code approach as described above
+# flickering by (a) not changing outputs if the value hasn't changed,
+# (b) using a gray code approach as described above and (c) changing both
+# bits at once when a change needs both of them
 def setLED(newstatus):
-    global _co2_status
+    global _co2_status, _led_changes
     if newstatus == _co2_status:
         return
-        
-    if newstatus & 1:
-        _led_bit0.value(1)
-    else:
-        _led_bit0.value(0)
-    if newstatus & 2:
-        _led_bit1.value(1)
-    else:
-        _led_bit1.value(0)
+    _stoplight.set(newstatus)
     _co2_status = newstatus
+    _led_changes += 1
     return
 
+# Report how much stoplight churn the filter and hysteresis have removed
+def filterReport():
+    print("Stoplight changes: %d from raw readings, %d after filtering" % (_raw_changes,_led_changes))
+    if isinstance(_filter, co2filter.HampelFilter):
+        print("Hampel filter replaced %d readings" % (_filter.replaced))
+
+# Report time spent in each sampling mode and estimated sensor current
+def samplingReport():
+    if _sampler is not None:
+        _sampler.report()
+
+# Compensate for ambient pressure using readings from source, a function
+# returning hPa (e.g. a barometer on another bus), or None to stop
+def setPressureSource(source):
+    global _pressure
+    if source is None:
+        _pressure = None
+    else:
+        _pressure = PressureFeed(source, scd4x, PRESSURE_DEADBAND, PRESSURE_MAX_AGE)
+
+# Pass each new (co2, tempF, rh) reading on through ring, a
+# dualcore.SampleRing, or stop with None
+def setSampleRing(ring):
+    global _ring
+    _ring = ring
+
+# Report the session's CO2, temperature and humidity statistics
+def statsReport():
+    print("CO2 %d->%d->%d ppm, %0.1f->%0.1f->%0.1f *F, %0.1f->%0.1f->%0.1f %%RH over %d readings" %
+          (_co2data.getMinimum(),_co2data.getAverage(),_co2data.getMaximum(),
+           _tempdata.getMinimum(),_tempdata.getAverage(),_tempdata.getMaximum(),
+           _rhdata.getMinimum(),_rhdata.getAverage(),_rhdata.getMaximum(),_co2data.getCount()))
+    if _history is not None:
+        print("History holds %d readings over %d minutes in %d bytes" %
+              (len(_history),_history.span() // 60,_history.bytes_used()))
+
+# How many milliseconds the main loop can idle before we next need to be
+# called: until the next reading is due, or one blink while pre-warning
+def idleMs():
+    if _prewarn:
+        return 1000
+    if _sampler is not None:
+        due = _sampler.due_ms()
+        if due is not None:
+            return due
+    since = _last_reading
+    if _sampler is not None and time.ticks_diff(_sampler.started, since) > 0:
+        since = _sampler.started
+    mode = energy.meter.current(energy.SENSOR)
+    interval = 5000 if mode == energy.SENSOR_PERIODIC else 30000
+    return max(500, interval - time.ticks_diff(time.ticks_ms(), since))
+
+# Lightsleep stops PWM, which would leave dimmed LEDs stuck on or off
+def canLightSleep():
+    return BRIGHTNESS == 100
+
+# Deep sleep resets the badge, so only when the sensor is idle between
+# duty-cycled readings.  The stoplight goes dark until we wake.
+def canDeepSleep():
+    return _sampler is not None and _sampler.due_ms() is not None and not _prewarn
+
+# The state we need to carry on seamlessly after a deep sleep, as bytes
+def saveState():
+    if _recorder is not None:
+        _recorder.flush()
+    mode = 255
+    due = 0
+    if _sampler is not None:
+        mode = _sampler.mode
+        due = _sampler.due_ms() or 0
+    return (struct.pack(_STATE, _co2_status, _raw_status, mode, due) +
+            _co2data.pack() + _tempdata.pack() + _rhdata.pack())
+
+# Put back what saveState() saved.  Returns the sampler mode to resume in
+# (or None) and how many ms from the save its next reading was due.
+def restoreState(data):
+    global _raw_status
+    if len(data) != struct.calcsize(_STATE) + 3 * RECORD_SIZE:
+        print("CO2 SAO saved state unusable, starting fresh")
+        return (None, 0)
+    (status, _raw_status, mode, due) = struct.unpack_from(_STATE, data, 0)
+    offset = struct.calcsize(_STATE)
+    for m in (_co2data, _tempdata, _rhdata):
+        offset = m.unpack_from(data, offset)
+    setLED(status)
+    return (None if mode == 255 else mode, due)
+
+# Report estimated energy use so far, overall and per component
+def energyReport():
+    energy.meter.report()
+
+# Report the sensor's I2C errors and what it took to recover from them
+def recoveryReport():
+    _recovery.report()
+
+# While pre-warning, alternate between the current color and the next one
+# up (green -> yellow, yellow -> red) each time we're called.  Otherwise make
+# sure the stoplight shows the current status.
+def prewarnLED():
+    global _blink
+    if _prewarn:
+        _blink = not _blink
+        if _blink:
+            _stoplight.set(YELLOW if _co2_status == GREEN else RED)
+            return
+    _stoplight.set(_co2_status)
+
+# Dim the stoplight LEDs, as a percentage of full brightness
+def setBrightness(percent):
+    global BRIGHTNESS
+    if _stoplight.dim(percent):
+        BRIGHTNESS = percent
+    else:
+        print("Stoplight pins GPIO%d/GPIO%d can't be dimmed together" % (STOPLIGHT_LSB,STOPLIGHT_MSB))
+
 def postdweet(co2, tempF, rh):
+    if basicdweet is None:
+        return
     payload = {
         'co2': co2,
         'temperatureF' : tempF,
         'humidity' : rh
         }
+    # Running energy and main loop timing totals, so configurations can be
+    # compared remotely
+    payload.update(energy.meter.telemetry())
+    payload.update(loopstats.monitor.telemetry())
+    payload.update(_recovery.telemetry())
     r = basicdweet.dweet_for('orangemoose-co2sao',payload)
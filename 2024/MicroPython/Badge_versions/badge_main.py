@@ -2,9 +2,23 @@ from machine import I2C, Pin
 import time
 import scd4x
 import co2sao
+import energy
+import loopstats
+import dualcore
+from buttons import Buttons
 
 counter = 0
 
+# Main loop timing (see loopstats.py).  The loop says when each pass is due
+# before it waits, and the add-ons' updates have budgets.
+monitor = loopstats.monitor
+UI_TASK = monitor.task("ui", 10)
+CO2_TASK = monitor.task("co2sao", 50)
+
+# Print the loop timing report this often, in seconds
+LOOP_REPORT = 3600
+last_report = time.ticks_ms()
+
 ## do a quick spiral to test
 if petal_bus:
     for j in range(8):
@@ -15,6 +29,14 @@ if petal_bus:
             time.sleep_ms(30)
             petal_bus.writeto_mem(PETAL_ADDRESS, i, bytes([which_leds]))
 
+# Run the CO2 add-on on the RP2040's second core and keep the petal,
+# touchwheel and buttons on a steady UI_TICK ms tick here (see dualcore.py)
+DUAL_CORE = False
+UI_TICK = 20
+
+# Longest the single-core loop waits with nothing to do, in ms
+MAX_WAIT = 1000
+
 # See if we have a CO2SAO attached and if so initialize it
 CO2SAO_ADDRESS     = 0x62
 haveCO2SAO = False
@@ -22,56 +44,136 @@ i2cbusses = which_bus_has_device_id(CO2SAO_ADDRESS)
 if len(i2cbusses) >= 1:
     print("CO2SAO detected")
     haveCO2SAO = True
-    co2sao.init(i2cbusses[0])
-
-while True:
-
-    ## display button status on RGB
-    if petal_bus:
-        if not buttonA.value():
-            petal_bus.writeto_mem(PETAL_ADDRESS, 2, bytes([0x80]))
-        else:
-            petal_bus.writeto_mem(PETAL_ADDRESS, 2, bytes([0x00]))
-
-        if not buttonB.value():
-            petal_bus.writeto_mem(PETAL_ADDRESS, 3, bytes([0x80]))
+    co2bus = i2cbusses[0]
+    # With the two cores sharing a bus, each transfer has to take turns
+    if DUAL_CORE and co2bus in (petal_bus, touchwheel_bus):
+        shared = dualcore.LockedI2C(co2bus)
+        if petal_bus is co2bus:
+            petal_bus = shared
+        if touchwheel_bus is co2bus:
+            touchwheel_bus = shared
+        co2bus = shared
+    co2sao.init(co2bus)
+
+# Buttons come in by interrupt and queue up until we get to them (see
+# buttons.py), so nothing needs to poll them.  The touchwheel has no
+# interrupt line, so we read it every TOUCH_POLL ms.
+buttons = Buttons((buttonA, buttonB, buttonC))
+event = [0, 0, 0]
+TOUCH_POLL = 100
+
+# What the petal should show: the buttons held down light the top bit of
+# petals 2-4, and the petal under a finger on the touchwheel lights the rest
+held = 0
+touched = 0
+# What each petal register was last set to (the spiral leaves them all lit),
+# so we only write the ones that change
+petal_leds = bytearray([0xFF] * 9)
+
+def read_buttons():
+    global held
+    while buttons.get(event):
+        if event[1]:
+            held |= 1 << event[0]
         else:
-            petal_bus.writeto_mem(PETAL_ADDRESS, 3, bytes([0x00]))
-
-        if not buttonC.value():
-            petal_bus.writeto_mem(PETAL_ADDRESS, 4, bytes([0x80]))
-        else:
-            petal_bus.writeto_mem(PETAL_ADDRESS, 4, bytes([0x00]))
-
-    ## see what's going on with the touch wheel
+            held &= ~(1 << event[0])
+
+def read_touchwheel():
+    global touched
+    tw = touchwheel_read(touchwheel_bus)
+    if tw > 0:
+        tw = (128 - tw) % 256
+        touched = int(tw/32) + 1
+    else:
+        touched = 0
+
+def show_petal():
+    for i in range(1,9):
+        value = 0
+        if 2 <= i <= 4 and held & (1 << (i - 2)):
+            value |= 0x80
+        if i == touched:
+            value |= 0x7F
+        if petal_leds[i] != value:
+            petal_leds[i] = value
+            petal_bus.writeto_mem(PETAL_ADDRESS, i, bytes([value]))
+
+def ui():
+    read_buttons()
     if touchwheel_bus:
-        tw = touchwheel_read(touchwheel_bus)
-
-    ## display touchwheel on petal
-    if petal_bus and touchwheel_bus:
-        if tw > 0:
-            tw = (128 - tw) % 256 
-            petal = int(tw/32) + 1
-        else: 
-            petal = 999
-        for i in range(1,9):
-            if i == petal:
-                petal_bus.writeto_mem(0, i, bytes([0x7F]))
-            else:
-                petal_bus.writeto_mem(0, i, bytes([0x00]))
-
+        read_touchwheel()
+    if petal_bus:
+        show_petal()
+
+if DUAL_CORE and haveCO2SAO:
+    # Core1 reads the sensor and passes each reading back through the ring.
+    # Here we just flash the Pico's LED for a tick when one arrives.
+    ring = dualcore.SampleRing(16)
+    reading = [0.0, 0.0, 0.0]
+    co2sao.setSampleRing(ring)
+    dualcore.start((co2sao.update,), co2sao.idleMs)
+    monitor.period_ms = UI_TICK
+    next_tick = time.ticks_ms()
+    while True:
+        monitor.tick()
+        started = monitor.start()
+        ui()
+        monitor.done(UI_TASK, started)
+
+        bootLED.off()
+        while ring.get(reading):
+            bootLED.on()
+
+        if time.ticks_diff(time.ticks_ms(), last_report) >= LOOP_REPORT * 1000:
+            last_report = time.ticks_ms()
+            monitor.report()
+
+        # Wait for the next tick, or start again from now if we're behind
+        next_tick = time.ticks_add(next_tick, UI_TICK)
+        wait = time.ticks_diff(next_tick, time.ticks_ms())
+        if wait > 0:
+            energy.meter.state(energy.CPU, energy.CPU_IDLE)
+            time.sleep_ms(wait)
+            energy.meter.state(energy.CPU, energy.CPU_ACTIVE)
+        else:
+            next_tick = time.ticks_ms()
 
-    
-    time.sleep_ms(20)
+# The loop only wakes for a button event, the next touchwheel read or the
+# add-on's next update, whichever comes first
+monitor.period_ms = TOUCH_POLL if touchwheel_bus else MAX_WAIT
+next_touch = time.ticks_ms()
+next_co2 = time.ticks_ms()
+while True:
+    monitor.tick()
+    now = time.ticks_ms()
+    started = monitor.start()
+    read_buttons()
+    if touchwheel_bus and time.ticks_diff(next_touch, now) <= 0:
+        read_touchwheel()
+        next_touch = time.ticks_add(now, TOUCH_POLL)
+    if petal_bus:
+        show_petal()
+    monitor.done(UI_TASK, started)
     bootLED.off()
-    
-    if haveCO2SAO == True:
-        co2sao.update()
-    
-    time.sleep(1)
-
-
-
 
+    if haveCO2SAO and time.ticks_diff(next_co2, now) <= 0:
+        started = monitor.start()
+        co2sao.update()
+        monitor.done(CO2_TASK, started)
+        next_co2 = time.ticks_add(time.ticks_ms(), co2sao.idleMs())
 
+    if time.ticks_diff(time.ticks_ms(), last_report) >= LOOP_REPORT * 1000:
+        last_report = time.ticks_ms()
+        monitor.report()
 
+    # Tell the energy meter the CPU is idle while we wait
+    wait = MAX_WAIT
+    if touchwheel_bus:
+        wait = min(wait, time.ticks_diff(next_touch, time.ticks_ms()))
+    if haveCO2SAO:
+        wait = min(wait, time.ticks_diff(next_co2, time.ticks_ms()))
+    wait = max(0, wait)
+    monitor.expect(wait)
+    energy.meter.state(energy.CPU, energy.CPU_IDLE)
+    buttons.wait(wait)
+    energy.meter.state(energy.CPU, energy.CPU_ACTIVE)
@@ -1,16 +1,18 @@
 import machine
-import network
-from time import sleep
+import time
 import scd4x
 import co2sao
+from wifi import WiFi
+from netpower import RadioManager, RADIO_DOWN
+from idle import Idle
+import energy
+import loopstats
 
 # Wi-Fi credentials
 ssid = 'Supercon'
 password = 'whatpassword'
 
 def badge_init():
-    global wlan
-    
     # Scan for attached I2C devices
     sdaPIN=machine.Pin(0)
     sclPIN=machine.Pin(1)
@@ -22,42 +24,65 @@ def badge_init():
             print("    I2C Device at address = ",hex(device))
     else:
         print("No device found")
-        
-    # Init Wi-Fi Interface
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
-
-    # Connect to your network
-    wlan.connect(ssid, password)
-
-    # Wait for Wi-Fi connection
-    connection_timeout = 10
-    while connection_timeout > 0:
-        if wlan.status() >= 3:
-            break
-        connection_timeout -= 1
-        print('Waiting for Wi-Fi connection...')
-        sleep(1)
-
-    # Check if connection is successful
-    if wlan.status() != 3:
-        raise RuntimeError('Failed to establish a network connection')
-    else:
-        network_info = wlan.ifconfig()
-        print('WiFi connected, IP address:', network_info[0])
+
+# Upload batching: bring the radio up when this many readings are queued,
+# or when the oldest has waited UPLOAD_DELAY seconds
+UPLOAD_BATCH = 10
+UPLOAD_DELAY = 600
+
+# How the main loop waits between sensor readings (see idle.py): "sleep",
+# "light" or "deep".  USB serial doesn't survive lightsleep, so use "sleep"
+# while working at the REPL.
+IDLE_MODE = "light"
+
+# Longest we idle in one go, in ms
+MAX_IDLE = 60000
+
+# Print energy, idle and loop timing reports this often, in seconds
+ENERGY_REPORT = 3600
+
+# Time budgets for each pass's work, in ms (see loopstats.py)
+RADIO_BUDGET = 50
+CO2SAO_BUDGET = 50
+
+# state is what was saved before a deep sleep, if we're waking from one
+def network_init(state=None):
+    global wifi, radio
+
+    # The radio manager decides when the radio comes up.  Connecting happens
+    # in the background (polled from the main loop) so add-ons run while we
+    # associate, and the radio goes back down once the batch is sent.
+    wifi = WiFi(ssid, password)
+    radio = RadioManager(wifi, co2sao.postdweet, batch=UPLOAD_BATCH, max_delay=UPLOAD_DELAY)
+    if state is not None and "radio" in state:
+        radio.restore(state["radio"], idle.last_slept)
 
 def init():
+    global idle
+
+    # Pick up any state saved before a deep sleep
+    idle = Idle(IDLE_MODE)
+    state = idle.resume()
+    if state is not None:
+        print("Waking from deep sleep after %d ms" % (idle.last_slept))
+
     # Initialize the badge itself
     badge_init()
-     
-     # Initialize all add-ons
+    network_init(state)
+
+    # Initialize all add-ons
     CO2SAO_ADDRESS     = 0x62
     i2cbusses = which_bus_has_device_id(CO2SAO_ADDRESS)
     if len(i2cbusses) >= 1:
         print("CO2SAO detected")
         haveCO2SAO = True
-        co2sao.init(i2cbusses[0])
-     
+        co2sao.init(i2cbusses[0], radio, state.get("co2sao") if state is not None else None,
+                    idle.last_slept)
+
+    # What to save if we deep sleep
+    idle.register("co2sao", co2sao.saveState)
+    idle.register("radio", radio.save)
+
 def main():
     # Initialize everything
     print("Badge initializing...")
@@ -65,10 +90,41 @@ def main():
     
     # Main loop
     print("Beginning main loop")
+    monitor = loopstats.monitor
+    radio_task = monitor.task("radio", RADIO_BUDGET)
+    co2sao_task = monitor.task("co2sao", CO2SAO_BUDGET)
+    last_report = time.ticks_ms()
     while True:
+        monitor.tick()
+
+        # Open an upload window if one is due, or check on the one in progress
+        started = monitor.start()
+        radio.poll()
+        monitor.done(radio_task, started)
+
         # Call update functions for all attached add-ons
+        started = monitor.start()
         co2sao.update()
-        sleep(10)
+        monitor.done(co2sao_task, started)
+
+        if time.ticks_diff(time.ticks_ms(), last_report) >= ENERGY_REPORT * 1000:
+            last_report = time.ticks_ms()
+            energy.meter.report()
+            co2sao.recoveryReport()
+            idle.report()
+            monitor.report()
+
+        # Wait until something's due, as deeply as it's safe to.  Neither
+        # sleep is safe with the radio up.
+        down = radio.state == RADIO_DOWN
+        wait = min(co2sao.idleMs(), radio.idle_ms(), MAX_IDLE)
+        # Any time we'd spend idle anyway can go on the one scan wifi.py
+        # needs to cache the access point (see WiFi.learn())
+        if down and wifi.learn(wait):
+            wait = min(co2sao.idleMs(), radio.idle_ms(), MAX_IDLE)
+        monitor.expect(wait)
+        idle.sleep(wait, light=down and co2sao.canLightSleep(),
+                   deep=down and co2sao.canDeepSleep())
     
         
 if __name__=="__main__":
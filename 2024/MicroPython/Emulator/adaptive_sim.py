@@ -0,0 +1,124 @@
+# Replay CO2 traces through the add-on with fixed and adaptive sampling
+#
+# Runs the real badge_co2sao add-on against a simulated SCD4X on a simulated
+# I2C bus, under a virtual clock, once for each sampling policy.  For each
+# run we report how long the sensor spent in each mode, its average current
+# (from the sensor's own view of its modes), and how long after CO2 really
+# crossed the warning and alarm levels the stoplight caught up.
+#
+# With no arguments two synthetic traces are used: a meeting room filling up
+# and emptying again, and a quiet office.  A recorded trace can be given as
+# a CSV file of "seconds,co2,tempC,rh" rows instead.
+#
+#     python3 adaptive_sim.py [trace.csv]
+
+import io
+import os
+import sys
+import tempfile
+from contextlib import redirect_stdout
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [HERE, os.path.dirname(HERE), os.path.join(os.path.dirname(HERE), "Badge_versions")]
+
+import mptime
+clock = mptime.install(mptime.VirtualClock())
+
+import importlib
+import time
+import machine
+import scd4x_sim
+import adaptive
+
+LOOP_DELAY = 1          # Seconds between main loop iterations
+WARNING = 800
+ALARM = 1000
+
+# (name, SAMPLING, SAMPLE_DELAY)
+POLICIES = (
+    ("periodic", "fixed", 5),
+    ("low power", "fixed", 40),
+    ("adaptive", "adaptive", 40),
+)
+
+# Times at which the trace first rises through each threshold
+def crossings(source, seconds):
+    found = {}
+    for t in range(0, seconds, LOOP_DELAY):
+        co2 = source(t)[0]
+        for level in (WARNING, ALARM):
+            if level not in found and co2 >= level:
+                found[level] = t
+    return found
+
+def run(source, seconds, sampling, sample_delay):
+    bus = machine.I2C(0)
+    sensor = bus.attach(scd4x_sim.SimSCD4X(source))
+    co2sao = importlib.import_module("badge_co2sao")
+    co2sao = importlib.reload(co2sao)
+    co2sao.SAMPLING = sampling
+    co2sao.SAMPLE_DELAY = sample_delay
+    co2sao.CO2_WARNING = WARNING
+    co2sao.CO2_ALARM = ALARM
+
+    start = clock.now_us()
+    shown = {}                  # First time each status was shown
+    with redirect_stdout(io.StringIO()):
+        co2sao.init(bus)
+        t = 0
+        while t < seconds:
+            co2sao.update()
+            t = (clock.now_us() - start) // 1000000
+            if co2sao._co2_status not in shown:
+                shown[co2sao._co2_status] = t
+            time.sleep(LOOP_DELAY)
+    return (sensor, co2sao._sampler, shown)
+
+def report(name, source, seconds):
+    print("%s trace, %.1f hours" % (name, seconds / 3600))
+    truth = crossings(source, seconds)
+    print("  %-10s %7s %7s %7s %7s %7s %9s %9s" % ("policy", "readings", "5s", "30s", "idle",
+                                                  "mA", "warn lag", "alarm lag"))
+    for (policy, sampling, sample_delay) in POLICIES:
+        (sensor, sampler, shown) = run(source, seconds, sampling, sample_delay)
+        spent = sensor.mode_seconds()
+        ua = (spent[scd4x_sim.PERIODIC] * adaptive.CURRENT_UA[0] +
+              spent[scd4x_sim.LOW_POWER] * adaptive.CURRENT_UA[1] +
+              spent[scd4x_sim.IDLE] * adaptive.CURRENT_UA[2]) / sum(spent)
+        lags = []
+        for (level, status) in ((WARNING, 3), (ALARM, 2)):
+            if level not in truth:
+                lags.append("-")
+            else:
+                seen = [t for (s, t) in shown.items() if s == status or (status == 3 and s == 2)]
+                lags.append("%ds" % (min(seen) - truth[level]) if seen else "missed")
+        print("  %-10s %7d %6.0f%% %6.0f%% %6.0f%% %7.2f %9s %9s" % (
+            policy, sensor.reads, 100 * spent[1] / seconds, 100 * spent[2] / seconds,
+            100 * spent[0] / seconds, ua / 1000, lags[0], lags[1]))
+        if sampler is not None:
+            print("  adaptive sampler's own estimate: %.2f mA, %d mode changes" %
+                  (sampler.average_ua() / 1000, sampler.switches))
+
+def main():
+    # Keep the add-on from picking up (or caching) a real co2sao.json
+    os.chdir(tempfile.mkdtemp())
+    if len(sys.argv) > 1:
+        source = scd4x_sim.trace(sys.argv[1])
+        report(os.path.basename(sys.argv[1]), source, int(_trace_length(sys.argv[1])))
+    else:
+        report("Meeting room", scd4x_sim.meeting, 4 * 3600)
+        report("Quiet office", scd4x_sim.office, 4 * 3600)
+    return 0
+
+def _trace_length(path):
+    last = 0
+    with open(path) as f:
+        for line in f:
+            try:
+                last = max(last, float(line.split(",")[0]))
+            except ValueError:
+                pass
+    return last + 60
+
+if __name__ == "__main__":
+    sys.exit(main())
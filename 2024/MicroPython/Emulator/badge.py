@@ -0,0 +1,291 @@
+# Headless Supercon 2024 badge
+#
+# Our badge main loops (Badge_versions/fauxbadge.py and badge_main.py) lean
+# on globals that the badge's own boot.py sets up -- the two I2C buses, the
+# petal and touchwheel SAOs, the three buttons, the Pico's LED and
+# which_bus_has_device_id() -- so on their own they only run on a badge.
+# Badge provides all of those on top of the emulated machine module, with
+# simulated petal and touchwheel controllers (sao_sim.py) and any other
+# simulated SAOs (like scd4x_sim.SimSCD4X) plugged into either bus, then
+# runs a main loop file unchanged under the virtual clock.  Buttons and the
+# touchwheel can be scheduled to be pressed and touched at given times.
+#
+# While it runs we keep track of:
+#   - how long each pass through the main loop takes, in virtual time (the
+#     loop period), in I2C bus time, and in host CPU time.  Both main loops
+#     call loopstats' monitor.tick() at the top of every pass, so that marks
+#     the passes.
+#   - how busy each bus is and which devices are using it
+#   - how long after each button press or touch the petal LEDs respond
+# along with the main loop's own timing report (see loopstats.py).
+#
+#     python3 badge.py [main loop file] [minutes]
+#
+# With no file given both Badge_versions main loops are run.  On the badge
+# the add-on lives in co2sao.py, so badge_co2sao is imported under that name.
+
+import io
+import math
+import os
+import runpy
+import sys
+import tempfile
+from contextlib import redirect_stdout
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BADGE_VERSIONS = os.path.join(os.path.dirname(HERE), "Badge_versions")
+sys.path[:0] = [HERE, os.path.dirname(HERE), BADGE_VERSIONS]
+
+import mptime
+clock = mptime.install(mptime.VirtualClock())
+
+import importlib
+import time
+import machine
+import network
+import energy
+import loopstats
+import scd4x_sim
+from sao_sim import SimPetal, SimTouchwheel, PETAL_ADDRESS, TOUCHWHEEL_ADDRESS
+
+# Button GPIOs, as wired on the badge.  They're pulled up, so pressed reads 0.
+BUTTONS = {"A": 8, "B": 9, "C": 28}
+
+class Finished(BaseException):
+    # Raised from inside the main loop's sleep when the run is over
+    pass
+
+class Badge:
+    def __init__(self):
+        self.buses = (machine.I2C(0), machine.I2C(1))
+        self.petal = None
+        self.touchwheel = None
+        self.inputs = []            # (us, description) of each press or touch
+        self.passes = []            # (virtual us, bus busy us, host s) at each pass
+        self.boots = 0
+
+    # Plug a simulated SAO into one of the buses
+    def plug(self, device, bus=0):
+        return self.buses[bus].attach(device)
+
+    def plug_petal(self, bus=0):
+        self.petal = self.plug(SimPetal(), bus)
+
+    def plug_touchwheel(self, bus=1):
+        self.touchwheel = self.plug(SimTouchwheel(), bus)
+
+    # Hold a button down for hold_ms, starting at seconds into the run.  The
+    # contacts bounce a few times, 1 ms apart, as they close and open.
+    def press(self, button, seconds, hold_ms=300, bounces=0):
+        pin = BUTTONS[button]
+        start = clock.now_us() + int(seconds * 1000000)
+
+        def level(value):
+            return lambda: machine.set_input(pin, value)
+
+        def down():
+            machine.set_input(pin, 0)
+            self.inputs.append((clock.now_us(), "button " + button))
+        clock.at(start, down)
+        for (at, value) in ((start, 0), (start + hold_ms * 1000, 1)):
+            for n in range(2 * bounces):
+                clock.at(at + 1000 * (n + 1), level(value if n % 2 else 1 - value))
+        clock.at(start + hold_ms * 1000, level(1))
+
+    # Touch the touchwheel at position (1-255) for hold_ms
+    def touch(self, position, seconds, hold_ms=300):
+        start = clock.now_us() + int(seconds * 1000000)
+
+        def down():
+            self.touchwheel.position = position
+            self.inputs.append((clock.now_us(), "touch"))
+
+        def up():
+            self.touchwheel.position = 0
+        clock.at(start, down)
+        clock.at(start + hold_ms * 1000, up)
+
+    # What the badge's boot.py leaves behind for the main program
+    def boot_globals(self):
+        i2c0 = machine.I2C(0, sda=machine.Pin(0), scl=machine.Pin(1), freq=400000)
+        i2c1 = machine.I2C(1, sda=machine.Pin(26), scl=machine.Pin(27), freq=400000)
+
+        def which_bus_has_device_id(i2c_addr, debug=False):
+            return [bus for bus in (i2c0, i2c1) if i2c_addr in bus.scan()]
+
+        def touchwheel_read(bus):
+            return bus.readfrom_mem(TOUCHWHEEL_ADDRESS, 0, 1)[0]
+
+        def touchwheel_rgb(bus, r, g, b):
+            bus.writeto_mem(TOUCHWHEEL_ADDRESS, 15, bytes([r]))
+            bus.writeto_mem(TOUCHWHEEL_ADDRESS, 16, bytes([g]))
+            bus.writeto_mem(TOUCHWHEEL_ADDRESS, 17, bytes([b]))
+
+        bootLED = machine.Pin("LED", machine.Pin.OUT)
+        bootLED.on()
+        names = dict(i2c0=i2c0, i2c1=i2c1, bootLED=bootLED,
+                     PETAL_ADDRESS=PETAL_ADDRESS, TOUCHWHEEL_ADDRESS=TOUCHWHEEL_ADDRESS,
+                     which_bus_has_device_id=which_bus_has_device_id,
+                     touchwheel_read=touchwheel_read, touchwheel_rgb=touchwheel_rgb,
+                     petal_bus=None, touchwheel_bus=None)
+        for (button, pin) in BUTTONS.items():
+            names["button" + button] = machine.Pin(pin, machine.Pin.IN, machine.Pin.PULL_UP)
+
+        # Set up the petal the way boot.py does
+        found = which_bus_has_device_id(PETAL_ADDRESS)
+        if found:
+            petal_bus = names["petal_bus"] = found[0]
+            for (reg, value) in ((0x09, 0x00), (0x0A, 0x09), (0x0B, 0x07), (0x0C, 0x81),
+                                 (0x0D, 0x00), (0x0E, 0x00), (0x0F, 0x00)):
+                petal_bus.writeto_mem(PETAL_ADDRESS, reg, bytes([value]))
+        found = which_bus_has_device_id(TOUCHWHEEL_ADDRESS)
+        if found:
+            names["touchwheel_bus"] = found[0]
+        return names
+
+    def _busy_us(self):
+        return sum(bus.busy_us for bus in self.buses)
+
+    # Load a fresh add-on for each boot, under the name the badge uses
+    def _load_addon(self):
+        co2sao = importlib.reload(importlib.import_module("badge_co2sao"))
+        sys.modules["co2sao"] = co2sao
+        return co2sao
+
+    # Mark each pass through the main loop by its call to monitor.tick()
+    def _mark_passes(self, monitor):
+        tick = monitor.tick
+
+        def marked_tick():
+            self.passes.append((clock.now_us(), self._busy_us(), time.perf_counter()))
+            tick()
+        monitor.tick = marked_tick
+
+    # Run a main loop file for the given number of seconds, booting it again
+    # whenever it deep sleeps.  Returns the console output.
+    def run(self, path, seconds):
+        for bus in self.buses:
+            machine.I2C.wire(bus)
+        machine.power_on()
+        monitor = loopstats.monitor
+        self._mark_passes(monitor)
+        self.start_us = clock.now_us()
+
+        def finish():
+            raise Finished()
+        clock.at(self.start_us + seconds * 1000000, finish)
+
+        console = io.StringIO()
+        try:
+            with redirect_stdout(console):
+                while True:
+                    self.boots += 1
+                    self._load_addon()
+                    try:
+                        runpy.run_path(path, init_globals=self.boot_globals(), run_name="__main__")
+                        break
+                    except machine.DeepSleepReset:
+                        pass
+        except Finished:
+            pass
+        finally:
+            machine.I2C.unwire()
+            del monitor.tick
+        self.end_us = clock.now_us()
+        return console.getvalue()
+
+    # For each press or touch, how long until the petal LEDs changed and
+    # how long that change lasted, or None if they didn't change before
+    # the next input
+    def responses(self):
+        history = self.petal.history if self.petal is not None else []
+        result = []
+        for (i, (t, what)) in enumerate(self.inputs):
+            limit = self.inputs[i + 1][0] if i + 1 < len(self.inputs) else self.end_us
+            change = next(((us, reg) for (us, reg, value) in history if t <= us < limit), None)
+            if change is None:
+                result.append((what, None, None))
+                continue
+            (us, reg) = change
+            after = next((later for (later, r, v) in history if later > us and r == reg), self.end_us)
+            result.append((what, us - t, after - us))
+        return result
+
+# Mean, 95th percentile (nearest rank) and max
+def _spread(values):
+    values = sorted(values)
+    if not values:
+        return "-"
+    p95 = values[min(len(values) - 1, math.ceil(0.95 * len(values)) - 1)]
+    return "mean %.1f, 95%% %.1f, max %.1f" % (sum(values) / len(values), p95, values[-1])
+
+def report(badge):
+    seconds = (badge.end_us - badge.start_us) / 1000000
+    print("%d main loop passes in %d s, %d boot%s" % (max(0, len(badge.passes) - 1), seconds,
+          badge.boots, "" if badge.boots == 1 else "s"))
+    steps = list(zip(badge.passes, badge.passes[1:]))
+    print("  loop period ms:   %s" % _spread([(b[0] - a[0]) / 1000 for (a, b) in steps]))
+    print("  bus time ms:      %s" % _spread([(b[1] - a[1]) / 1000 for (a, b) in steps]))
+    print("  host CPU us:      %s" % _spread([(b[2] - a[2]) * 1000000 for (a, b) in steps]))
+
+    for bus in badge.buses:
+        print("I2C bus %d: %d transactions, %d bytes, busy %.2f%% of the time" %
+              (bus.id, bus.transactions, bus.bytes, 100 * bus.busy_us / 1000000 / max(seconds, 1)))
+        for (addr, (n, nbytes, us)) in sorted(bus.per_device.items()):
+            name = type(bus.devices[addr]).__name__ if addr in bus.devices else "nobody"
+            print("  0x%02x %-14s %7d transactions %8d bytes %5.1f%% of bus time" %
+                  (addr, name, n, nbytes, 100 * us / max(1, bus.busy_us)))
+
+    loopstats.monitor.report()
+
+    results = badge.responses()
+    if results:
+        kinds = sorted(set(what for (what, lag, held) in results))
+        print("Input to petal LED:")
+        for what in kinds:
+            mine = [(lag, held) for (w, lag, held) in results if w == what]
+            seen = [(lag, held) for (lag, held) in mine if lag is not None]
+            if not seen:
+                print("  %-9s %d inputs, no response" % (what, len(mine)))
+                continue
+            print("  %-9s %d inputs, %d answered, latency ms %s; LEDs held ms %s" %
+                  (what, len(mine), len(seen), _spread([lag / 1000 for (lag, held) in seen]),
+                   _spread([held / 1000 for (lag, held) in seen])))
+
+def run(path, seconds):
+    network.reset()
+    energy.meter = energy.Meter()
+    loopstats.monitor = loopstats.Monitor()
+    badge = Badge()
+    badge.plug_petal(0)
+    badge.plug_touchwheel(1)
+    badge.plug(scd4x_sim.SimSCD4X(scd4x_sim.meeting), 0)
+    # Every few seconds someone presses a button or runs a finger round
+    for (i, at) in enumerate(range(5, seconds - 5, 7)):
+        if i % 4 < 3:
+            badge.press("ABC"[i % 4], at, bounces=2)
+        else:
+            badge.touch(1 + (37 * i) % 255, at)
+    badge.run(path, seconds)
+    return badge
+
+def main():
+    minutes = 10
+    paths = []
+    for arg in sys.argv[1:]:
+        if arg.isdigit():
+            minutes = int(arg)
+        else:
+            paths.append(os.path.abspath(arg))
+    if not paths:
+        paths = [os.path.join(BADGE_VERSIONS, name) for name in ("badge_main.py", "fauxbadge.py")]
+    # Keep the add-on from picking up (or caching) a real co2sao.json
+    os.chdir(tempfile.mkdtemp())
+    for path in paths:
+        print("%s, %d simulated minutes" % (os.path.basename(path), minutes))
+        report(run(path, minutes * 60))
+        print()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
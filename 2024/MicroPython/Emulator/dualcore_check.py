@@ -0,0 +1,140 @@
+# Check the dual-core split with real threads
+#
+# dualcore.py runs the sensor side of the badge on the RP2040's second core
+# with _thread, which CPython has too, so here it runs on a real second
+# thread.  Two threads can't share the virtual clock, so this runs in real
+# time.  We:
+#
+#   1. hammer a SampleRing from a producer thread while this thread drains
+#      it, and check every reading arrives exactly once and in order, or
+#      was counted as dropped.  The producer only waits for room before
+#      every other reading.
+#   2. run a 20 ms UI tick, writing the petal on the bus the CO2 add-on
+#      shares, alongside the add-on and a radio manager posting every
+#      reading -- first all inline on one core, then with the add-on and
+#      radio on core1 -- and compare how late the UI ticks ran
+#
+#     python3 dualcore_check.py [seconds]
+
+import io
+import os
+import sys
+import tempfile
+from contextlib import redirect_stdout
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [HERE, os.path.dirname(HERE), os.path.join(os.path.dirname(HERE), "Badge_versions")]
+
+import mptime
+mptime.install()
+
+import _thread
+import importlib
+import time
+import machine
+import network
+import energy
+import loopstats
+import dualcore
+import scd4x_sim
+from sao_sim import SimPetal, PETAL_ADDRESS
+from wifi import WiFi
+from netpower import RadioManager
+
+UI_TICK = 20            # ms
+SEND_MS = 300           # One dweet round trip
+RING_READINGS = 20000
+
+def ring_check():
+    ring = dualcore.SampleRing(16, 1)
+    done = []
+
+    def producer():
+        for n in range(RING_READINGS):
+            while n % 2 == 0 and len(ring) == ring.capacity:
+                pass
+            ring.put(n)
+        done.append(True)
+
+    _thread.start_new_thread(producer, ())
+    got = []
+    out = [0.0]
+    while not done or len(ring):
+        if ring.get(out):
+            got.append(int(out[0]))
+    in_order = all(a < b for (a, b) in zip(got, got[1:]))
+    accounted = len(got) + ring.dropped == RING_READINGS
+    print("Ring: %d readings, %d passed across, %d dropped, %s, %s" %
+          (RING_READINGS, len(got), ring.dropped, "in order" if in_order else "OUT OF ORDER",
+           "all accounted for" if accounted else "SOME LOST"))
+    return in_order and accounted
+
+def send(co2, tempF, rh):
+    time.sleep_ms(SEND_MS)
+
+def ui_check(seconds, dual):
+    network.reset()
+    energy.meter = energy.Meter()
+    monitor = loopstats.monitor = loopstats.Monitor(UI_TICK)
+    ui_task = monitor.task("ui", 5)
+    bus = machine.I2C(0)
+    bus.attach(scd4x_sim.SimSCD4X(scd4x_sim.meeting))
+    petal = bus.attach(SimPetal())
+    co2sao = importlib.reload(importlib.import_module("badge_co2sao"))
+    co2sao.SAMPLE_DELAY = 5
+    ring = dualcore.SampleRing(16)
+    reading = [0.0, 0.0, 0.0]
+    readings = 0
+
+    with redirect_stdout(io.StringIO()):
+        radio = RadioManager(WiFi("Supercon", "whatpassword"), send, batch=1, max_delay=0)
+        shared = dualcore.LockedI2C(bus) if dual else bus
+        co2sao.init(shared, radio)
+        if dual:
+            co2sao.setSampleRing(ring)
+            dualcore.start((radio.poll, co2sao.update), co2sao.idleMs)
+
+        end = time.ticks_add(time.ticks_ms(), seconds * 1000)
+        next_tick = time.ticks_ms()
+        while time.ticks_diff(end, time.ticks_ms()) > 0:
+            monitor.tick()
+            started = monitor.start()
+            for i in range(1, 9):
+                shared.writeto_mem(PETAL_ADDRESS, i, bytes([monitor.passes & 0xFF]))
+            monitor.done(ui_task, started)
+            if dual:
+                while ring.get(reading):
+                    readings += 1
+            else:
+                radio.poll()
+                co2sao.update()
+            next_tick = time.ticks_add(next_tick, UI_TICK)
+            wait = time.ticks_diff(next_tick, time.ticks_ms())
+            if wait > 0:
+                time.sleep_ms(wait)
+            else:
+                next_tick = time.ticks_ms()
+        if dual:
+            dualcore.stop()
+    if not dual:
+        readings = co2sao._co2data.getCount()
+    return (monitor, radio, readings)
+
+def main():
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 12
+    # Keep the add-on from picking up (or caching) a real co2sao.json
+    os.chdir(tempfile.mkdtemp())
+    ok = ring_check()
+    print("UI on a %d ms tick for %d s, add-on in periodic mode posting every reading" % (UI_TICK, seconds))
+    print("%-10s %6s %9s %9s %10s %8s %9s" % ("mode", "ticks", "mean ms", "missed", "worst late",
+                                            "readings", "uploaded"))
+    worst = []
+    for (name, dual) in (("one core", False), ("two cores", True)):
+        (monitor, radio, readings) = ui_check(seconds, dual)
+        worst.append(monitor.worst_late)
+        print("%-10s %6d %9.1f %9d %8d ms %8d %9d" % (name, monitor.passes, monitor.mean_period(),
+              monitor.misses, monitor.worst_late // 1000, readings, radio.uploaded))
+    return 0 if ok and worst[1] < worst[0] else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+# Compare add-on configurations by estimated energy use
+#
+# Runs the CO2 add-on, the radio manager and a fauxbadge-style main loop
+# against the simulated SCD4X and WLAN under a virtual clock, and prints the
+# energy meter's figures (energy.py) for each configuration: average current
+# (= mAh per hour), mAh per CO2 sample, and the split between components.
+#
+# The CPU only counts as busy while the simulated hardware is actually
+# taking time (I2C transfers, the sensor driver's command delays, uploads),
+# so its figures are a lower bound.
+#
+#     python3 energy_sim.py [hours]
+
+import io
+import os
+import sys
+import tempfile
+from contextlib import redirect_stdout
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [HERE, os.path.dirname(HERE), os.path.join(os.path.dirname(HERE), "Badge_versions")]
+
+import mptime
+clock = mptime.install(mptime.VirtualClock())
+
+import importlib
+import time
+import machine
+import network
+import scd4x_sim
+import energy
+from wifi import WiFi
+from netpower import RadioManager, RADIO_DOWN
+
+LOOP_DELAY = 1          # Seconds between main loop iterations
+SEND_MS = 120           # Simulated time for one dweet round trip
+
+# (name, co2sao settings, RadioManager settings)
+CONFIGS = (
+    ("periodic, post each", dict(SAMPLING="fixed", SAMPLE_DELAY=5),
+     dict(batch=1, max_delay=0, keep_associated=True)),
+    ("low power, post each", dict(SAMPLING="fixed", SAMPLE_DELAY=40),
+     dict(batch=1, max_delay=0, keep_associated=True)),
+    ("low power, batch 10", dict(SAMPLING="fixed", SAMPLE_DELAY=40),
+     dict(batch=10, max_delay=600)),
+    ("adaptive, batch 10", dict(SAMPLING="adaptive", SAMPLE_DELAY=40),
+     dict(batch=10, max_delay=600)),
+    ("adaptive, batch 10, LEDs 30%", dict(SAMPLING="adaptive", SAMPLE_DELAY=40, BRIGHTNESS=30),
+     dict(batch=10, max_delay=600)),
+)
+
+def send(co2, tempF, rh):
+    time.sleep_ms(SEND_MS)
+
+def run(seconds, settings, radio_settings):
+    network.reset()
+    bus = machine.I2C(0)
+    bus.attach(scd4x_sim.SimSCD4X(scd4x_sim.meeting))
+    co2sao = importlib.reload(importlib.import_module("badge_co2sao"))
+    for (name, value) in settings.items():
+        setattr(co2sao, name, value)
+    energy.meter = energy.Meter()
+
+    with redirect_stdout(io.StringIO()):
+        wifi = WiFi("Supercon", "whatpassword")
+        radio = RadioManager(wifi, send, **radio_settings)
+        if radio_settings.get("keep_associated"):
+            wifi.start()
+        co2sao.init(bus, radio)
+        end = time.ticks_add(time.ticks_ms(), seconds * 1000)
+        while time.ticks_diff(end, time.ticks_ms()) > 0:
+            if radio_settings.get("keep_associated"):
+                wifi.poll()
+            radio.poll()
+            co2sao.update()
+            if radio.state == RADIO_DOWN:
+                wifi.learn(min(co2sao.idleMs(), radio.idle_ms()))
+            energy.meter.state(energy.CPU, energy.CPU_IDLE)
+            time.sleep(LOOP_DELAY)
+            energy.meter.state(energy.CPU, energy.CPU_ACTIVE)
+    return energy.meter
+
+def main():
+    hours = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    # Keep the add-on from picking up (or caching) a real co2sao.json
+    os.chdir(tempfile.mkdtemp())
+    print("Meeting room trace, %d hours" % hours)
+    print("%-30s %7s %7s %10s %7s %7s %7s %7s" % ("configuration", "samples", "mA", "mAh/sample",
+                                                 "cpu", "sensor", "led", "radio"))
+    for (name, settings, radio_settings) in CONFIGS:
+        meter = run(hours * 3600, settings, radio_settings)
+        print("%-30s %7d %7.2f %10.4f %7.2f %7.2f %7.2f %7.2f" % (
+            name, meter.samples, meter.average_ma(), meter.mah_per_sample(),
+            meter.average_ma(energy.CPU), meter.average_ma(energy.SENSOR),
+            meter.average_ma(energy.LED), meter.average_ma(energy.RADIO)))
+    print()
+    meter.report()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+# Keep the badge running through I2C faults
+#
+# Runs the badge main loops unchanged on the headless badge (badge.py) with
+# the simulated SCD4X injecting faults along the way (see scd4x_sim.py):
+#
+#   - a couple of NACKs, and a few replies with a bad CRC, which retries
+#     should get past without the add-on noticing
+#   - the sensor wedging the bus by holding SDA low, which every transfer
+#     then times out on until SCL is clocked free
+#   - a brownout, after which the sensor sits idle with its settings lost
+#     until it's set up again
+#   - a burst of NACKs too long for retries to ride out, so updates fail
+#     outright until the add-on reinitializes the sensor
+#   - and then a faulty stretch with a random fault every few seconds
+#
+# and reports, for each fault, how long until the add-on next got a
+# reading, along with the recovery counts (see recovery.py).  It fails if
+# the main loop stops, or the readings don't keep coming to the end.
+#
+#     python3 fault_sim.py [Badge_versions/fauxbadge.py] [minutes]
+
+import os
+import random
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+from badge import Badge, BADGE_VERSIONS, clock
+import energy
+import loopstats
+import network
+import scd4x_sim
+from scd4x_sim import NACK, BAD_CRC, WEDGE, BROWNOUT
+
+# (seconds in, kind, count), then random faults from FAULTY_FROM to FAULTY_TO
+SCHEDULE = ((120, NACK, 2), (240, BAD_CRC, 3), (360, WEDGE, 1), (480, BROWNOUT, 1), (600, NACK, 40))
+FAULTY_FROM = 720
+FAULTY_TO = 960
+FAULTY_EVERY = 7
+
+# Seconds without a main loop pass or a reading at the end that count as
+# having stopped
+LATE = 65
+
+class WatchedSCD4X(scd4x_sim.SimSCD4X):
+    # Notes when each measurement is read out
+    def __init__(self, source):
+        super().__init__(source)
+        self.read_us = []
+
+    def write(self, data):
+        reads = self.reads
+        super().write(data)
+        if self.reads > reads:
+            self.read_us.append(clock.now_us())
+
+def schedule(sensor, start_us, seconds):
+    faults = [(at, kind, count) for (at, kind, count) in SCHEDULE if at < seconds - 60]
+    rng = random.Random(2024)
+    for at in range(FAULTY_FROM, min(FAULTY_TO, seconds - 60), FAULTY_EVERY):
+        faults.append((at, rng.choice((NACK, NACK, BAD_CRC, WEDGE)), rng.randint(1, 3)))
+    for (at, kind, count) in faults:
+        clock.at(start_us + at * 1000000, lambda kind=kind, count=count: sensor.inject(kind, count))
+    return faults
+
+def run(path, seconds):
+    network.reset()
+    energy.meter = energy.Meter()
+    loopstats.monitor = loopstats.Monitor()
+    b = Badge()
+    b.plug_petal(0)
+    b.plug_touchwheel(1)
+    sensor = b.plug(WatchedSCD4X(scd4x_sim.meeting), 0)
+    faults = schedule(sensor, clock.now_us(), seconds)
+    console = b.run(path, seconds)
+    return (b, sensor, faults, console)
+
+def report(b, sensor, faults, console):
+    start = b.start_us
+    seconds = (b.end_us - start) / 1000000
+    reads = [(us - start) / 1000000 for us in sensor.read_us]
+    print("%d readings in %d s, %d main loop passes" % (len(reads), seconds, len(b.passes)))
+    print("Faults injected: %s" % ", ".join("%d %s" % (n, kind) for (kind, n) in sorted(sensor.injected.items())))
+    print("  %6s  %-9s %5s  %s" % ("at s", "fault", "count", "next reading s later"))
+    for (at, kind, count) in faults:
+        if at >= FAULTY_FROM:
+            continue
+        after = next((t for t in reads if t > at), None)
+        print("  %6d  %-9s %5d  %s" % (at, kind, count, "none" if after is None else "%.1f" % (after - at)))
+    random_faults = [at for (at, kind, count) in faults if at >= FAULTY_FROM]
+    if random_faults:
+        during = [t for t in reads if random_faults[0] <= t <= random_faults[-1]]
+        print("  %d random faults from %d to %d s, %d readings meanwhile" %
+              (len(random_faults), random_faults[0], random_faults[-1], len(during)))
+    sys.modules["co2sao"]._recovery.report()
+    print("Sensor reinitialized %d time(s), %d transfers timed out on a stuck bus" %
+          (console.count("Reinitializing CO2 sensor"), b.buses[0].timeouts))
+    looping = bool(b.passes) and (b.end_us - b.passes[-1][0]) / 1000000 < LATE
+    reading = bool(reads) and seconds - reads[-1] < LATE
+    print("Main loop ran to the end: %s, readings kept coming: %s" %
+          ("yes" if looping else "NO", "yes" if reading else "NO"))
+    return looping and reading
+
+def main():
+    minutes = 20
+    paths = []
+    for arg in sys.argv[1:]:
+        if arg.isdigit():
+            minutes = int(arg)
+        else:
+            paths.append(os.path.abspath(arg))
+    if not paths:
+        paths = [os.path.join(BADGE_VERSIONS, name) for name in ("badge_main.py", "fauxbadge.py")]
+    # Keep the add-on from picking up (or caching) a real co2sao.json
+    os.chdir(tempfile.mkdtemp())
+    ok = True
+    for path in paths:
+        print("%s, %d simulated minutes" % (os.path.basename(path), minutes))
+        ok = report(*run(path, minutes * 60)) and ok
+        print()
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+# Compressed reading history: how much fits, and does it come back intact
+#
+# Feeds a day (or however many hours) of 5 second readings into a History
+# (see history.py) of each size below, the way the add-on does -- CO2 in
+# ppm, temperature in F and humidity in %, as scd4x.py turns the sensor's
+# raw words into them, with time.time() seconds that now and again slip a
+# second against the sensor's 5 second cadence.  Temperature and humidity
+# drift and have noise on them like the real sensor's.  For each room we
+# report bytes per reading, how many hours each size holds, how long each
+# append took on this machine, and check that iterating forward and
+# backward gives back exactly the readings that went in (to the stored
+# resolution).
+#
+#     python3 history_sim.py [hours]
+
+import math
+import os
+import random
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [HERE, os.path.dirname(HERE)]
+
+import mptime
+mptime.install(mptime.VirtualClock())
+
+import scd4x_sim
+import tracelog
+from history import History, TEMP_SCALE, RH_SCALE
+
+INTERVAL = 5
+SIZES = (8192, 16384, 32768)
+START = 1730419200
+
+def room(co2_source, seed):
+    rng = random.Random(seed)
+
+    def source(seconds):
+        (co2, tempC, rh) = co2_source(seconds)
+        tempC += 1.5 * math.sin(seconds / 20000) + rng.gauss(0, 0.03)
+        rh += 5 * math.sin(seconds / 30000) + rng.gauss(0, 0.1)
+        return (co2, tempC, rh)
+    return source
+
+# Readings as the add-on sees them: (seconds, co2, tempF, rh)
+def readings(source, hours):
+    sensor = scd4x_sim.SimSCD4X(source)
+    sensor.temperature_offset = 0
+    rng = random.Random(1)
+    result = []
+    for n in range(int(hours * 3600 / INTERVAL)):
+        seconds = n * INTERVAL
+        (co2, tempC, rh) = tracelog.convert((0,) + sensor._measure(seconds))
+        late = 1 if rng.random() < 0.01 else 0
+        result.append((START + seconds + late, co2, tempC * 1.8 + 32.0, rh))
+    return result
+
+def stored(reading):
+    (t, co2, temp, rh) = reading
+    return (t, round(co2), round(temp * TEMP_SCALE) / TEMP_SCALE, round(rh * RH_SCALE) / RH_SCALE)
+
+def main():
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else 24
+    ok = True
+    print("%.0f hours of %d second readings, %d readings" % (hours, INTERVAL, hours * 3600 / INTERVAL))
+    print("Packed as float32 (time plus three values) they'd take %d bytes" %
+          (16 * hours * 3600 / INTERVAL))
+    print("%-10s %7s %9s %8s %11s %10s %s" % ("room", "bytes", "readings", "B/read", "hours held",
+                                            "append us", "round trip"))
+    for (name, source) in (("meeting", scd4x_sim.meeting), ("office", scd4x_sim.office)):
+        data = readings(room(source, 7), hours)
+        for size in SIZES:
+            history = History(size)
+            began = time.perf_counter()
+            for (t, co2, temp, rh) in data:
+                history.append(t, co2, temp, rh)
+            took = time.perf_counter() - began
+            kept = [stored(r) for r in data[len(data) - len(history):]]
+            forward = list(history)
+            backward = list(reversed(history))
+            good = forward == kept and backward == kept[::-1]
+            ok = ok and good
+            print("%-10s %7d %9d %8.2f %11.1f %10.1f %s" %
+                  (name, size, len(history), history.bytes_used() / max(1, len(history)),
+                   history.span() / 3600, 1000000 * took / len(data),
+                   "exact" if good else "MISMATCH"))
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+# Compare main-loop idle strategies with the simulated badge
+#
+# Runs the same main loop as Badge_versions/fauxbadge.py -- radio manager,
+# CO2 add-on, then idle.Idle until something's due -- against the simulated
+# SCD4X and WLAN under a virtual clock, once with each idle mode.  A deep
+# sleep resets the simulated badge, so the loop is booted again from
+# scratch with only what idle.py saved, which checks that nothing (Measure
+# totals, queued uploads, the LED status) gets lost on the way.  Then we
+# check that state left behind by a badge switched off mid-sleep is thrown
+# away at the next power-on rather than picked up.
+#
+#     python3 idle_sim.py [hours]
+
+import io
+import os
+import sys
+import tempfile
+from contextlib import redirect_stdout
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [HERE, os.path.dirname(HERE), os.path.join(os.path.dirname(HERE), "Badge_versions")]
+
+import mptime
+clock = mptime.install(mptime.VirtualClock())
+
+import importlib
+import time
+import machine
+import network
+import scd4x_sim
+import energy
+from wifi import WiFi
+from netpower import RadioManager, RADIO_DOWN
+from idle import Idle
+
+SEND_MS = 120           # Simulated time for one dweet round trip
+
+sent = []
+def send(co2, tempF, rh):
+    time.sleep_ms(SEND_MS)
+    sent.append(co2)
+
+# One boot of the badge, up to the next deep sleep (or the end of the run)
+def boot(bus, mode, end):
+    co2sao = importlib.reload(importlib.import_module("badge_co2sao"))
+    co2sao.SAMPLING = "adaptive"
+    idle = Idle(mode)
+    state = idle.resume()
+    wifi = WiFi("Supercon", "whatpassword")
+    radio = RadioManager(wifi, send, batch=10, max_delay=600)
+    if state is not None and "radio" in state:
+        radio.restore(state["radio"], idle.last_slept)
+    co2sao.init(bus, radio, state.get("co2sao") if state is not None else None, idle.last_slept)
+    idle.register("co2sao", co2sao.saveState)
+    idle.register("radio", radio.save)
+    result = (co2sao, radio, idle)
+    try:
+        while time.ticks_diff(end, time.ticks_ms()) > 0:
+            radio.poll()
+            co2sao.update()
+            down = radio.state == RADIO_DOWN
+            if down:
+                wifi.learn(min(co2sao.idleMs(), radio.idle_ms(), 60000))
+            idle.sleep(min(co2sao.idleMs(), radio.idle_ms(), 60000),
+                       light=down and co2sao.canLightSleep(),
+                       deep=down and co2sao.canDeepSleep())
+    except machine.DeepSleepReset:
+        return (False,) + result
+    return (True,) + result
+
+def run(mode, seconds):
+    network.reset()
+    machine.power_on()
+    del sent[:]
+    bus = machine.I2C(0)
+    sensor = bus.attach(scd4x_sim.SimSCD4X(scd4x_sim.office))
+    energy.meter = energy.Meter()
+    end = time.ticks_add(time.ticks_ms(), seconds * 1000)
+    boots = 0
+    with redirect_stdout(io.StringIO()):
+        done = False
+        while not done:
+            boots += 1
+            (done, co2sao, radio, idle) = boot(bus, mode, end)
+    return (sensor, co2sao, radio, idle, boots)
+
+# Deep sleep with state saved, then power on instead of waking: resume()
+# should hand nothing back and remove the file
+def power_on_resume():
+    idle = Idle("deep")
+    idle.register("co2sao", lambda: b"saved")
+    try:
+        idle.sleep(1000, deep=True)
+    except machine.DeepSleepReset:
+        pass
+    machine.power_on()
+    idle = Idle("deep")
+    return idle.resume() is None and not os.path.exists(idle.statefile)
+
+def main():
+    hours = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    # Keep the add-on from picking up (or caching) a real co2sao.json
+    os.chdir(tempfile.mkdtemp())
+    print("Quiet office trace, adaptive sampling, %d hours" % hours)
+    print("%-6s %6s %6s %9s %9s %8s %7s %7s %6s %s" % ("idle", "boots", "reads", "measured",
+          "uploaded", "periods", "got", "early", "mA", "cpu split"))
+    failed = False
+    for mode in ("sleep", "light", "deep"):
+        (sensor, co2sao, radio, idle, boots) = run(mode, hours * 3600)
+        counted = co2sao._co2data.getCount()
+        accounted = len(sent) + radio.pending
+        if counted != sensor.reads or accounted != sensor.reads:
+            failed = True
+        split = ", ".join("%s %.0f%%" % (name, 100 * s / (hours * 3600))
+                          for (name, s) in zip(energy.STATE_NAMES[energy.CPU],
+                                               energy.meter.seconds(energy.CPU)) if s >= 1)
+        print("%-6s %6d %6d %9d %9d %8d %6.1f%% %7d %6.2f %s" % (
+            mode, boots, sensor.reads, counted, accounted, sum(idle.periods),
+            100 * idle.efficiency(), idle.early, energy.meter.average_ma(), split))
+    print("State carried across deep sleeps: %s" % ("no" if failed else "yes"))
+    stale = power_on_resume()
+    print("Stale state ignored at power-on: %s" % ("yes" if stale else "no"))
+    return 1 if failed or not stale else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
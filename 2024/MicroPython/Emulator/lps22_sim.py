@@ -0,0 +1,67 @@
+# Simulated ST LPS22HB barometer
+#
+# A register-level model for the emulated machine.I2C bus, enough for
+# pressure.LPS22: WHO_AM_I, a one-shot conversion started through CTRL_REG2
+# and the 24-bit pressure output registers.  The pressure comes from a
+# source function that takes seconds since the simulation started and
+# returns hPa, like the CO2 sources in scd4x_sim.py.
+
+import math
+import mptime
+
+ADDRESS = 0x5C
+
+WHO_AM_I = 0x0F
+CTRL_REG2 = 0x11
+PRESS_OUT_XL = 0x28
+
+# Steady pressure, for when nothing more interesting is needed
+def constant(hpa=1013.25):
+    return lambda seconds: hpa
+
+# A weather front: pressure falls 25 hPa over a day and a half, then
+# recovers, with a little twice-daily atmospheric tide on top
+def front(base=985.0):
+    def source(seconds):
+        hours = seconds / 3600
+        drop = 25 * (1 - math.cos(math.pi * min(hours, 72) / 36)) / 2
+        return base - drop + 0.8 * math.sin(2 * math.pi * hours / 12)
+    return source
+
+class SimLPS22:
+    def __init__(self, source=None, address=ADDRESS):
+        self.address = address
+        self.source = source if source is not None else constant()
+        self.conversions = 0
+        self._origin = mptime.clock().now_us()
+        self._regs = bytearray(0x80)
+        self._regs[WHO_AM_I] = 0xB1
+        self._regs[CTRL_REG2] = 0x10
+
+    def _convert(self):
+        seconds = (mptime.clock().now_us() - self._origin) / 1000000
+        raw = int(self.source(seconds) * 4096) & 0xFFFFFF
+        self._regs[PRESS_OUT_XL] = raw & 0xFF
+        self._regs[PRESS_OUT_XL + 1] = (raw >> 8) & 0xFF
+        self._regs[PRESS_OUT_XL + 2] = (raw >> 16) & 0xFF
+        self.conversions += 1
+
+    def write_mem(self, reg, data):
+        for (i, value) in enumerate(data):
+            self._regs[reg + i] = value
+        if reg <= CTRL_REG2 < reg + len(data) and self._regs[CTRL_REG2] & 1:
+            self._convert()
+            self._regs[CTRL_REG2] &= ~1
+
+    def read_mem(self, reg, n):
+        return bytes(self._regs[reg:reg + n])
+
+    # Plain writes set the register pointer, plain reads read from it
+    def write(self, data):
+        if len(data) > 1:
+            self.write_mem(data[0], data[1:])
+        elif data:
+            self._pointer = data[0]
+
+    def read(self, n):
+        return self.read_mem(getattr(self, "_pointer", 0), n)
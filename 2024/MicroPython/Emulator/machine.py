@@ -0,0 +1,397 @@
+# Simulated MicroPython machine module (RP2040 flavour)
+#
+# Pins, PWM and the mem32 register window share one model of the RP2040's
+# GPIO outputs, so code that mixes Pin.value() with direct SIO or PWM
+# register writes sees consistent results.  Every time the pattern on the
+# output pins changes it's appended to gpio.history, which lets a harness
+# check exactly what external logic (like the stoplight's NAND decoder) would
+# have seen, including any short-lived intermediate states.
+#
+# While a pin is under PWM control its level depends on the slice counter,
+# so a history entry is the tuple of every output pattern that appears
+# during one PWM period.  For plain outputs that's just one pattern.
+
+import time
+
+# RP2040 register addresses we model
+SIO_BASE = 0xd0000000
+SIO_GPIO_IN = SIO_BASE + 0x004
+SIO_GPIO_OUT = SIO_BASE + 0x010
+SIO_GPIO_OUT_SET = SIO_BASE + 0x014
+SIO_GPIO_OUT_CLR = SIO_BASE + 0x018
+SIO_GPIO_OUT_XOR = SIO_BASE + 0x01c
+PWM_BASE = 0x40050000
+PWM_SLICE_SIZE = 0x14
+PWM_CC = 0x0c
+PWM_TOP = 0x10
+
+CPU_FREQ = 125000000
+
+class _GPIO:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.out = 0            # SIO output register
+        self.pwm_pins = {}      # pin -> PWM driving it
+        self.slices = [[0, 0xFFFF] for _ in range(8)]   # [cc, top] per slice
+        self.history = []
+        self.writes = 0         # Register and Pin writes that touched outputs
+
+    # Every output pattern visible during one PWM period
+    def visible(self):
+        if not self.pwm_pins:
+            return (self.out,)
+        edges = set([0])
+        top = 0
+        for pin in self.pwm_pins:
+            edges.add(self._level(pin))
+            top = max(top, self.slices[(pin >> 1) & 7][1])
+        patterns = []
+        for start in sorted(edges):
+            if start > top:
+                break
+            word = self.out
+            for pin in self.pwm_pins:
+                if start < self._level(pin):
+                    word |= 1 << pin
+                else:
+                    word &= ~(1 << pin)
+            if word not in patterns:
+                patterns.append(word)
+        return tuple(patterns)
+
+    def _level(self, pin):
+        cc = self.slices[(pin >> 1) & 7][0]
+        return (cc >> 16) & 0xFFFF if pin & 1 else cc & 0xFFFF
+
+    def changed(self):
+        self.writes += 1
+        state = self.visible()
+        if not self.history or self.history[-1] != state:
+            self.history.append(state)
+
+gpio = _GPIO()
+
+class _Mem32:
+    def __init__(self):
+        self.words = {}
+
+    def __getitem__(self, addr):
+        if addr in (SIO_GPIO_OUT, SIO_GPIO_IN):
+            return gpio.out
+        if PWM_BASE <= addr < PWM_BASE + 8 * PWM_SLICE_SIZE:
+            s, reg = divmod(addr - PWM_BASE, PWM_SLICE_SIZE)
+            if reg == PWM_CC:
+                return gpio.slices[s][0]
+            if reg == PWM_TOP:
+                return gpio.slices[s][1]
+        return self.words.get(addr, 0)
+
+    def __setitem__(self, addr, value):
+        value &= 0xFFFFFFFF
+        if addr == SIO_GPIO_OUT:
+            gpio.out = value
+        elif addr == SIO_GPIO_OUT_SET:
+            gpio.out |= value
+        elif addr == SIO_GPIO_OUT_CLR:
+            gpio.out &= ~value
+        elif addr == SIO_GPIO_OUT_XOR:
+            gpio.out ^= value
+        elif PWM_BASE <= addr < PWM_BASE + 8 * PWM_SLICE_SIZE:
+            s, reg = divmod(addr - PWM_BASE, PWM_SLICE_SIZE)
+            if reg == PWM_CC:
+                gpio.slices[s][0] = value
+            elif reg == PWM_TOP:
+                gpio.slices[s][1] = value & 0xFFFF
+        else:
+            self.words[addr] = value
+            return
+        gpio.changed()
+
+mem32 = _Mem32()
+
+class Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    _names = {"LED": 64}
+    inputs = {}          # Simulated input levels, by pin id
+    watchers = {}        # pin id -> fn(level), called whenever the pin is written
+    _irqs = {}           # pin id -> (handler, trigger, pin)
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = self._names.get(id, id)
+        self.mode = mode
+        self.init(mode, pull, value)
+
+    def init(self, mode=-1, pull=-1, value=None):
+        if mode != -1:
+            self.mode = mode
+        if self.mode == Pin.OUT:
+            gpio.pwm_pins.pop(self.id, None)
+        if value is not None:
+            self.value(value)
+
+    def value(self, v=None):
+        if v is None:
+            if self.mode == Pin.OUT:
+                return (gpio.out >> self.id) & 1
+            return Pin.inputs.get(self.id, 1)
+        if v:
+            gpio.out |= 1 << self.id
+        else:
+            gpio.out &= ~(1 << self.id)
+        gpio.changed()
+        watcher = Pin.watchers.get(self.id)
+        if watcher is not None:
+            watcher(1 if v else 0)
+
+    def __call__(self, v=None):
+        return self.value(v)
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING, hard=False):
+        if handler is None:
+            Pin._irqs.pop(self.id, None)
+        else:
+            Pin._irqs[self.id] = (handler, trigger, self)
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    def toggle(self):
+        self.value(1 - ((gpio.out >> self.id) & 1))
+
+# Drive an input pin to level from outside, as a button would, calling its
+# interrupt handler if the edge is one it asked for
+def set_input(id, level):
+    id = Pin._names.get(id, id)
+    was = Pin.inputs.get(id, 1)
+    Pin.inputs[id] = level
+    if level == was or id not in Pin._irqs:
+        return
+    (handler, trigger, pin) = Pin._irqs[id]
+    if trigger & (Pin.IRQ_RISING if level else Pin.IRQ_FALLING):
+        handler(pin)
+
+class PWM:
+    def __init__(self, pin, freq=None, duty_u16=None):
+        self.pin = pin.id
+        self.slice = (self.pin >> 1) & 7
+        gpio.pwm_pins[self.pin] = self
+        if freq is not None:
+            self.freq(freq)
+        if duty_u16 is not None:
+            self.duty_u16(duty_u16)
+
+    def freq(self, f=None):
+        top = gpio.slices[self.slice][1]
+        if f is None:
+            return CPU_FREQ // (top + 1)
+        gpio.slices[self.slice][1] = max(1, min(0xFFFF, CPU_FREQ // f - 1))
+        gpio.changed()
+
+    def duty_u16(self, duty=None):
+        cc, top = gpio.slices[self.slice]
+        shift = 16 if self.pin & 1 else 0
+        if duty is None:
+            return ((cc >> shift) & 0xFFFF) * 65536 // (top + 1)
+        level = duty * (top + 1) // 65536
+        cc = (cc & ~(0xFFFF << shift)) | (level << shift)
+        gpio.slices[self.slice][0] = cc
+        gpio.changed()
+
+    def deinit(self):
+        gpio.pwm_pins.pop(self.pin, None)
+        gpio.changed()
+
+class I2C:
+    # Simulated I2C bus.  Devices are attached by address and see raw
+    # transfers, so drivers run unchanged.  The bus counts transactions and
+    # bytes, overall and for each address, and charges the (virtual) clock
+    # for the time each transfer would take on the wire: 9 bit times per
+    # byte plus the address byte.
+    #
+    # A harness can wire() a bus, after which I2C(id) hands back that same
+    # bus, the way it would get the same peripheral on the real chip, and
+    # passing pins or a frequency again sets the peripheral up again.
+    #
+    # wedge() has a device hold SDA low, as one cut off in the middle of a
+    # byte would.  Until SCL has been clocked enough times to get it to the
+    # end of that byte, every transfer times out, after the bus's timeout.
+    _wired = {}
+
+    def __new__(cls, id=0, *args, **kwargs):
+        bus = cls._wired.get(id)
+        return bus if bus is not None else super().__new__(cls)
+
+    def __init__(self, id=0, scl=None, sda=None, freq=400000, timeout=50000):
+        if I2C._wired.get(id) is self:
+            self.scl = scl.id if scl is not None else self.scl
+            self.sda = sda.id if sda is not None else self.sda
+            self.freq = freq
+            self.timeout = timeout
+            return
+        self.id = id
+        self.scl = scl.id if scl is not None else None
+        self.sda = sda.id if sda is not None else None
+        self.freq = freq
+        self.timeout = timeout
+        self.wedged = 0             # SCL clocks until SDA is let go
+        self.timeouts = 0
+        self.devices = {}
+        self.transactions = 0
+        self.bytes = 0
+        self.busy_us = 0
+        self.per_device = {}        # addr -> [transactions, bytes, busy us]
+
+    @classmethod
+    def wire(cls, bus):
+        cls._wired[bus.id] = bus
+
+    @classmethod
+    def unwire(cls):
+        cls._wired.clear()
+
+    # The way the rp2 port shows a bus
+    def __repr__(self):
+        return "I2C(%d, freq=%d, scl=%s, sda=%s, timeout=%d)" % (self.id, self.freq, self.scl,
+                                                                self.sda, self.timeout)
+
+    # Devices can get at the bus they're on, to wedge() it
+    def attach(self, device, addr=None):
+        self.devices[device.address if addr is None else addr] = device
+        device.bus = self
+        return device
+
+    def wedge(self, clocks=9):
+        self.wedged = clocks
+        self._scl_level = 1
+        Pin.inputs[self.sda] = 0
+        Pin.watchers[self.scl] = self._clocked
+
+    # Count rising edges on SCL
+    def _clocked(self, level):
+        rising = level and not self._scl_level
+        self._scl_level = level
+        if rising and self.wedged:
+            self.wedged -= 1
+            if self.wedged == 0:
+                Pin.inputs[self.sda] = 1
+                Pin.watchers.pop(self.scl, None)
+
+    def detach(self, addr):
+        self.devices.pop(addr, None)
+
+    def _device(self, addr):
+        if self.wedged:
+            self.timeouts += 1
+            time.sleep_us(self.timeout)
+            raise OSError(110)      # ETIMEDOUT: can't even start
+        device = self.devices.get(addr)
+        if device is None:
+            raise OSError(5)        # EIO: no ACK from anyone
+        return device
+
+    def _transfer(self, addr, nbytes):
+        self.transactions += 1
+        self.bytes += nbytes
+        us = (nbytes + 1) * 9 * 1000000 // self.freq
+        self.busy_us += us
+        counts = self.per_device.setdefault(addr, [0, 0, 0])
+        counts[0] += 1
+        counts[1] += nbytes
+        counts[2] += us
+        time.sleep_us(us)
+
+    def scan(self):
+        return sorted(self.devices)
+
+    def writeto(self, addr, buf, stop=True):
+        device = self._device(addr)
+        self._transfer(addr, len(buf))
+        device.write(bytes(buf))
+        return len(buf)
+
+    def readfrom_into(self, addr, buf, stop=True):
+        device = self._device(addr)
+        self._transfer(addr, len(buf))
+        data = device.read(len(buf))
+        buf[:len(data)] = data
+
+    def readfrom(self, addr, nbytes, stop=True):
+        buf = bytearray(nbytes)
+        self.readfrom_into(addr, buf)
+        return bytes(buf)
+
+    def writeto_mem(self, addr, memaddr, buf, addrsize=8):
+        device = self._device(addr)
+        self._transfer(addr, len(buf) + 1)
+        device.write_mem(memaddr, bytes(buf))
+
+    def readfrom_mem_into(self, addr, memaddr, buf, addrsize=8):
+        device = self._device(addr)
+        self._transfer(addr, len(buf) + 1)
+        data = device.read_mem(memaddr, len(buf))
+        buf[:len(data)] = data
+
+    def readfrom_mem(self, addr, memaddr, nbytes, addrsize=8):
+        buf = bytearray(nbytes)
+        self.readfrom_mem_into(addr, memaddr, buf)
+        return bytes(buf)
+
+# Reset causes, as on the rp2 port.  The rp2 port implements deepsleep() as
+# a lightsleep followed by a watchdog reset, so that's what it reports.
+PWRON_RESET = 1
+WDT_RESET = 3
+
+_reset_cause = PWRON_RESET
+
+# Set to a number of milliseconds to have the next lightsleep() cut short
+# that far in, as if an interrupt had woken the CPU
+wake_after = None
+
+# Total time handed to lightsleep() and deepsleep()
+slept_ms = [0, 0]
+
+class DeepSleepReset(BaseException):
+    # Raised by the simulated deepsleep(): on the badge the CPU resets when
+    # it wakes and everything in RAM is gone, so a harness catches this and
+    # boots the code again from the top
+    pass
+
+def reset_cause():
+    return _reset_cause
+
+# As if the badge had just been switched on
+def power_on():
+    global _reset_cause
+    _reset_cause = PWRON_RESET
+
+def lightsleep(ms=None):
+    global wake_after
+    if ms is None:
+        ms = 0
+    if wake_after is not None and wake_after < ms:
+        ms = max(0, wake_after)
+    wake_after = None
+    time.sleep_ms(ms)
+    slept_ms[0] += ms
+
+def deepsleep(ms=None):
+    global _reset_cause
+    if ms:
+        time.sleep_ms(ms)
+        slept_ms[1] += ms
+    gpio.reset()
+    Pin._irqs.clear()
+    _reset_cause = WDT_RESET
+    raise DeepSleepReset()
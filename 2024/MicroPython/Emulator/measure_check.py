@@ -0,0 +1,113 @@
+# Check Measure's batch, merge and pack against a single pass
+#
+# For a few kinds of series -- noisy CO2 readings, temperatures, a constant,
+# values around a huge offset (where a naive sum of squares falls apart),
+# a single reading and none at all -- we compare:
+#
+#   - include_many() with include() a reading at a time (must be identical)
+#   - the series cut into random pieces, a Measure per piece, merged back
+#     together in order with merge() and +, with one Measure fed everything
+#     (the count, min, max and latest value must be identical, and the
+#     total, average and variance equal to a part in a million)
+#   - the variance with statistics.pvariance() over the raw readings
+#   - pack() then unpacked() with the original (must be identical)
+#
+# and time include() against include_many() on a day of readings.
+#
+#     python3 measure_check.py
+
+import math
+import os
+import random
+import statistics
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [HERE, os.path.dirname(HERE)]
+
+from measure import Measure, RECORD_SIZE
+
+FIELDS = ("count", "value", "total", "average", "minvalue", "maxvalue", "m2", "newminmax")
+
+def series(rng):
+    yield ("CO2 readings", [rng.randint(400, 1800) for _ in range(17280)])
+    yield ("temperatures", [72 + rng.gauss(0, 2) for _ in range(5000)])
+    yield ("constant", [612] * 1000)
+    yield ("huge offset", [1e9 + rng.random() for _ in range(5000)])
+    yield ("one reading", [415])
+    yield ("no readings", [])
+
+def state(m):
+    return tuple(getattr(m, name) for name in FIELDS)
+
+def close(a, b):
+    return math.isclose(a, b, rel_tol=1e-6, abs_tol=1e-12)
+
+def check(name, values, rng):
+    problems = []
+    single = Measure()
+    for v in values:
+        single.include(v)
+
+    batch = Measure()
+    batch.include_many(values)
+    if state(batch) != state(single):
+        problems.append("include_many differs from include")
+
+    # Cut into pieces at random and merge them back, alternating merge() and +
+    cuts = sorted(rng.sample(range(1, len(values)), min(20, max(0, len(values) - 1))))
+    pieces = []
+    for (lo, hi) in zip([0] + cuts, cuts + [len(values)]):
+        m = Measure()
+        m.include_many(values[lo:hi])
+        pieces.append(m)
+    merged = Measure()
+    for (i, piece) in enumerate(pieces):
+        merged = merged + piece if i % 2 else merged.merge(piece)
+    for field in ("count", "value", "minvalue", "maxvalue", "newminmax"):
+        if getattr(merged, field) != getattr(single, field):
+            problems.append("merged %s %r, single pass %r" % (field, getattr(merged, field), getattr(single, field)))
+    for field in ("total", "average", "m2"):
+        if not close(getattr(merged, field), getattr(single, field)):
+            problems.append("merged %s %r, single pass %r" % (field, getattr(merged, field), getattr(single, field)))
+
+    if values and not close(single.getVariance(), statistics.pvariance(values)):
+        problems.append("variance %r, statistics says %r" % (single.getVariance(), statistics.pvariance(values)))
+
+    record = merged.pack()
+    if len(record) != RECORD_SIZE or state(Measure.unpacked(b"xx" + record, 2)) != state(merged):
+        problems.append("pack/unpack doesn't round trip")
+
+    print("%-13s %6d readings, %3d pieces: %s" % (name, len(values), len(pieces),
+                                                 "ok" if not problems else "; ".join(problems)))
+    return not problems
+
+def main():
+    rng = random.Random(2024)
+    ok = all([check(name, values, rng) for (name, values) in series(rng)])
+
+    # Merging something empty, or into something empty, changes nothing
+    m = Measure()
+    m.include_many([5, 3, 9])
+    before = state(m)
+    m.merge(Measure())
+    unchanged = state(m) == before and state(Measure() + m) == before
+    ok = ok and unchanged
+    print("Empty merges: %s" % ("ok" if unchanged else "CHANGED THINGS"))
+
+    values = [rng.randint(400, 1800) for _ in range(17280)]
+    began = time.perf_counter()
+    m = Measure()
+    for v in values:
+        m.include(v)
+    one = time.perf_counter() - began
+    began = time.perf_counter()
+    Measure().include_many(values)
+    many = time.perf_counter() - began
+    print("A day at 5 s: include() %.1f ms, include_many() %.1f ms (%.1fx), a record is %d bytes" %
+          (1000 * one, 1000 * many, one / many, RECORD_SIZE))
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,29 @@
+# Simulated micropython module
+
+# Callbacks that can be waiting to run, as on the rp2 port
+SCHEDULE_DEPTH = 8
+
+_scheduled = []
+_running = False
+
+def const(value):
+    return value
+
+# On the badge a scheduled callback runs in the main context as soon as
+# whatever is running lets it, including from inside a sleep.  Here the
+# only thing that schedules is an interrupt handler, which the emulator
+# calls from inside a sleep, so we run it straight away.
+def schedule(fn, arg):
+    global _running
+    if len(_scheduled) >= SCHEDULE_DEPTH:
+        raise RuntimeError("schedule queue full")
+    _scheduled.append((fn, arg))
+    if _running:
+        return
+    _running = True
+    try:
+        while _scheduled:
+            (fn, arg) = _scheduled.pop(0)
+            fn(arg)
+    finally:
+        _running = False
@@ -0,0 +1,129 @@
+# MicroPython time functions for CPython
+#
+# MicroPython's time module has ticks_ms()/ticks_us()/ticks_diff()/
+# ticks_add() and sleep_ms()/sleep_us(), none of which exist in CPython.
+# install() grafts them onto the CPython time module so our add-on code runs
+# unchanged on Linux.
+#
+# Time comes from a clock object.  RealClock just follows the host clock.
+# VirtualClock only moves when something sleeps (or the harness advances it),
+# so a simulated day of badge operation takes a fraction of a second and is
+# exactly repeatable.  With a VirtualClock installed time.sleep() and
+# time.time() are replaced too.  A harness can also schedule callbacks on a
+# VirtualClock with at(), say to press a button, and they run at exactly
+# that virtual time from inside whatever sleep spans it.
+
+import heapq
+import time
+
+# Same wrap-around behaviour as the rp2 port, where ticks are 30 bits wide
+TICKS_PERIOD = 1 << 30
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALFPERIOD = TICKS_PERIOD // 2
+
+_host_sleep = time.sleep
+_host_time = time.time
+
+class RealClock:
+    virtual = False
+
+    def __init__(self):
+        self._start = time.perf_counter_ns()
+
+    def now_us(self):
+        return (time.perf_counter_ns() - self._start) // 1000
+
+    def sleep_us(self, us):
+        if us > 0:
+            _host_sleep(us / 1000000)
+
+class VirtualClock:
+    virtual = True
+
+    def __init__(self, start_us=0, epoch=1730419200):
+        self.us = start_us
+        self.epoch = epoch      # Wall-clock seconds at virtual time zero
+        self.slept_us = 0       # Total time handed out through sleep calls
+        self._events = []       # Heap of (us, sequence, callback)
+        self._sequence = 0
+
+    def now_us(self):
+        return self.us
+
+    # Call fn() once virtual time reaches us
+    def at(self, us, fn):
+        heapq.heappush(self._events, (int(us), self._sequence, fn))
+        self._sequence += 1
+
+    def _move_to(self, us):
+        while self._events and self._events[0][0] <= us:
+            (when, _, fn) = heapq.heappop(self._events)
+            self.us = max(self.us, when)
+            fn()
+        self.us = us
+
+    def sleep_us(self, us):
+        if us > 0:
+            self.slept_us += int(us)
+            self._move_to(self.us + int(us))
+
+    # Move time forward without counting it as sleep, e.g. to charge for
+    # work the real hardware would have spent time on
+    def advance_us(self, us):
+        if us > 0:
+            self._move_to(self.us + int(us))
+
+    def advance(self, seconds):
+        self.advance_us(seconds * 1000000)
+
+_clock = None
+
+def clock():
+    return _clock
+
+def ticks_us():
+    return _clock.now_us() & TICKS_MAX
+
+def ticks_ms():
+    return (_clock.now_us() // 1000) & TICKS_MAX
+
+def ticks_cpu():
+    return ticks_us()
+
+def ticks_diff(end, start):
+    return ((end - start + TICKS_HALFPERIOD) & TICKS_MAX) - TICKS_HALFPERIOD
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & TICKS_MAX
+
+def sleep(seconds):
+    _clock.sleep_us(seconds * 1000000)
+
+def sleep_ms(ms):
+    _clock.sleep_us(ms * 1000)
+
+def sleep_us(us):
+    _clock.sleep_us(us)
+
+def _virtual_time():
+    return _clock.epoch + _clock.now_us() / 1000000
+
+# Install a clock (a RealClock if none given) and the MicroPython time
+# functions.  Returns the clock so callers can advance it.
+def install(clk=None):
+    global _clock
+    _clock = clk if clk is not None else RealClock()
+    time.ticks_us = ticks_us
+    time.ticks_ms = ticks_ms
+    time.ticks_cpu = ticks_cpu
+    time.ticks_diff = ticks_diff
+    time.ticks_add = ticks_add
+    time.sleep_ms = sleep_ms
+    time.sleep_us = sleep_us
+    if _clock.virtual:
+        time.sleep = sleep
+        time.time = _virtual_time
+    else:
+        time.sleep = _host_sleep
+        time.time = _host_time
+    return _clock
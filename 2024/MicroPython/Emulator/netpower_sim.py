@@ -0,0 +1,89 @@
+# Compare radio policies on Linux using the simulated WLAN
+#
+# Runs a simulated day of CO2 readings through netpower.RadioManager under
+# a virtual clock and reports radio time per uploaded sample, alongside the
+# old behaviour of staying associated and posting every reading.
+#
+#     python3 netpower_sim.py [hours]
+
+import io
+import os
+import sys
+from contextlib import redirect_stdout
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [HERE, os.path.dirname(HERE)]
+
+import mptime
+clock = mptime.install(mptime.VirtualClock())
+
+import time
+import network
+from wifi import WiFi, CONNECTED
+from netpower import RadioManager
+
+SAMPLE_DELAY = 30        # Seconds between readings (low-power periodic mode)
+LOOP_DELAY = 1           # Seconds between main loop iterations
+SEND_MS = 120            # Simulated time for one dweet round trip
+
+sent = []
+def send(co2, tempF, rh):
+    time.sleep_ms(SEND_MS)
+    sent.append(co2)
+
+def run(hours, batch, max_delay, keep_associated=False, always_on=False):
+    network.reset()
+    cachefile = os.path.join(HERE, "wifi_sim.json")
+    if os.path.exists(cachefile):
+        os.remove(cachefile)
+    del sent[:]
+
+    wifi = WiFi("Supercon", "whatpassword", cachefile=cachefile)
+    radio = RadioManager(wifi, send, batch=batch, max_delay=max_delay,
+                         keep_associated=keep_associated)
+    if always_on:
+        wifi.start()
+
+    end = time.ticks_add(time.ticks_ms(), hours * 3600 * 1000)
+    next_sample = time.ticks_ms()
+    co2 = 600
+    while time.ticks_diff(end, time.ticks_ms()) > 0:
+        if time.ticks_diff(time.ticks_ms(), next_sample) >= 0:
+            next_sample = time.ticks_add(next_sample, SAMPLE_DELAY * 1000)
+            co2 = 600 + (co2 * 7 + 13) % 400
+            if always_on:
+                if wifi.poll() == CONNECTED:
+                    send(co2, 72.0, 45.0)
+            else:
+                radio.queue((co2, 72.0, 45.0))
+        if always_on:
+            wifi.poll()
+        else:
+            radio.poll()
+        wifi.learn(time.ticks_diff(next_sample, time.ticks_ms()))
+        time.sleep(LOOP_DELAY)
+
+    on_ms, ps_ms = wifi.wlan.radio_time()
+    if os.path.exists(cachefile):
+        os.remove(cachefile)
+    return (len(sent), on_ms, ps_ms, radio)
+
+def main():
+    hours = int(sys.argv[1]) if len(sys.argv) > 1 else 24
+    print("Simulating %d hours, one reading every %d seconds" % (hours, SAMPLE_DELAY))
+    print("%-34s %8s %12s %12s %10s" % ("policy", "samples", "radio on s", "powersave s", "ms/sample"))
+    policies = (
+        ("always associated, post each", dict(batch=1, max_delay=0, always_on=True)),
+        ("batch 10, radio off", dict(batch=10, max_delay=600)),
+        ("batch 20, radio off", dict(batch=20, max_delay=900)),
+        ("batch 10, power-save between", dict(batch=10, max_delay=600, keep_associated=True)),
+    )
+    for name, kwargs in policies:
+        with redirect_stdout(io.StringIO()):
+            count, on_ms, ps_ms, radio = run(hours, **kwargs)
+        print("%-34s %8d %12.1f %12.1f %10.1f" %
+              (name, count, on_ms / 1000, ps_ms / 1000, on_ms / max(count, 1)))
+    print("Virtual time elapsed: %.1f hours" % (clock.now_us() / 3600e6))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+# Simulated MicroPython network module (CYW43 station interface)
+#
+# Just enough of network.WLAN for wifi.py and netpower.py to run on Linux.
+# Association takes a configurable amount of (possibly virtual) time, longer
+# when the radio has to scan for the access point than when it's handed a
+# BSSID, and every WLAN keeps track of how long its radio has been powered
+# and in which power-management mode, so radio policies can be compared.
+#
+# Behaviour is controlled through the module-level settings below, which a
+# harness changes before the code under test creates its WLAN.
+
+import time
+
+STA_IF = 0
+AP_IF = 1
+
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_WRONG_PASSWORD = -3
+STAT_NO_AP_FOUND = -2
+STAT_CONNECT_FAIL = -1
+STAT_GOT_IP = 3
+
+# Access points within range: (ssid, bssid, channel, RSSI, security, hidden)
+access_points = [
+    (b"Supercon", b"\x02\x00\x5e\x10\x00\x01", 6, -61, 3, False),
+    (b"Supercon", b"\x02\x00\x5e\x10\x00\x02", 11, -72, 3, False),
+]
+password = None          # If set, connect() with any other key fails
+scan_ms = 2200           # Time taken by a blocking scan()
+assoc_ms = 3500          # Time to associate when we have to scan first
+assoc_bssid_ms = 1100    # Time to associate straight to a known BSSID
+
+class WLAN:
+    PM_NONE = 0xa11140
+    PM_PERFORMANCE = 0xa11142
+    PM_POWERSAVE = 0xa11c82
+
+    _interfaces = {}
+
+    # Like the real thing, each interface is a singleton
+    def __new__(cls, interface=STA_IF):
+        wlan = cls._interfaces.get(interface)
+        if wlan is None:
+            wlan = object.__new__(cls)
+            wlan._setup(interface)
+            cls._interfaces[interface] = wlan
+        return wlan
+
+    def __init__(self, interface=STA_IF):
+        pass
+
+    def _setup(self, interface):
+        self.interface = interface
+        self._active = False
+        self._status = STAT_IDLE
+        self._ssid = None
+        self._bssid = None
+        self._channel = 1
+        self._connect_done = 0
+        self._connect_status = STAT_IDLE
+        self._pm = self.PM_PERFORMANCE
+        self._since = time.ticks_ms()
+        self.connects = 0
+        self.scans = 0
+        self.on_ms = 0           # Radio powered, not in power-save
+        self.powersave_ms = 0    # Radio powered, in power-save
+
+    # Charge the time since the last state change to the right bucket
+    def _account(self):
+        now = time.ticks_ms()
+        elapsed = time.ticks_diff(now, self._since)
+        self._since = now
+        if self._active:
+            if self._pm == self.PM_POWERSAVE and self._status == STAT_GOT_IP:
+                self.powersave_ms += elapsed
+            else:
+                self.on_ms += elapsed
+
+    def active(self, state=None):
+        if state is None:
+            return self._active
+        self._account()
+        self._active = bool(state)
+        if not self._active:
+            self._status = STAT_IDLE
+
+    def connect(self, ssid=None, key=None, bssid=None):
+        if not self._active:
+            raise OSError("WLAN not active")
+        self._account()
+        self.connects += 1
+        self._ssid = ssid
+        matches = [ap for ap in access_points if ap[0].decode() == ssid and
+                   (bssid is None or ap[1] == bytes(bssid))]
+        if not matches:
+            self._connect_status = STAT_NO_AP_FOUND
+            delay = assoc_ms
+        elif password is not None and key != password:
+            self._connect_status = STAT_WRONG_PASSWORD
+            delay = assoc_ms
+        else:
+            ap = max(matches, key=lambda ap: ap[3])
+            self._bssid = ap[1]
+            self._channel = ap[2]
+            self._connect_status = STAT_GOT_IP
+            delay = assoc_bssid_ms if bssid is not None else assoc_ms
+        self._status = STAT_CONNECTING
+        self._connect_done = time.ticks_add(time.ticks_ms(), delay)
+
+    def disconnect(self):
+        self._account()
+        self._status = STAT_IDLE
+
+    def status(self, param=None):
+        if param == "rssi":
+            return -61
+        if self._status == STAT_CONNECTING and \
+           time.ticks_diff(time.ticks_ms(), self._connect_done) >= 0:
+            self._account()
+            self._status = self._connect_status
+        return self._status
+
+    def isconnected(self):
+        return self.status() == STAT_GOT_IP
+
+    def ifconfig(self, config=None):
+        if self.status() == STAT_GOT_IP:
+            return ("192.168.4.%d" % (20 + self.interface), "255.255.255.0",
+                    "192.168.4.1", "192.168.4.1")
+        return ("0.0.0.0", "0.0.0.0", "0.0.0.0", "0.0.0.0")
+
+    def scan(self):
+        if not self._active:
+            raise OSError("WLAN not active")
+        self.scans += 1
+        time.sleep_ms(scan_ms)
+        return list(access_points)
+
+    def config(self, *args, **kwargs):
+        if args:
+            name = args[0]
+            if name == "pm":
+                return self._pm
+            if name == "channel":
+                return self._channel
+            if name == "ssid":
+                return self._ssid
+            if name == "mac":
+                return b"\x28\xcd\xc1\x00\x00\x01"
+            raise ValueError("unknown config param")
+        self._account()
+        if "pm" in kwargs:
+            self._pm = kwargs["pm"]
+        if "channel" in kwargs:
+            self._channel = kwargs["channel"]
+
+    # Total radio time so far, in milliseconds: (full power, power-save)
+    def radio_time(self):
+        self._account()
+        return (self.on_ms, self.powersave_ms)
+
+# Forget every interface, e.g. between simulated boots
+def reset():
+    WLAN._interfaces.clear()
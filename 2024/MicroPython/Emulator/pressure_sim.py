@@ -0,0 +1,79 @@
+# Pressure compensation: accuracy against I2C writes
+#
+# Runs the CO2 add-on for a few simulated days of steady 600 ppm CO2 while a
+# weather front moves the real air pressure around, with a simulated LPS22
+# barometer on the same bus.  For each deadband setting we report how many
+# set_ambient_pressure() writes went to the sensor and how far the CO2
+# readings were off, compared with relying on the altitude setting alone.
+#
+#     python3 pressure_sim.py [days]
+
+import io
+import os
+import sys
+import tempfile
+from contextlib import redirect_stdout
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [HERE, os.path.dirname(HERE), os.path.join(os.path.dirname(HERE), "Badge_versions")]
+
+import mptime
+clock = mptime.install(mptime.VirtualClock())
+
+import importlib
+import time
+import machine
+import scd4x_sim
+import lps22_sim
+
+CO2 = 600
+LOOP_DELAY = 5
+
+# (name, deadband in hPa or None for no barometer, max age in seconds)
+CASES = (
+    ("altitude only", None, 0),
+    ("every reading", 0.0, 3600),
+    ("1 hPa, 1 hour", 1.0, 3600),
+    ("2 hPa, 1 hour", 2.0, 3600),
+    ("2 hPa, 1 day", 2.0, 86400),
+    ("5 hPa, 1 day", 5.0, 86400),
+)
+
+def run(seconds, deadband, max_age):
+    weather = lps22_sim.front()
+    bus = machine.I2C(0)
+    sensor = bus.attach(scd4x_sim.SimSCD4X(scd4x_sim.constant(CO2), ambient=weather))
+    if deadband is not None:
+        bus.attach(lps22_sim.SimLPS22(weather))
+    co2sao = importlib.reload(importlib.import_module("badge_co2sao"))
+    co2sao.SAMPLE_DELAY = 40
+    co2sao.FILTER = "none"
+    if deadband is not None:
+        co2sao.PRESSURE_DEADBAND = deadband
+        co2sao.PRESSURE_MAX_AGE = max_age
+
+    errors = []
+    with redirect_stdout(io.StringIO()):
+        co2sao.init(bus)
+        end = time.ticks_add(time.ticks_ms(), seconds * 1000)
+        count = 0
+        while time.ticks_diff(end, time.ticks_ms()) > 0:
+            co2sao.update()
+            if co2sao._co2data.getCount() != count:
+                count = co2sao._co2data.getCount()
+                errors.append(abs(co2sao._co2data.getCurrent() - CO2))
+            time.sleep(LOOP_DELAY)
+    return (sensor.pressure_writes, errors)
+
+def main():
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    os.chdir(tempfile.mkdtemp())
+    print("%d days at %d ppm through a weather front, one reading every 30 s" % (days, CO2))
+    print("%-16s %8s %10s %10s" % ("compensation", "writes", "mean err", "max err"))
+    for (name, deadband, max_age) in CASES:
+        (writes, errors) = run(days * 86400, deadband, max_age)
+        print("%-16s %8d %9.1f %9d" % (name, writes, sum(errors) / len(errors), max(errors)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,192 @@
+# Replay a recorded sensor session through the add-on
+#
+# Plays back a trace recorded on the badge (recordTrace in co2sao.json, see
+# tracelog.py) through the unchanged badge_co2sao code, on a simulated I2C
+# bus under a virtual clock, so a day of readings takes seconds.  Settings
+# can be overridden on the command line to try out thresholds, filters and
+# sampling policies against the same data, e.g.
+#
+#     python3 replay.py co2trace.bin FILTER=hampel HYSTERESIS=50 SAMPLING=adaptive
+#
+# A CSV trace of "seconds,co2,tempC,rh" rows works too.  With no trace
+# given we first record one from the synthetic meeting room, through the
+# same recorder the badge uses.
+#
+# At the end we report every stoplight transition, I2C bus use, and how
+# long after the recorded CO2 rose through the warning and alarm levels the
+# stoplight caught up.
+
+import io
+import os
+import sys
+import tempfile
+from contextlib import redirect_stdout
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [HERE, os.path.dirname(HERE), os.path.join(os.path.dirname(HERE), "Badge_versions")]
+
+import mptime
+clock = mptime.install(mptime.VirtualClock())
+
+import importlib
+import time
+import machine
+import scd4x_sim
+import tracelog
+
+RECORD_HOURS = 4        # Length of the synthetic session
+SHOW_TRANSITIONS = 20   # Stoplight transitions to list before summarizing
+
+COLORS = {0: "off", 1: "green", 3: "yellow", 2: "red"}
+SEVERITY = {0: 0, 1: 1, 3: 2, 2: 3}
+
+# Run the add-on against a sensor on a fresh bus for the given number of
+# seconds, idling between calls the way the badge's main loop does.
+# Returns the bus, the add-on module and its stoplight transitions as
+# (ms, status) pairs.
+def run(sensor, seconds, settings):
+    bus = machine.I2C(0)
+    bus.attach(sensor)
+    co2sao = importlib.reload(importlib.import_module("badge_co2sao"))
+    for (name, value) in settings.items():
+        setattr(co2sao, name, value)
+    start = clock.now_us()
+    transitions = []
+    with redirect_stdout(io.StringIO()):
+        co2sao.init(bus)
+        end = time.ticks_add(time.ticks_ms(), seconds * 1000)
+        while time.ticks_diff(end, time.ticks_ms()) > 0:
+            co2sao.update()
+            if not transitions or transitions[-1][1] != co2sao._co2_status:
+                transitions.append(((clock.now_us() - start) // 1000, co2sao._co2_status))
+            time.sleep_ms(co2sao.idleMs())
+        if co2sao._recorder is not None:
+            co2sao._recorder.flush()
+    return (bus, co2sao, transitions)
+
+# Record the synthetic meeting room session to path
+def record(path):
+    sensor = scd4x_sim.SimSCD4X(scd4x_sim.meeting)
+    run(sensor, RECORD_HOURS * 3600, dict(RECORD_TRACE=1, SAMPLE_DELAY=5))
+    os.rename(tracelog.TRACE_FILE, path)
+
+# Raw records from a trace file, as (ms, co2, temperature, humidity) words
+def load(path):
+    if not path.endswith(".csv"):
+        return tracelog.load(path)[1]
+    source = scd4x_sim.trace(path)
+    sensor = scd4x_sim.SimSCD4X(source)
+    sensor.temperature_offset = 0
+    rows = []
+    with open(path) as f:
+        for line in f:
+            try:
+                seconds = float(line.split(",")[0])
+            except ValueError:
+                continue
+            rows.append((int(seconds * 1000),) + sensor._measure(seconds))
+    return sorted(rows)
+
+# When the recorded CO2 rose through level, in ms.  Like the stoplight, it
+# has to fall margin ppm below level again before the next one counts, so
+# noise around the threshold isn't a string of crossings.
+def crossings(records, level, margin):
+    found = []
+    below = True
+    for (ms, co2, t, rh) in records:
+        if below and co2 >= level:
+            found.append(ms)
+            below = False
+        elif co2 < level - margin:
+            below = True
+    return found
+
+# How long the stoplight took to show at least status after each time CO2
+# rose through level, or None if it never did before the next crossing
+def lags(transitions, times, status):
+    result = []
+    for (i, t) in enumerate(times):
+        limit = times[i + 1] if i + 1 < len(times) else None
+        shown = None
+        for (j, (ms, s)) in enumerate(transitions):
+            if SEVERITY[s] < SEVERITY[status]:
+                continue
+            following = transitions[j + 1][0] if j + 1 < len(transitions) else None
+            if following is not None and following <= t:
+                continue
+            shown = max(0, ms - t)
+            break
+        if shown is not None and limit is not None and t + shown >= limit:
+            shown = None
+        result.append(shown)
+    return result
+
+def clock_time(ms):
+    seconds = ms // 1000
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def setting(text):
+    (name, value) = text.split("=", 1)
+    for kind in (int, float):
+        try:
+            return (name, kind(value))
+        except ValueError:
+            pass
+    return (name, value)
+
+def main():
+    args = sys.argv[1:]
+    settings = dict(setting(a) for a in args if "=" in a)
+    paths = [os.path.abspath(a) for a in args if "=" not in a]
+    # Keep the add-on from picking up (or caching) a real co2sao.json
+    os.chdir(tempfile.mkdtemp())
+    if paths:
+        path = paths[0]
+    else:
+        path = os.path.abspath("meeting.bin")
+        record(path)
+        print("Recorded %d hours of the synthetic meeting room to %s" % (RECORD_HOURS, path))
+    try:
+        records = load(path)
+    except (OSError, ValueError) as err:
+        print("Can't load trace: %s" % err)
+        return 1
+    if not records:
+        print("%s: no readings found" % path)
+        return 1
+    seconds = records[-1][0] // 1000 + 60
+
+    began = time.perf_counter()
+    (bus, co2sao, transitions) = run(scd4x_sim.ReplaySCD4X(records), seconds, settings)
+    wall = time.perf_counter() - began
+
+    print("Replayed %d readings covering %s in %.2f s of real time (%.0fx)" %
+          (len(records), clock_time(seconds * 1000), wall, seconds / wall))
+    if settings:
+        print("Settings: %s" % ", ".join("%s=%s" % item for item in sorted(settings.items())))
+    print("Add-on took %d readings" % co2sao._co2data.getCount())
+
+    print("Stoplight transitions: %d" % (len(transitions) - 1))
+    for (i, (ms, status)) in enumerate(transitions[1:SHOW_TRANSITIONS + 1]):
+        print("  %s  %s -> %s" % (clock_time(ms), COLORS[transitions[i][1]], COLORS[status]))
+    if len(transitions) > SHOW_TRANSITIONS + 1:
+        print("  ... and %d more" % (len(transitions) - SHOW_TRANSITIONS - 1))
+
+    print("I2C bus: %d transactions, %d bytes, %.1f ms busy, %.1f transactions per reading" %
+          (bus.transactions, bus.bytes, bus.busy_us / 1000,
+           bus.transactions / max(1, co2sao._co2data.getCount())))
+
+    for (name, level, status) in (("warning", co2sao.CO2_WARNING, 3), ("alarm", co2sao.CO2_ALARM, 2)):
+        times = crossings(records, level, co2sao.HYSTERESIS)
+        found = lags(transitions, times, status)
+        seen = [lag for lag in found if lag is not None]
+        if not times:
+            print("Latency to %s (%d ppm): never reached" % (name, level))
+            continue
+        print("Latency to %s (%d ppm): %d crossings, %d shown, mean %.0f s, max %.0f s" %
+              (name, level, len(times), len(seen),
+               sum(seen) / 1000 / max(1, len(seen)), max(seen, default=0) / 1000))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,194 @@
+# Time and heap use per SCD4X sample, float vs raw-word decoding
+#
+# scd4x.py used to turn every measurement into floats as soon as it was
+# read -- temperature and humidity, whether anybody wanted them or not --
+# and co2sao.update() then made more floats converting to F.  Now it keeps
+# the sensor's raw 16-bit words and converts on request: integer
+# hundredths of a degree C and of a percent RH, or floats (C, F, %RH).
+#
+# We read samples through the real driver, on a stand-in bus that always
+# has a measurement ready and with the sleeps after each command skipped,
+# and compare the old float decoding (a copy of it, below) with:
+#
+#   - what co2sao.update() now asks for: CO2, temperature_f and
+#     relative_humidity
+#   - CO2 alone, which is all co2status() needs
+#   - CO2 with the integer temperature_centi and relative_humidity_centi
+#
+# MicroPython allocates every float on the heap, which the garbage
+# collector then has to clear up.  Run there -- copy this and scd4x.py to
+# the badge -- gc.mem_alloc() tells us how many bytes each sample
+# allocated.  CPython keeps freed floats to reuse, so it can only give the
+# times.  First we check the integer accessors against the floats for every
+# possible word.
+#
+#     python3 sample_bench.py [samples]
+
+import gc
+import sys
+
+MICROPYTHON = sys.implementation.name == "micropython"
+if not MICROPYTHON:
+    import os
+    HERE = os.path.dirname(os.path.abspath(__file__))
+    sys.path[:0] = [HERE, os.path.dirname(HERE)]
+    import mptime
+    mptime.install()
+
+import time
+import scd4x
+
+SAMPLES = 2000
+
+# Stands in for time in scd4x.py, so we time the driver and not its waits
+class NoWait:
+    @staticmethod
+    def sleep(seconds):
+        pass
+
+# An I2C bus whose sensor always replies with the same measurement, or
+# with "no data ready" when ready is False
+class Bus:
+    def __init__(self, co2, temp_word, humi_word):
+        self.ready = True
+        self.measurement = self.words(co2, temp_word, humi_word)
+        self.not_ready = self.words(0, 0, 0)
+
+    @staticmethod
+    def words(*values):
+        out = bytearray(18)
+        for (i, value) in enumerate(values):
+            out[3 * i] = value >> 8
+            out[3 * i + 1] = value & 0xFF
+            out[3 * i + 2] = scd4x.SCD4X._crc8(out[3 * i:3 * i + 2])
+        return out
+
+    def writeto(self, address, buf):
+        pass
+
+    def readfrom_into(self, address, buf):
+        reply = self.measurement if self.ready else self.not_ready
+        for i in range(9):
+            buf[i] = reply[i]
+
+# scd4x.py's decoding before it kept the raw words
+class FloatSCD4X(scd4x.SCD4X):
+    @property
+    def temperature(self):
+        if self.data_ready:
+            self._read_data()
+        return self._temperature
+
+    @property
+    def relative_humidity(self):
+        if self.data_ready:
+            self._read_data()
+        return self._relative_humidity
+
+    def _read_data(self):
+        self._send_command(0xEC05, cmd_delay=0.001)
+        self._read_reply(self._buffer, 9)
+        self._co2 = (self._buffer[0] << 8) | self._buffer[1]
+        temp = (self._buffer[3] << 8) | self._buffer[4]
+        self._temperature = -45 + 175 * (temp / 2**16)
+        humi = (self._buffer[6] << 8) | self._buffer[7]
+        self._relative_humidity = 100 * (humi / 2**16)
+
+    def _read_reply(self, buff, num):
+        self.i2c_device.readfrom_into(self.address, buff)
+        self._check_buffer_crc(self._buffer[0:num])
+
+def sensor(kind, bus):
+    scd4x.time = NoWait
+    scd4x.print = lambda *args: None        # __init__ is chatty
+    try:
+        return kind(bus)
+    finally:
+        del scd4x.print
+
+def floats_before(s, n):
+    for _ in range(n):
+        if s.data_ready:
+            co2 = s.CO2
+            tempF = (s.temperature * 1.8) + 32.0
+            rh = s.relative_humidity
+
+def floats_now(s, n):
+    for _ in range(n):
+        if s.data_ready:
+            co2 = s.CO2
+            tempF = s.temperature_f
+            rh = s.relative_humidity
+
+def co2_only(s, n):
+    for _ in range(n):
+        if s.data_ready:
+            co2 = s.CO2
+
+def integers(s, n):
+    for _ in range(n):
+        if s.data_ready:
+            co2 = s.CO2
+            centiC = s.temperature_centi
+            centiRH = s.relative_humidity_centi
+
+# Microseconds and heap bytes (None if we can't tell) per sample
+def measure(path, s, n):
+    path(s, 10)
+    gc.collect()
+    if MICROPYTHON:
+        gc.disable()
+        before = gc.mem_alloc()
+    began = time.ticks_us()
+    path(s, n)
+    took = time.ticks_diff(time.ticks_us(), began)
+    heap = None
+    if MICROPYTHON:
+        heap = (gc.mem_alloc() - before) / n
+        gc.enable()
+    return (took / n, heap)
+
+# The integer accessors against the floats, for every word the sensor
+# could send.  With the bus saying no data is ready, the driver just
+# converts whatever word we leave it.
+def check_words():
+    bus = Bus(0, 0, 0)
+    bus.ready = False
+    new = sensor(scd4x.SCD4X, bus)
+    problems = 0
+    for word in range(65536):
+        new._temp_word = new._humi_word = word
+        temp = -45 + 175 * (word / 2**16)
+        humi = 100 * (word / 2**16)
+        if (abs(new.temperature_centi - 100 * temp) > 0.5 + 1e-6 or
+                abs(new.relative_humidity_centi - 100 * humi) > 0.5 + 1e-6 or
+                new.temperature != temp or new.relative_humidity != humi or
+                abs(new.temperature_f - (temp * 1.8 + 32.0)) > 1e-9):
+            problems += 1
+    print("All 65536 words: %s" % ("integer and float readings agree" if problems == 0
+                                    else "%d disagree" % problems))
+    return problems == 0
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else SAMPLES
+    ok = check_words()
+    # 812 ppm, 23.4 C, 41.6 %RH
+    bus = Bus(812, int((23.4 + 45) * 2**16 / 175), int(41.6 * 2**16 / 100))
+    old = sensor(FloatSCD4X, bus)
+    new = sensor(scd4x.SCD4X, bus)
+    print("%d samples, each read through the driver:" % n)
+    (base, base_heap) = measure(floats_before, old, n)
+    for (name, path, s) in (("Floats, decoded as before", floats_before, old),
+                            ("Floats, decoded on request", floats_now, new),
+                            ("CO2 only, as before", co2_only, old),
+                            ("CO2 only, raw words", co2_only, new),
+                            ("CO2 with centi C and %RH", integers, new)):
+        (us, heap) = (base, base_heap) if path is floats_before else measure(path, s, n)
+        print("  %-27s %7.1f us%s" % (name, us,
+              "" if heap is None else ", %5.1f heap bytes" % heap))
+    if base_heap is None:
+        print("(heap bytes a sample allocates need MicroPython's gc.mem_alloc() -- run it on the badge)")
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,61 @@
+# Simulated badge SAOs: the petal and the touchwheel
+#
+# Both sit on a simulated machine.I2C bus like the SCD4X in scd4x_sim.py.
+# The petal keeps a timestamped history of every LED register change, so a
+# harness can tell exactly when (and for how long) something lit up.
+
+import mptime
+
+PETAL_ADDRESS = 0x00
+TOUCHWHEEL_ADDRESS = 0x54
+
+class SimPetal:
+    # The petal SAO's LED driver: registers 1-8 hold the LEDs of each
+    # petal, 9-15 are setup.  We keep the register values and when each one
+    # changed.
+    address = PETAL_ADDRESS
+
+    def __init__(self):
+        self.registers = bytearray(16)
+        self.writes = 0
+        self.history = []           # (us, register, value) on every change
+
+    def write_mem(self, memaddr, data):
+        for (i, value) in enumerate(data):
+            reg = (memaddr + i) & 0x0F
+            self.writes += 1
+            if self.registers[reg] != value:
+                self.registers[reg] = value
+                self.history.append((mptime.clock().now_us(), reg, value))
+
+    def read_mem(self, memaddr, n):
+        return bytes(self.registers[(memaddr + i) & 0x0F] for i in range(n))
+
+    def write(self, data):
+        if data:
+            self.write_mem(data[0], data[1:])
+
+    def read(self, n):
+        return self.read_mem(0, n)
+
+class SimTouchwheel:
+    # The touchwheel SAO: register 0 reads 0 when untouched, otherwise 1-255
+    # clockwise from the bottom.  Registers 15-17 are its RGB LED.
+    address = TOUCHWHEEL_ADDRESS
+
+    def __init__(self):
+        self.position = 0
+        self.rgb = bytearray(3)
+        self.reads = 0
+
+    def read_mem(self, memaddr, n):
+        self.reads += 1
+        regs = bytearray(32)
+        regs[0] = self.position
+        regs[15:18] = self.rgb
+        return bytes(regs[(memaddr + i) & 0x1F] for i in range(n))
+
+    def write_mem(self, memaddr, data):
+        for (i, value) in enumerate(data):
+            if 15 <= memaddr + i <= 17:
+                self.rgb[memaddr + i - 15] = value
@@ -0,0 +1,322 @@
+# Simulated Sensirion SCD4X CO2 sensor
+#
+# Sits on a simulated machine.I2C bus and speaks the same command set as the
+# real sensor, CRCs and all, so scd4x.py drives it unchanged.  Measurements
+# come out on the sensor's own schedule -- every 5 seconds in periodic mode
+# and every 30 seconds in low-power periodic mode, timed from when the mode
+# was started -- using the virtual clock from mptime.py.  Like the real
+# thing, most commands are refused (NACKed) while a measurement mode is
+# running.
+#
+# What the sensor "measures" comes from a source function that takes the
+# number of seconds since the simulation started and returns (co2 ppm,
+# temperature C, relative humidity %).  trace() builds one from a recorded
+# CSV file of "seconds,co2,tempC,rh" rows, and there are a couple of
+# synthetic ones below.  ReplaySCD4X at the end plays back the raw words
+# of a session recorded on the badge with tracelog.py instead.
+#
+# If it's given an ambient pressure source as well (seconds -> hPa), CO2
+# readings are off by the ratio of the real pressure to the pressure the
+# sensor assumes -- the one last set with set_ambient_pressure(), or else
+# the one for its altitude setting -- which is what the real sensor's
+# pressure compensation corrects for.
+#
+# The sensor also keeps track of how long it spends in each mode, so the
+# sensor-side view of power use can be checked against what the add-on
+# thinks it's doing.
+#
+# Faults can be injected with inject(): NACKs on the next few transfers,
+# replies with a bad CRC, getting stuck holding SDA low (which wedges the
+# bus until SCL is clocked), or a brownout that leaves the sensor idle with
+# its settings back to how they were stored, as after a power cycle.
+
+import math
+import random
+import mptime
+
+ADDRESS = 0x62
+
+IDLE = 0
+PERIODIC = 1
+LOW_POWER = 2
+MODE_NAMES = ("idle", "periodic", "low power")
+INTERVAL_US = (0, 5000000, 30000000)
+
+# Commands allowed while a measurement mode is running (SCD4X datasheet
+# section 3.5), everything else is NACKed
+_RUNNING_OK = (0xEC05, 0xE4B8, 0x3F86, 0xE000)
+_SET_COMMANDS = (0x241D, 0x2427, 0xE000, 0x2416, 0x362F)
+
+# Kinds of fault for inject()
+NACK = "nack"
+BAD_CRC = "crc"
+WEDGE = "wedge"
+BROWNOUT = "brownout"
+FAULTS = (NACK, BAD_CRC, WEDGE, BROWNOUT)
+
+def crc8(data):
+    crc = 0xFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x31) if crc & 0x80 else (crc << 1)
+    return crc & 0xFF
+
+# Pack 16-bit words the way the sensor sends them, each followed by its CRC
+def words(*values):
+    out = bytearray()
+    for value in values:
+        pair = bytes(((value >> 8) & 0xFF, value & 0xFF))
+        out += pair
+        out.append(crc8(pair))
+    return bytes(out)
+
+# Steady readings, for when nothing more interesting is needed
+def constant(co2=600, tempC=22.0, rh=45.0):
+    return lambda seconds: (co2, tempC, rh)
+
+def _noise(seconds):
+    return random.Random(int(seconds)).gauss(0, 8)
+
+# Meeting room: quiet for half an hour, then an hour-long meeting pushes CO2
+# up past both thresholds, then the room airs out
+def meeting(seconds):
+    start, end = 1800, 5400
+    if seconds < start:
+        co2 = 450
+    elif seconds < end:
+        co2 = 450 + 1000 * (1 - math.exp(-(seconds - start) / 1800))
+    else:
+        peak = 450 + 1000 * (1 - math.exp(-(end - start) / 1800))
+        co2 = 450 + (peak - 450) * math.exp(-(seconds - end) / 900)
+    return (co2 + _noise(seconds), 23.0, 40.0)
+
+# Quiet office: a slow drift that never gets near the thresholds
+def office(seconds):
+    co2 = 480 + 40 * math.sin(seconds / 7200)
+    return (co2 + _noise(seconds), 22.0, 45.0)
+
+# Source that replays a CSV trace of "seconds,co2,tempC,rh" rows, holding
+# each row until the next one.  Blank lines, comments and a header are
+# skipped.  Past the end of the trace the last row is held.
+def trace(path):
+    rows = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split("#")[0].strip().split(",")
+            try:
+                rows.append(tuple(float(x) for x in fields[:4]))
+            except ValueError:
+                continue
+    if not rows:
+        raise ValueError("%s: no readings found" % path)
+    rows.sort()
+    state = [0]
+
+    def source(seconds):
+        i = state[0]
+        if i > 0 and rows[i][0] > seconds:
+            i = 0
+        while i + 1 < len(rows) and rows[i + 1][0] <= seconds:
+            i += 1
+        state[0] = i
+        return rows[i][1:]
+    return source
+
+class SimSCD4X:
+    address = ADDRESS
+
+    def __init__(self, source=None, serial=(0xBEEF, 0x0C02, 0x2024), ambient=None):
+        self.source = source if source is not None else constant()
+        self.ambient = ambient
+        self.serial = serial
+        self.mode = IDLE
+        self.temperature_offset = 0x0912        # Raw, 4 C as shipped
+        self.altitude = 0
+        self.pressure = None                    # hPa, once set
+        self.pressure_writes = 0
+        self.asc = 1
+        self.measurements = 0                   # Measurements taken
+        self.reads = 0                          # Measurements read out
+        self.nacks = 0
+        self.faults = {}                        # kind -> how many still to come
+        self.injected = {}                      # kind -> how many happened
+        self.bus = None                         # Set when attached
+        self.mode_us = [0, 0, 0]                # Time spent in each mode
+        self._origin = mptime.clock().now_us()
+        self._since = self._origin              # When the current mode started
+        self._taken = 0                         # Measurements so far this mode
+        self._unread = False
+        self._latest = None                     # (co2, raw temperature, raw rh)
+        self._reply = b""
+
+    def _now(self):
+        return mptime.clock().now_us()
+
+    # Take any measurements that have come due since we last looked
+    def _catch_up(self):
+        if self.mode == IDLE:
+            return
+        now = self._now()
+        due = (now - self._since) // INTERVAL_US[self.mode]
+        if due > self._taken:
+            when = self._since + due * INTERVAL_US[self.mode]
+            self._latest = self._measure((when - self._origin) / 1000000)
+            self.measurements += due - self._taken
+            self._taken = due
+            self._unread = True
+
+    # Raw (CO2, temperature, humidity) words for a measurement taken this
+    # many seconds into the simulation
+    def _measure(self, seconds):
+        (co2, tempC, rh) = self.source(seconds)
+        tempC -= 175.0 * self.temperature_offset / 65536
+        if self.ambient is not None:
+            co2 *= self.ambient(seconds) / self.assumed_pressure()
+        return (max(0, min(40000, int(co2))),
+                max(0, min(65535, int((tempC + 45) * 65536 / 175))),
+                max(0, min(65535, int(rh * 65536 / 100))))
+
+    # Pressure the sensor's compensation is working from, in hPa
+    def assumed_pressure(self):
+        if self.pressure is not None:
+            return self.pressure
+        return 1013.25 * (1 - 2.25577e-5 * self.altitude) ** 5.25588
+
+    def _set_mode(self, mode):
+        now = self._now()
+        self.mode_us[self.mode] += now - self._since
+        self.mode = mode
+        self._since = now
+        self._taken = 0
+        self._unread = False
+
+    # Seconds spent in each mode so far, including the current one
+    def mode_seconds(self):
+        spent = list(self.mode_us)
+        spent[self.mode] += self._now() - self._since
+        return [us / 1000000 for us in spent]
+
+    def _nack(self):
+        self.nacks += 1
+        raise OSError(5)
+
+    # Have the next count transfers NACK, or replies fail their CRC, or
+    # reads wedge the bus; or brown out now
+    def inject(self, kind, count=1):
+        if kind == BROWNOUT:
+            self._set_mode(IDLE)
+            self.temperature_offset = 0x0912
+            self.altitude = 0
+            self.pressure = None
+            self._latest = None
+            self._reply = b""
+            self._injected(kind)
+        else:
+            self.faults[kind] = self.faults.get(kind, 0) + count
+
+    def _injected(self, kind):
+        self.injected[kind] = self.injected.get(kind, 0) + 1
+
+    # Whether a fault of this kind is due, using it up if so
+    def _fault(self, kind):
+        if not self.faults.get(kind):
+            return False
+        self.faults[kind] -= 1
+        self._injected(kind)
+        return True
+
+    def write(self, data):
+        if self._fault(NACK):
+            self._nack()
+        if len(data) < 2:
+            self._nack()
+        cmd = (data[0] << 8) | data[1]
+        value = None
+        if len(data) >= 5:
+            if crc8(data[2:4]) != data[4]:
+                self._nack()
+            value = (data[2] << 8) | data[3]
+        self._catch_up()
+        if self.mode != IDLE and cmd not in _RUNNING_OK:
+            self._nack()
+        if (cmd in _SET_COMMANDS) != (value is not None):
+            self._nack()
+        self._reply = b""
+
+        if cmd == 0x21B1:
+            self._set_mode(PERIODIC)
+        elif cmd == 0x21AC:
+            self._set_mode(LOW_POWER)
+        elif cmd == 0x3F86:
+            self._set_mode(IDLE)
+        elif cmd == 0xE4B8:
+            self._reply = words(0x8006 if self._unread else 0x8000)
+        elif cmd == 0xEC05:
+            if self._latest is None:
+                self._nack()
+            self._reply = words(*self._latest)
+            self._unread = False
+            self.reads += 1
+        elif cmd == 0x3682:
+            self._reply = words(*self.serial)
+        elif cmd == 0x2318:
+            self._reply = words(self.temperature_offset)
+        elif cmd == 0x241D:
+            self.temperature_offset = value
+        elif cmd == 0x2322:
+            self._reply = words(self.altitude)
+        elif cmd == 0x2427:
+            self.altitude = value
+        elif cmd == 0xE000:
+            self.pressure = value
+            self.pressure_writes += 1
+        elif cmd == 0x2313:
+            self._reply = words(self.asc)
+        elif cmd == 0x2416:
+            self.asc = value
+        elif cmd == 0x362F:
+            self._reply = words(0x8000)         # No correction needed
+        elif cmd == 0x3639:
+            self._reply = words(0)              # Self test passed
+        elif cmd in (0x3646, 0x3632, 0x3615):
+            pass                                # Reinit, factory reset, persist
+        else:
+            self._nack()
+
+    # Reading past the end of a reply gives 0xFF, as on the real bus
+    def read(self, n):
+        if self._fault(WEDGE):
+            self._reply = b""
+            self.bus.wedge()
+            raise OSError(110)
+        if self._fault(NACK):
+            self._nack()
+        reply = self._reply[:n]
+        self._reply = b""
+        if reply and self._fault(BAD_CRC):
+            reply = bytes((reply[0] ^ 0x10,)) + reply[1:]
+        return reply + b"\xff" * (n - len(reply))
+
+class ReplaySCD4X(SimSCD4X):
+    # Plays back a trace recorded on the badge by tracelog.py: each
+    # measurement gives exactly the raw words of the latest recorded reading
+    # at or before that time (the first one before the trace starts).  The
+    # sensor still measures on its own schedule for whatever mode the add-on
+    # puts it in, so a trace recorded at one rate can be replayed under
+    # another sampling policy.  The recorded temperature already includes
+    # the recording badge's offset, so the offset setting is ignored.
+    def __init__(self, records, serial=(0xBEEF, 0x0C02, 0x2024)):
+        super().__init__(None, serial)
+        self.records = records
+        self._next = 0
+
+    def _measure(self, seconds):
+        ms = seconds * 1000
+        i = self._next
+        if i > 0 and self.records[i - 1][0] > ms:
+            i = 0
+        while i < len(self.records) and self.records[i][0] <= ms:
+            i += 1
+        self._next = i
+        return tuple(self.records[max(0, i - 1)][1:])
@@ -0,0 +1,97 @@
+# Check what the stoplight decoder sees during every possible LED change
+#
+# Drives stoplight.Stoplight through every transition between OFF, GREEN,
+# YELLOW and RED against the simulated RP2040 registers, with and without
+# the SIO fast path and with and without PWM dimming, and reports any output
+# pattern that was visible in between.  An intermediate "off" is just a
+# blink; an intermediate color is the glitch we're trying to eliminate.
+#
+#     python3 stoplight_check.py
+
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [HERE, os.path.dirname(HERE)]
+
+import mptime
+mptime.install()
+
+import machine
+from stoplight import Stoplight, OFF, GREEN, YELLOW, RED
+
+NAMES = {OFF: "off", GREEN: "green", YELLOW: "yellow", RED: "red"}
+LSB = 7
+MSB = 6
+
+# The status the decoder would show for an output pattern
+def decode(word):
+    return ((word >> LSB) & 1) | (((word >> MSB) & 1) << 1)
+
+# The old badge_co2sao.setLED(): bit 0 first, then bit 1
+class TwoWrites:
+    def __init__(self):
+        self.status = OFF
+        self._pin0 = machine.Pin(LSB, machine.Pin.OUT)
+        self._pin1 = machine.Pin(MSB, machine.Pin.OUT)
+
+    def set(self, status):
+        if status == self.status:
+            return
+        self._pin0.value(status & 1)
+        self._pin1.value((status >> 1) & 1)
+        self.status = status
+
+    def dim(self, percent):
+        return False
+
+def check(make, brightness=100):
+    colors = blinks = 0
+    for start in NAMES:
+        for end in NAMES:
+            if start == end:
+                continue
+            machine.gpio.reset()
+            light = make()
+            light.dim(brightness)
+            light.set(start)
+            del machine.gpio.history[:]
+            light.set(end)
+            for state in machine.gpio.history[:-1]:
+                seen = [decode(word) for word in state]
+                extra = [s for s in seen if s not in (start, end)]
+                if [s for s in extra if s != OFF]:
+                    colors += 1
+                    print("  %6s -> %-6s showed %s" % (NAMES[start], NAMES[end],
+                          "/".join(NAMES[s] for s in seen)))
+                elif extra and not (OFF in (start, end) or brightness < 100):
+                    blinks += 1
+            final = set(decode(word) for word in machine.gpio.history[-1])
+            expected = set([end]) if brightness == 100 or end == OFF else set([end, OFF])
+            if final != expected:
+                print("  %6s -> %-6s ended showing %s" % (NAMES[start], NAMES[end],
+                      "/".join(NAMES[s] for s in final)))
+                colors += 1
+    return (colors, blinks)
+
+def main():
+    # (description, driver factory, brightness, must be completely clean)
+    cases = (
+        ("two Pin.value() calls (old setLED)", lambda: TwoWrites(), 100, False),
+        ("Pin.value() fallback, clear first", lambda: Stoplight(LSB, MSB, use_sio=False), 100, False),
+        ("SIO GPIO_OUT_XOR", lambda: Stoplight(LSB, MSB, use_sio=True), 100, True),
+        ("PWM dimmed 30%, duty_u16()", lambda: Stoplight(LSB, MSB, use_sio=False), 30, False),
+        ("PWM dimmed 30%, single CC write", lambda: Stoplight(LSB, MSB, use_sio=True), 30, True),
+    )
+    failed = False
+    for (name, make, brightness, clean) in cases:
+        print(name)
+        colors, blinks = check(make, brightness)
+        print("  %d transitions showed a wrong color, %d blinked off" % (colors, blinks))
+        if clean and (colors or blinks):
+            failed = True
+    print("SIO driver glitch-free: %s" % ("no" if failed else "yes"))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
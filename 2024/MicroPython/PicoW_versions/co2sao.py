@@ -3,6 +3,8 @@ from machine import Pin
 import time
 import scd4x
 import basicdweet
+import energy
+from stoplight import Stoplight
 
 # Map LED control values (GPIO1 & GPIO2) to LED colors. Must agree with wiring
 # on Stoplight controller board.  We're using a Grey code scheme for green ->
@@ -30,8 +32,13 @@ ALTITUDE = 400
 CO2_WARNING = 800
 CO2_ALARM = 1000
 
-def init():
-    global scd4x, _led_bit0, _led_bit1, _co2_status
+# Outbound readings go through a netpower.RadioManager if we're given one,
+# otherwise each reading is posted as soon as it arrives
+_radio = None
+
+def init(radio=None):
+    global scd4x, _stoplight, _co2_status, _radio
+    _radio = radio
 
     # On-board LED, which isn't used normally but might be useful for debugging
     # led = Pin("LED", Pin.OUT)
@@ -45,12 +52,10 @@ def init():
     # pins identified as "5" (D5) and "6" (D6) on the Adafruit Feather RP2040
     # itself are actually GPIO7 and GPIO8 (so must be identified as "7" and "8" \
     # respectively in calls to the MicroPython Pin() class.
-    _led_bit0 = Pin(14, Pin.OUT)
-    _led_bit1 = Pin(15, Pin.OUT)
-
-    # Initialize LEDs to all off, overall CO2 status is off
-    _led_bit0.value(0)
-    _led_bit1.value(0)
+    #
+    # The Stoplight driver sets both bits in a single register write (see
+    # stoplight.py) and starts with LEDs all off, so overall CO2 status is off.
+    _stoplight = Stoplight(14, 15)
     _co2_status = OFF
 
     # Connect to SCD40 and initialize
@@ -80,6 +85,7 @@ def update():
     global scd4x 
     if scd4x.data_ready:
             tempF = (scd4x.temperature * 1.8) + 32.0
+            energy.meter.sample()
             print("Hi: %d ppm CO2, %0.1f *F, %0.1f %%RH" % (scd4x.CO2,tempF,scd4x.relative_humidity))
             
             # Calculate green/yellow/red CO2 air quality status from CO2 value
@@ -88,8 +94,12 @@ def update():
             # Set status, which may result in updating stoplight LEDs
             setLED(newstatus)
             
-            # Post latest readings via dweet.io (presuming we're connected to a network)
-            postdweet(scd4x.CO2,tempF,scd4x.relative_humidity)
+            # Post latest readings via dweet.io (presuming we're connected to a network),
+            # batched through the radio manager if we have one
+            if _radio is not None:
+                _radio.queue((scd4x.CO2,tempF,scd4x.relative_humidity))
+            else:
+                postdweet(scd4x.CO2,tempF,scd4x.relative_humidity)
             
 # Determine air quality corresponding to CO2 reading, with thresholds
 # to establish green, yellow, and red status in overall PPM.  Note that
@@ -111,15 +121,7 @@ def setLED(newstatus):
     global _co2_status
     if newstatus == _co2_status:
         return
-        
-    if newstatus & 1:
-        _led_bit0.value(1)
-    else:
-        _led_bit0.value(0)
-    if newstatus & 2:
-        _led_bit1.value(1)
-    else:
-        _led_bit1.value(0)
+    _stoplight.set(newstatus)
     _co2_status = newstatus
     return
 
@@ -129,5 +131,7 @@ def postdweet(co2, tempF, rh):
         'temperatureF' : tempF,
         'humidity' : rh
         }
+    # Running energy totals, so configurations can be compared remotely
+    payload.update(energy.meter.telemetry())
     r = basicdweet.dweet_for('orangemoose-co2sao',payload)
     print(r)
@@ -3,14 +3,15 @@ import network
 from time import sleep
 import scd4x
 import co2sao
+from wifi import WiFi
+from netpower import RadioManager
+import energy
 
 # Wi-Fi credentials
 ssid = 'Centaurus A'
 password = 'P@ran0rm@l'
 
 def badge_init():
-    global wlan
-    
     # Scan for attached I2C devices
     sdaPIN=machine.Pin(0)
     sclPIN=machine.Pin(1)
@@ -22,37 +23,33 @@ def badge_init():
             print("    I2C Device at address = ",hex(device))
     else:
         print("No device found")
-        
-    # Init Wi-Fi Interface
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
 
-    # Connect to your network
-    wlan.connect(ssid, password)
+# Upload batching: bring the radio up when this many readings are queued,
+# or when the oldest has waited UPLOAD_DELAY seconds
+UPLOAD_BATCH = 10
+UPLOAD_DELAY = 600
 
-    # Wait for Wi-Fi connection
-    connection_timeout = 10
-    while connection_timeout > 0:
-        if wlan.status() >= 3:
-            break
-        connection_timeout -= 1
-        print('Waiting for Wi-Fi connection...')
-        sleep(1)
+# Print an energy report every this many trips around the main loop (about
+# an hour with a 10 second loop)
+ENERGY_REPORT = 360
 
-    # Check if connection is successful
-    if wlan.status() != 3:
-        raise RuntimeError('Failed to establish a network connection')
-    else:
-        network_info = wlan.ifconfig()
-        print('WiFi connected, IP address:', network_info[0])
+def network_init():
+    global wifi, radio
+
+    # The radio manager decides when the radio comes up.  Connecting happens
+    # in the background (polled from the main loop) so add-ons run while we
+    # associate, and the radio goes back down once the batch is sent.
+    wifi = WiFi(ssid, password)
+    radio = RadioManager(wifi, co2sao.postdweet, batch=UPLOAD_BATCH, max_delay=UPLOAD_DELAY)
 
 def init():
-     # Initialize the badge itself
-     badge_init()
-     
-     # Initialize all add-ons
-     co2sao.init()
-     
+    # Initialize the badge itself
+    badge_init()
+    network_init()
+
+    # Initialize all add-ons
+    co2sao.init(radio)
+
 def main():
     # Initialize everything
     print("Badge initializing...")
@@ -60,10 +57,22 @@ def main():
     
     # Main loop
     print("Beginning main loop")
+    loops = 0
     while True:
+        # Open an upload window if one is due, or check on the one in progress
+        radio.poll()
+
         # Call update functions for all attached add-ons
         co2sao.update()
+
+        loops += 1
+        if loops % ENERGY_REPORT == 0:
+            energy.meter.report()
+
+        # Tell the energy meter the CPU is idle while we wait
+        energy.meter.state(energy.CPU, energy.CPU_IDLE)
         sleep(10)
+        energy.meter.state(energy.CPU, energy.CPU_ACTIVE)
     
         
 if __name__=="__main__":
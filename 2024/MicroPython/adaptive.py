@@ -0,0 +1,194 @@
+# Rate-of-change adaptive sampling for the SCD40
+#
+# The SCD40 is by far the biggest steady power draw on the add-on, and most
+# of the time CO2 is either sitting still or drifting slowly, well away from
+# the stoplight thresholds.  Sampling every 5 seconds then buys nothing.  So
+# instead of picking one measurement mode at boot, the Sampler moves the
+# sensor between three modes as conditions change:
+#
+#   FAST    periodic measurement, a reading every 5 seconds (~15 mA)
+#   LOW     low-power periodic measurement, every 30 seconds (~3.2 mA)
+#   CYCLED  the sensor idles (~0.2 mA) and is woken up every `cycle`
+#           seconds for a single reading, then stopped again
+#
+# The SCD40 has no single-shot command (that's the SCD41), so CYCLED starts
+# periodic measurement, takes the first reading about 5 seconds later and
+# stops.  Sensirion say the first reading after a start is a little less
+# accurate, and automatic self-calibration assumes continuous operation, so
+# CYCLED is only used when CO2 is far from both thresholds and not moving.
+#
+# The mode is chosen from the CO2 trend (ppm per minute, from trend.py) and
+# how close the filtered reading is to the warning or alarm level.  Going to
+# a faster mode happens straight away.  Going to a slower one needs a margin
+# half as wide again (the rate below 2/3 of the limit, the distance beyond
+# 1.5 times it) and for that to have held for `hold` seconds, so a room
+# hovering near a boundary doesn't make the sensor flip back and forth.  Each
+# mode change costs a stop command, which blocks for 500 ms.
+#
+# Time spent in each mode is recorded, along with time spent in each sensor
+# state, from which report() estimates the sensor's average current.
+
+import time
+import energy
+
+FAST = 0
+LOW = 1
+CYCLED = 2
+MODE_NAMES = ("periodic", "low power", "duty cycled")
+
+# Sensor states, for power accounting
+_RUNNING = 0        # Periodic measurement
+_LOW_RUNNING = 1    # Low-power periodic measurement
+_IDLE = 2
+STATE_NAMES = ("periodic", "low power", "idle")
+
+# Typical average supply current in each state, in uA
+CURRENT_UA = (energy.CURRENT_UA[energy.SENSOR][energy.SENSOR_PERIODIC],
+              energy.CURRENT_UA[energy.SENSOR][energy.SENSOR_LOW_POWER],
+              energy.CURRENT_UA[energy.SENSOR][energy.SENSOR_IDLE])
+
+FAST_RATE = 20      # ppm/min at or above which we sample every 5 seconds
+SLOW_RATE = 5       # ppm/min at or above which we stay in low-power mode
+NEAR = 50           # ppm from a threshold within which we sample every 5 seconds
+FAR = 150           # ppm from a threshold within which we stay in low-power mode
+HOLD = 120          # Seconds conditions must stay calm before slowing down
+
+class Sampler:
+    def __init__(self, sensor, warning, alarm, cycle=120, hold=HOLD):
+        self.sensor = sensor
+        self.warning = warning
+        self.alarm = alarm
+        self.cycle = cycle
+        self.hold = hold * 1000
+        self.mode = None
+        self.switches = 0
+        self.mode_ms = [0, 0, 0]
+        self.state_ms = [0, 0, 0]
+        self._state = _IDLE
+        self._last = time.ticks_ms()
+        self._calm_since = None
+        self._next = None           # When the next CYCLED reading is due
+        self.started = self._last   # When the sensor last started measuring
+
+    # Charge the time since we last looked to the current mode and state
+    def _account(self):
+        now = time.ticks_ms()
+        elapsed = time.ticks_diff(now, self._last)
+        self._last = now
+        if self.mode is not None:
+            self.mode_ms[self.mode] += elapsed
+        self.state_ms[self._state] += elapsed
+        return now
+
+    def _stop(self):
+        if self._state != _IDLE:
+            self.sensor.stop_periodic_measurement()
+            self._account()
+            self._state = _IDLE
+
+    def _run(self, state):
+        if state == _RUNNING:
+            self.sensor.start_periodic_measurement()
+        else:
+            self.sensor.start_low_periodic_measurement()
+        self.started = self._account()
+        self._state = state
+
+    # Put the sensor into a mode.  Assumes nothing about its current state
+    # the first time, so call this once the sensor is configured.
+    def start(self, mode=LOW):
+        now = self._account()
+        if self.mode is None:
+            self._state = _RUNNING
+        elif mode != self.mode:
+            self.switches += 1
+        self.mode = mode
+        self._calm_since = None
+        self._stop()
+        if mode == FAST:
+            self._run(_RUNNING)
+        elif mode == LOW:
+            self._run(_LOW_RUNNING)
+        else:
+            self._next = time.ticks_add(now, self.cycle * 1000)
+
+    # Carry on in a mode after a reboot (e.g. waking from deep sleep), with
+    # the next CYCLED reading due in due_ms
+    def resume(self, mode, due_ms=0):
+        self.start(mode)
+        if mode == CYCLED:
+            self._next = time.ticks_add(self._last, max(0, due_ms))
+
+    # Milliseconds until the sensor next needs waking, or None if it's
+    # measuring by itself
+    def due_ms(self):
+        if self.mode != CYCLED or self._state != _IDLE:
+            return None
+        return max(0, time.ticks_diff(self._next, time.ticks_ms()))
+
+    # Whether the sensor is idle, so nothing needs to happen until due_ms()
+    def idle(self):
+        return self._state == _IDLE
+
+    # Call regularly from the main loop: wakes the sensor up when a CYCLED
+    # reading is due
+    def poll(self):
+        now = self._account()
+        if (self.mode == CYCLED and self._state == _IDLE and
+                time.ticks_diff(now, self._next) >= 0):
+            self._next = time.ticks_add(self._next, self.cycle * 1000)
+            if time.ticks_diff(now, self._next) >= 0:
+                self._next = time.ticks_add(now, self.cycle * 1000)
+            self._run(_RUNNING)
+
+    # Pick a mode for a given rate of change and distance from the nearest
+    # threshold
+    def _choose(self, rate, gap):
+        if rate >= FAST_RATE or gap <= NEAR:
+            return FAST
+        if rate >= SLOW_RATE or gap <= FAR:
+            return LOW
+        return CYCLED
+
+    # Call with each filtered reading and the current trend in ppm/min.
+    # Switches mode if needed and returns the mode we're now in.
+    def sampled(self, co2, slope):
+        now = self._account()
+        rate = abs(slope)
+        gap = min(abs(co2 - self.warning), abs(co2 - self.alarm))
+        mode = self._choose(rate, gap)
+        if mode < self.mode:
+            self.start(mode)
+        elif mode > self.mode:
+            # Only slow down once we've been well inside the slower mode's
+            # band for a while
+            mode = self._choose(rate * 3 / 2, gap * 2 / 3)
+            if mode <= self.mode:
+                self._calm_since = None
+            elif self._calm_since is None:
+                self._calm_since = now
+            elif time.ticks_diff(now, self._calm_since) >= self.hold:
+                self.start(mode)
+        else:
+            self._calm_since = None
+
+        # A duty-cycled reading is done, so back to sleep until the next one
+        if self.mode == CYCLED:
+            self._stop()
+        return self.mode
+
+    # Estimated average sensor current so far, in uA
+    def average_ua(self):
+        self._account()
+        total = sum(self.state_ms)
+        if total == 0:
+            return 0
+        return sum(ms * ua for (ms, ua) in zip(self.state_ms, CURRENT_UA)) // total
+
+    def report(self):
+        self._account()
+        total = max(1, sum(self.mode_ms))
+        for (name, ms) in zip(MODE_NAMES, self.mode_ms):
+            print("%-12s %7d s  %5.1f%%" % (name, ms // 1000, 100 * ms / total))
+        print("%d mode changes, estimated sensor current %.2f mA (%.2f mA if always periodic)" %
+              (self.switches, self.average_ua() / 1000, CURRENT_UA[_RUNNING] / 1000))
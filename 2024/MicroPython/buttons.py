@@ -0,0 +1,153 @@
+# Interrupt-driven buttons
+#
+# The badge main loop used to read each button's pin once per pass and
+# rewrite the petal to match, so a press only showed up at the next pass --
+# up to a second later -- and a quick press could come and go between two
+# passes without being seen at all.  Buttons instead watches the pins with
+# interrupts:
+#
+#   - each edge interrupts the CPU, and the handler debounces it: an edge
+#     within `debounce_ms` of the last one we took on that pin is contact
+#     bounce and ignored, as is one that leaves the pin where it was.  The
+#     handler doesn't allocate, so it can be a hard interrupt.
+#   - an edge ignored as bounce might really have been the last one -- a
+#     button let go within `debounce_ms` of being pressed -- so the pin is
+#     marked to be read again once the window is over.  get() and wait()
+#     do that, and take the level it's settled at as an edge if it changed.
+#   - a good edge is handed to the main context with micropython.schedule(),
+#     which adds it to a fixed ring of events along with when it happened.
+#     If the loop falls behind, new events are dropped (and counted).
+#   - the main loop takes events off the ring with get(), and can wait()
+#     until one arrives or it has something else to do, rather than polling.
+#
+# Typical use from a main loop:
+#
+#     buttons = Buttons((buttonA, buttonB, buttonC))
+#     event = [0, 0, 0]
+#     while True:
+#         while buttons.get(event):
+#             button, pressed, when = event
+#             ...
+#         buttons.wait(ms_until_something_else_is_due)
+
+import micropython
+from machine import Pin
+from array import array
+import time
+
+DEBOUNCE_MS = 20        # Edges closer together than this are bounce
+QUEUE_SIZE = 16         # Events waiting for the main loop
+WAIT_SLICE_MS = 10      # How often wait() looks for new events
+
+class Buttons:
+    # pins are pulled up, so a pressed button reads 0.  Buttons are numbered
+    # by their place in pins.
+    def __init__(self, pins, debounce_ms=DEBOUNCE_MS, size=QUEUE_SIZE):
+        self.pins = tuple(pins)
+        self.debounce_ms = debounce_ms
+        self.size = size
+        self.bounces = 0            # Edges ignored as bounce
+        self.dropped = 0            # Events lost to a full ring or schedule queue
+        self._level = array("B", [1] * len(self.pins))     # Last level we took
+        self._edge = array("i", [0] * len(self.pins))      # ticks_ms we took it
+        self._bounced = array("i", [0] * len(self.pins))   # ticks_ms of the last edge ignored
+        self._recheck = array("B", [0] * len(self.pins))   # 1 to read again after the window
+        self._events = array("B", [0] * size)      # button << 1 | pressed
+        self._times = array("i", [0] * size)       # ticks_ms of each event
+        self._head = 0
+        self._count = 0
+        # Bound methods allocate, so make the one we schedule up front
+        self._queue_ref = self._queue
+        for pin in self.pins:
+            pin.irq(handler=self._irq, trigger=Pin.IRQ_FALLING | Pin.IRQ_RISING, hard=True)
+
+    # Interrupt context: debounce and pass the edge on
+    def _irq(self, pin):
+        i = 0
+        while self.pins[i] is not pin:
+            i += 1
+        now = time.ticks_ms()
+        level = pin.value()
+        if time.ticks_diff(now, self._edge[i]) < self.debounce_ms:
+            self.bounces += 1
+            self._bounced[i] = now
+            self._recheck[i] = 1
+            return
+        if level == self._level[i]:
+            self.bounces += 1
+            return
+        self._level[i] = level
+        self._edge[i] = now
+        try:
+            micropython.schedule(self._queue_ref, (i << 1) | (1 - level))
+        except RuntimeError:
+            self.dropped += 1
+
+    # Main context: read again any pin that had edges ignored as bounce,
+    # once its debounce window is over, and queue an event if it ended up
+    # somewhere other than the last level we took.  The event is stamped
+    # with the last ignored edge, when it got there, and goes through
+    # micropython.schedule() like any other so _queue() never runs twice
+    # at once.  We clear the mark before reading the pin, so an edge after
+    # that marks it again.
+    def _settle(self):
+        now = time.ticks_ms()
+        for i in range(len(self.pins)):
+            if not self._recheck[i] or time.ticks_diff(now, self._edge[i]) < self.debounce_ms:
+                continue
+            self._recheck[i] = 0
+            level = self.pins[i].value()
+            if level != self._level[i]:
+                self._level[i] = level
+                self._edge[i] = self._bounced[i]
+                try:
+                    micropython.schedule(self._queue_ref, (i << 1) | (1 - level))
+                except RuntimeError:
+                    self.dropped += 1
+
+    # Main context: add an event to the ring.  It's stamped with the time of
+    # the button's latest edge, which is this one unless another has come
+    # in since.
+    def _queue(self, event):
+        if self._count == self.size:
+            self.dropped += 1
+            return
+        slot = (self._head + self._count) % self.size
+        self._events[slot] = event
+        self._times[slot] = self._edge[event >> 1]
+        self._count += 1
+
+    # Copy the oldest event into out as [button, pressed (1) or released
+    # (0), ticks_ms].  Returns False if there wasn't one.
+    def get(self, out):
+        self._settle()
+        if self._count == 0:
+            return False
+        event = self._events[self._head]
+        out[0] = event >> 1
+        out[1] = event & 1
+        out[2] = self._times[self._head]
+        self._head = (self._head + 1) % self.size
+        self._count -= 1
+        return True
+
+    def __len__(self):
+        return self._count
+
+    # Whether button i is down, as of the last edge we took
+    def pressed(self, i):
+        return self._level[i] == 0
+
+    # Wait up to ms for an event.  Scheduled callbacks run while we sleep,
+    # so we only have to look at the ring (and any pins to read again)
+    # between short sleeps.
+    def wait(self, ms):
+        end = time.ticks_add(time.ticks_ms(), ms)
+        while True:
+            self._settle()
+            if self._count:
+                break
+            left = time.ticks_diff(end, time.ticks_ms())
+            if left <= 0:
+                break
+            time.sleep_ms(min(left, WAIT_SLICE_MS))
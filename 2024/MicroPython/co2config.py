@@ -0,0 +1,158 @@
+# Configuration loader for the CO2 SAO add-on
+#
+# Settings live in co2sao.json so they can be changed without touching code.
+# Parsing JSON on every boot is slow on the badge though, and a typo in the
+# file used to be silently ignored, so loading now works like this:
+#
+# 1. The first time (or whenever co2sao.json changes) the JSON is parsed and
+#    every setting is checked against SCHEMA below.  Any problem raises a
+#    ValueError that says exactly what's wrong.
+# 2. The validated settings are packed into a small binary file, co2sao.bin,
+#    along with the size and modification time of the JSON file they came
+#    from and a signature of the schema.
+# 3. Later boots just unpack co2sao.bin, which is a single struct.unpack.  If
+#    it's missing, or the JSON file or schema has changed since it was
+#    written, we go back to step 1.
+
+import json
+import os
+import struct
+try:
+    import binascii
+except ImportError:
+    import ubinascii as binascii
+
+CONFIG_FILE = "co2sao.json"
+CACHE_FILE = "co2sao.bin"
+
+# Every setting we understand: (name, type, default, minimum, maximum).
+# For str settings the minimum is instead the tuple of allowed choices.
+SCHEMA = (
+    ("sampleDelay",  int,   40,   5,   3600),
+    ("altitude",     int,   275,  0,   9000),
+    ("co2Warning",   int,   800,  400, 10000),
+    ("co2Alarm",     int,   1000, 400, 10000),
+    ("tempOffsetC",  float, 0.0,  0.0, 20.0),
+    ("stoplightLSB", int,   7,    0,   29),
+    ("stoplightMSB", int,   6,    0,   29),
+    ("badgePort",    int,   1,    1,   6),
+    ("brightness",   int,   100,  1,   100),
+    ("filter",       str,   "median", ("none", "median", "hampel"), None),
+    ("filterWindow", int,   5,    1,   15),
+    ("hampelK",      float, 3.0,  1.0, 10.0),
+    ("hysteresis",   int,   25,   0,   200),
+    ("trendWindow",  int,   600,  60,  900),
+    ("prewarnSeconds", int, 300,  0,   3600),
+    ("sampling",     str,   "fixed", ("fixed", "adaptive"), None),
+    ("cyclePeriod",  int,   120,  30,  3600),
+    ("pressureDeadband", float, 2.0, 0.0, 50.0),
+    ("pressureMaxAge", int, 3600, 60,  86400),
+    ("recordTrace",  int,   0,    0,   1),
+    ("historyKB",    int,   32,   0,   128),
+)
+
+# Header: magic, JSON file size, JSON file mtime, schema signature
+_MAGIC = b"CO2C"
+_HEADER = ">4sIII"
+_VALUES = ">" + "".join({int: "i", float: "f", str: "B"}[t] for (n, t, d, lo, hi) in SCHEMA)
+_SIGNATURE = binascii.crc32(("%s%s" % (_VALUES, ",".join(n for (n, t, d, lo, hi) in SCHEMA))).encode()) & 0xFFFFFFFF
+
+class Config:
+    def __init__(self, values):
+        for (entry, value) in zip(SCHEMA, values):
+            setattr(self, entry[0], value)
+
+    def values(self):
+        return tuple(getattr(self, entry[0]) for entry in SCHEMA)
+
+    # Values as stored in the compiled cache, with choices as indexes
+    def packed(self):
+        return tuple(entry[3].index(value) if entry[1] is str else value
+                     for (entry, value) in zip(SCHEMA, self.values()))
+
+    @staticmethod
+    def unpacked(values):
+        return Config([entry[3][value] if entry[1] is str else value
+                       for (entry, value) in zip(SCHEMA, values)])
+
+# Default settings, for when there's no usable config file at all
+def defaults():
+    return Config([entry[2] for entry in SCHEMA])
+
+# Check parsed JSON against the schema.  Returns a Config or raises
+# ValueError listing every problem found.
+def validate(data):
+    if not isinstance(data, dict):
+        raise ValueError("config must be a JSON object")
+    problems = []
+    values = []
+    for (name, kind, default, lo, hi) in SCHEMA:
+        value = data.get(name, default)
+        if kind is float and isinstance(value, int) and not isinstance(value, bool):
+            value = float(value)
+        if kind is str:
+            if value not in lo:
+                problems.append("%s should be one of %s" % (name, ", ".join(lo)))
+        elif not isinstance(value, kind) or isinstance(value, bool):
+            problems.append("%s should be %s" % (name, "a number" if kind is float else "an integer"))
+        elif value < lo or value > hi:
+            problems.append("%s = %s is outside %s..%s" % (name, value, lo, hi))
+        values.append(value)
+    known = [entry[0] for entry in SCHEMA]
+    for name in data:
+        if not name.startswith("_") and name not in known:
+            problems.append("unknown setting %s" % name)
+    if not problems:
+        config = Config(values)
+        if config.co2Warning >= config.co2Alarm:
+            problems.append("co2Warning must be below co2Alarm")
+        if config.stoplightLSB == config.stoplightMSB:
+            problems.append("stoplightLSB and stoplightMSB must be different pins")
+    if problems:
+        raise ValueError("%s: %s" % (CONFIG_FILE, "; ".join(problems)))
+    return config
+
+# Size and modification time identify which version of the JSON file a
+# cached blob was built from
+def _stamp(path):
+    st = os.stat(path)
+    return (st[6], int(st[8]) & 0xFFFFFFFF)
+
+def _load_cache(cache, stamp):
+    try:
+        with open(cache, "rb") as f:
+            blob = f.read()
+    except OSError:
+        return None
+    hsize = struct.calcsize(_HEADER)
+    if len(blob) != hsize + struct.calcsize(_VALUES):
+        return None
+    magic, size, mtime, signature = struct.unpack_from(_HEADER, blob, 0)
+    if magic != _MAGIC or (size, mtime) != stamp or signature != _SIGNATURE:
+        return None
+    try:
+        return Config.unpacked(struct.unpack_from(_VALUES, blob, hsize))
+    except IndexError:
+        return None
+
+def _save_cache(cache, stamp, config):
+    try:
+        with open(cache, "wb") as f:
+            f.write(struct.pack(_HEADER, _MAGIC, stamp[0], stamp[1], _SIGNATURE))
+            f.write(struct.pack(_VALUES, *config.packed()))
+    except OSError:
+        pass        # Read-only filesystem, we'll just parse again next boot
+
+# Load the add-on configuration, from the compiled cache if it's current and
+# from the JSON file otherwise.  Raises OSError if there's no config file and
+# ValueError if it doesn't parse or validate.
+def load(path=CONFIG_FILE, cache=CACHE_FILE):
+    stamp = _stamp(path)
+    config = _load_cache(cache, stamp)
+    if config is not None:
+        return config
+    with open(path) as f:
+        data = json.load(f)
+    config = validate(data)
+    _save_cache(cache, stamp, config)
+    return config
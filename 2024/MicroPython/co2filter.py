@@ -0,0 +1,145 @@
+# Streaming outlier filters for CO2 readings
+#
+# A single noisy SCD40 reading -- or someone breathing on the badge -- used
+# to flip the stoplight to red, only for the next reading to flip it back.
+# These filters sit between the sensor and co2status() and knock out that
+# kind of one-off spike while still following real changes within a few
+# samples.
+#
+# Both filters keep the last N readings in preallocated arrays: once in
+# arrival order (so we know which reading to drop next) and once in sorted
+# order (so the median is just the middle element).  Each new reading costs
+# two binary searches plus a short move of the elements above it, and no
+# memory is allocated after construction.
+#
+# MedianFilter reports the median of the window, which removes any spike
+# shorter than half the window.
+#
+# HampelFilter passes readings through unchanged unless they're further than
+# k scaled median absolute deviations (MAD) from the window's median, in
+# which case the median is reported instead.  That keeps genuine step
+# changes sharp while still rejecting outliers.  Finding the MAD walks
+# outwards from the middle of the sorted window, which is linear in the
+# window size but still allocation-free.
+
+from array import array
+
+NONE = "none"
+MEDIAN = "median"
+HAMPEL = "hampel"
+
+class MedianFilter:
+    def __init__(self, size=5):
+        self.size = size
+        self._ring = array("i", [0] * size)      # Arrival order
+        self._sorted = array("i", [0] * size)    # Sorted order
+        self._count = 0
+        self._next = 0
+        self.value = 0
+
+    # Index of the first sorted element >= value
+    def _search(self, value):
+        lo = 0
+        hi = self._count
+        s = self._sorted
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            if s[mid] < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _insert(self, value):
+        s = self._sorted
+        pos = self._search(value)
+        i = self._count
+        while i > pos:
+            s[i] = s[i - 1]
+            i -= 1
+        s[pos] = value
+        self._count += 1
+
+    def _remove(self, value):
+        s = self._sorted
+        i = self._search(value)
+        self._count -= 1
+        while i < self._count:
+            s[i] = s[i + 1]
+            i += 1
+
+    def median(self):
+        n = self._count
+        if n == 0:
+            return 0
+        if n & 1:
+            return self._sorted[n >> 1]
+        return (self._sorted[(n >> 1) - 1] + self._sorted[n >> 1]) >> 1
+
+    # Add the latest reading to the window and return the filtered value
+    def add(self, value):
+        value = int(value)
+        if self._count == self.size:
+            self._remove(self._ring[self._next])
+        self._insert(value)
+        self._ring[self._next] = value
+        self._next += 1
+        if self._next == self.size:
+            self._next = 0
+        self.value = self.median()
+        return self.value
+
+    def clear(self):
+        self._count = 0
+        self._next = 0
+        self.value = 0
+
+class HampelFilter(MedianFilter):
+    # 1.4826 scales the MAD to match a standard deviation for normal noise
+    def __init__(self, size=7, k=3.0):
+        super().__init__(size)
+        self.threshold = k * 1.4826
+        self.replaced = 0          # Readings replaced by the median
+
+    # Median absolute deviation of the window from its median.  The sorted
+    # window's deviations grow outwards from the middle, so merging the two
+    # sides in order finds the middle deviation without sorting anything.
+    # An even window has two middle deviations, and the MAD is their mean
+    # (not rounded down like median(), which could make it 0 and have every
+    # reading off the median replaced).
+    def mad(self, med):
+        s = self._sorted
+        n = self._count
+        left = self._search(med) - 1
+        right = left + 1
+        want = n >> 1
+        dev = 0
+        for _ in range(want + 1):
+            below = dev
+            if right >= n or (left >= 0 and med - s[left] <= s[right] - med):
+                dev = med - s[left]
+                left -= 1
+            else:
+                dev = s[right] - med
+                right += 1
+        if n & 1:
+            return dev
+        return (below + dev) / 2
+
+    def add(self, value):
+        value = int(value)
+        med = MedianFilter.add(self, value)
+        if self._count >= 3 and abs(value - med) > self.threshold * self.mad(med):
+            self.replaced += 1
+            self.value = med
+            return med
+        self.value = value
+        return value
+
+# Build the filter named in the configuration, or None for no filtering
+def make(kind, size=5, k=3.0):
+    if kind == MEDIAN:
+        return MedianFilter(size)
+    if kind == HAMPEL:
+        return HampelFilter(size, k)
+    return None
@@ -0,0 +1,163 @@
+# Run the sensor side of the badge on the RP2040's second core
+#
+# Everything the badge does normally runs inline in one loop on core0, so a
+# slow step anywhere -- a 500 ms SCD4X stop command, a Wi-Fi scan, a dweet
+# round trip -- stalls the petal, touchwheel and buttons along with it.  The
+# RP2040 has a second core that nothing uses.  start() below runs the sensor
+# side (add-on updates, which read, filter and log the sensor, and the radio
+# manager's uploads) in a loop on core1 with _thread, leaving core0 free to
+# keep the UI on a steady tick.
+#
+# The two sides share:
+#
+#   - SampleRing, a single-producer/single-consumer ring of readings from
+#     core1 to core0, preallocated and guarded by a lock.  If core0 falls
+#     behind, new readings are dropped (and counted) rather than blocking
+#     the sensor side.
+#   - LockedI2C, for when an add-on and the UI's SAOs are on the same I2C
+#     bus: each transfer holds the bus lock, so the two cores can't talk
+#     over each other.  Command delays happen outside the lock.
+#   - energy.meter and loopstats.monitor, which both sides report to and
+#     which each hold their own lock while updating or reading their totals.
+#
+# CPython has _thread too, so all of this runs unchanged on Linux.
+#
+# Typical use from the badge main loop:
+#
+#     ring = dualcore.SampleRing(16)
+#     co2sao.setSampleRing(ring)
+#     dualcore.start((co2sao.update,), co2sao.idleMs)
+#     while True:
+#         ...UI...
+#         while ring.get(reading):
+#             ...show reading...
+
+import _thread
+from array import array
+import time
+
+MAX_WAIT_MS = 1000      # Longest core1 sleeps before looking again
+
+class SampleRing:
+    def __init__(self, capacity=16, width=3):
+        self.capacity = capacity
+        self.width = width
+        self.dropped = 0
+        self._data = array("f", [0.0] * (capacity * width))
+        self._head = 0          # Next slot to write, only moved by the producer
+        self._tail = 0          # Next slot to read, only moved by the consumer
+        self._count = 0
+        self._lock = _thread.allocate_lock()
+
+    # Producer side: add a reading.  Returns False if the ring was full and
+    # the reading was dropped.
+    def put(self, *values):
+        self._lock.acquire()
+        try:
+            if self._count == self.capacity:
+                self.dropped += 1
+                return False
+            base = self._head * self.width
+            for i in range(self.width):
+                self._data[base + i] = values[i]
+            self._head = (self._head + 1) % self.capacity
+            self._count += 1
+            return True
+        finally:
+            self._lock.release()
+
+    # Consumer side: copy the oldest reading into out (a list or array of
+    # at least width items).  Returns False if there wasn't one.
+    def get(self, out):
+        self._lock.acquire()
+        try:
+            if self._count == 0:
+                return False
+            base = self._tail * self.width
+            for i in range(self.width):
+                out[i] = self._data[base + i]
+            self._tail = (self._tail + 1) % self.capacity
+            self._count -= 1
+            return True
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return self._count
+
+class LockedI2C:
+    # An I2C bus shared between the cores.  Anything we don't wrap goes
+    # straight to the bus.
+    def __init__(self, i2c, lock=None):
+        self.i2c = i2c
+        self.lock = lock if lock is not None else _thread.allocate_lock()
+
+    def __getattr__(self, name):
+        return getattr(self.i2c, name)
+
+    def _locked(self, fn, *args):
+        self.lock.acquire()
+        try:
+            return fn(*args)
+        finally:
+            self.lock.release()
+
+    def scan(self):
+        return self._locked(self.i2c.scan)
+
+    def writeto(self, addr, buf, stop=True):
+        return self._locked(self.i2c.writeto, addr, buf, stop)
+
+    def readfrom_into(self, addr, buf, stop=True):
+        return self._locked(self.i2c.readfrom_into, addr, buf, stop)
+
+    def readfrom(self, addr, nbytes, stop=True):
+        return self._locked(self.i2c.readfrom, addr, nbytes, stop)
+
+    def writeto_mem(self, addr, memaddr, buf, addrsize=8):
+        return self._locked(self.i2c.writeto_mem, addr, memaddr, buf)
+
+    def readfrom_mem_into(self, addr, memaddr, buf, addrsize=8):
+        return self._locked(self.i2c.readfrom_mem_into, addr, memaddr, buf)
+
+    def readfrom_mem(self, addr, memaddr, nbytes, addrsize=8):
+        return self._locked(self.i2c.readfrom_mem, addr, memaddr, nbytes)
+
+# Whether the core1 loop should keep going, and whether it's running
+_run = False
+running = False
+passes = 0
+
+def _core1(tasks, idle_ms):
+    global running, passes
+    running = True
+    try:
+        while _run:
+            for task in tasks:
+                task()
+            passes += 1
+            wait = MAX_WAIT_MS
+            if idle_ms is not None:
+                wait = max(1, min(idle_ms(), MAX_WAIT_MS))
+            time.sleep_ms(wait)
+    finally:
+        running = False
+
+# Start calling each of tasks in turn on core1, then sleeping for
+# idle_ms() ms (at most MAX_WAIT_MS), until stop() is called
+def start(tasks, idle_ms=None):
+    global _run, running
+    _run = True
+    running = True
+    _thread.start_new_thread(_core1, (tuple(tasks), idle_ms))
+
+# Ask the core1 loop to finish its current pass and stop.  Waits up to
+# timeout_ms for it to do so and returns whether it did.
+def stop(timeout_ms=5000):
+    global _run
+    _run = False
+    waited = 0
+    while running and waited < timeout_ms:
+        time.sleep_ms(10)
+        waited += 10
+    return not running
@@ -0,0 +1,211 @@
+# Energy accounting for the badge and the CO2 add-on
+#
+# The sensor driver, the stoplight driver, the Wi-Fi code and the main loop
+# each tell the meter below whenever they change state (sensor measurement
+# mode, which LED is lit and how bright, radio up/down, CPU busy or idle).
+# The meter charges the time spent in each state against a table of typical
+# supply currents, so we get a running estimate of where the battery goes:
+# average current (which is also mAh per hour) and mAh per CO2 sample, in
+# total and per component.
+#
+# The currents are typical figures at 3.3 V from the datasheets, or rough
+# bench numbers where there's no datasheet (the stoplight LEDs).  They're
+# good for comparing configurations with each other, not for predicting
+# battery life to the minute.  Change CURRENT_UA to match your hardware.
+#
+# Like Measure, the meter only keeps running totals, in arrays allocated up
+# front, so reporting a state change never allocates.  Time is kept as whole
+# seconds plus leftover milliseconds and charge as whole mA-seconds plus
+# leftover uA-milliseconds, which keeps every total a small integer for
+# years of running.
+#
+# In dual-core mode (dualcore.py) the sensor side reports from core1 while
+# the UI loop reports the CPU's state from core0, and bringing the totals up
+# to date touches every component's, so each call that changes or reads the
+# totals holds the meter's lock.  Nobody else holds it, so on one core
+# taking it costs next to nothing.
+#
+# Drivers report into the shared `meter` instance:
+#
+#     import energy
+#     energy.meter.state(energy.RADIO, energy.RADIO_CONNECTING)
+
+import _thread
+from array import array
+import time
+
+# Components
+CPU = 0
+SENSOR = 1
+LED = 2
+RADIO = 3
+COMPONENTS = ("cpu", "sensor", "led", "radio")
+
+# CPU states
+CPU_ACTIVE = 0      # Running code
+CPU_IDLE = 1        # In time.sleep(), still fully clocked
+CPU_LIGHTSLEEP = 2  # machine.lightsleep()
+CPU_DEEPSLEEP = 3   # machine.deepsleep()
+
+# SCD4X states, same order as the sensor's own modes
+SENSOR_IDLE = 0
+SENSOR_PERIODIC = 1
+SENSOR_LOW_POWER = 2
+
+# Stoplight states are the status codes themselves (OFF, GREEN, RED, YELLOW)
+
+# Radio states
+RADIO_OFF = 0
+RADIO_CONNECTING = 1    # Powered up, scanning/associating
+RADIO_ACTIVE = 2        # Associated at full power
+RADIO_POWERSAVE = 3     # Associated in CYW43 power-save mode
+
+STATE_NAMES = (
+    ("active", "idle", "lightsleep", "deepsleep"),
+    ("idle", "periodic", "low power"),
+    ("off", "green", "red", "yellow"),
+    ("off", "connecting", "active", "powersave"),
+)
+
+# Typical supply current in each state, in uA
+CURRENT_UA = (
+    (25000, 18000, 1300, 800),      # RP2040 at 125 MHz (RP2040 datasheet 5.1)
+    (200, 15000, 3200),             # SCD4X (datasheet table 3)
+    (0, 5000, 5000, 5000),          # Stoplight, one LED lit at full brightness
+    (0, 60000, 45000, 2000),        # CYW43439, average in each state
+)
+
+_SLOTS = 4      # Most states any component has
+
+class Meter:
+    def __init__(self, currents=CURRENT_UA):
+        n = len(COMPONENTS)
+        self.currents = currents
+        self.samples = 0
+        self._state = array("i", [0] * n)
+        self._ua = array("i", [currents[c][0] for c in range(n)])
+        self._since = array("i", [0] * n)
+        self._sec = array("i", [0] * (n * _SLOTS))      # Time in each state
+        self._ms = array("i", [0] * (n * _SLOTS))
+        self._mas = array("i", [0] * n)                 # Charge, mA-seconds
+        self._uams = array("i", [0] * n)                # Leftover uA-ms
+        self._lock = _thread.allocate_lock()
+        self.clear()
+
+    # Charge component c for the time since its last change, at its
+    # current state and draw
+    def _charge(self, c, now):
+        elapsed = time.ticks_diff(now, self._since[c])
+        self._since[c] = now
+        if elapsed <= 0:
+            return
+        i = c * _SLOTS + self._state[c]
+        ms = self._ms[i] + elapsed
+        self._sec[i] += ms // 1000
+        self._ms[i] = ms % 1000
+        # The draw times the whole elapsed ms outgrows a small int after a
+        # minute or so at mA currents, so we take whole seconds at whole mA
+        # and the uA left over separately: every product here stays a small
+        # integer for as long as ticks_diff() can measure
+        ua = self._ua[c]
+        seconds = elapsed // 1000
+        uas = (ua % 1000) * seconds                     # uA-s from the leftover uA
+        uams = self._uams[c] + (uas % 1000) * 1000 + ua * (elapsed % 1000)
+        self._mas[c] += (ua // 1000) * seconds + uas // 1000 + uams // 1000000
+        self._uams[c] = uams % 1000000
+
+    # Record that component c is now in the given state.  percent scales
+    # the state's current, e.g. for PWM-dimmed LEDs.
+    def state(self, c, state, percent=100):
+        with self._lock:
+            self._charge(c, time.ticks_ms())
+            self._state[c] = state
+            self._ua[c] = self.currents[c][state] * percent // 100
+
+    def current(self, c):
+        return self._state[c]
+
+    # Count one CO2 sample, for the per-sample figures
+    def sample(self):
+        with self._lock:
+            self.samples += 1
+
+    # Bring every component's totals up to date.  Call with the lock held.
+    def _settle(self):
+        now = time.ticks_ms()
+        for c in range(len(COMPONENTS)):
+            self._charge(c, now)
+
+    # Seconds since the meter started (or was cleared).  The CPU is always
+    # in exactly one of its states, so that's the time in all of them --
+    # which, unlike a ticks_diff() from the start, stays right past the
+    # 2**29 ms ticks_diff() can measure.
+    def elapsed(self):
+        with self._lock:
+            self._settle()
+            base = CPU * _SLOTS
+            return sum(self._sec[base + s] + self._ms[base + s] / 1000
+                       for s in range(len(STATE_NAMES[CPU])))
+
+    # Charge used so far, in mAh, for one component or all of them
+    def mah(self, c=None):
+        with self._lock:
+            self._settle()
+            if c is None:
+                return sum(self._mas[i] + self._uams[i] / 1000000
+                           for i in range(len(COMPONENTS))) / 3600
+            return (self._mas[c] + self._uams[c] / 1000000) / 3600
+
+    # Average current in mA, which is also mAh used per hour
+    def average_ma(self, c=None):
+        seconds = self.elapsed()
+        if seconds <= 0:
+            return 0.0
+        return self.mah(c) * 3600 / seconds
+
+    def mah_per_sample(self, c=None):
+        if self.samples == 0:
+            return 0.0
+        return self.mah(c) / self.samples
+
+    # Seconds spent in each state of component c
+    def seconds(self, c):
+        with self._lock:
+            self._settle()
+            base = c * _SLOTS
+            return [self._sec[base + s] + self._ms[base + s] / 1000
+                    for s in range(len(STATE_NAMES[c]))]
+
+    def report(self):
+        total = max(self.elapsed(), 0.001)
+        print("Energy over %d s: %.3f mAh, %.2f mA average, %.4f mAh per sample (%d samples)" %
+              (total, self.mah(), self.average_ma(), self.mah_per_sample(), self.samples))
+        for (c, name) in enumerate(COMPONENTS):
+            split = ", ".join("%s %.0f%%" % (state, 100 * s / total)
+                              for (state, s) in zip(STATE_NAMES[c], self.seconds(c)) if s)
+            print("  %-6s %8.3f mAh %7.2f mA  (%s)" % (name, self.mah(c), self.average_ma(c), split))
+
+    # Totals for posting alongside the readings
+    def telemetry(self):
+        return {
+            'mA': round(self.average_ma(), 2),
+            'mAh': round(self.mah(), 3),
+            'mAhPerSample': round(self.mah_per_sample(), 5),
+            'sensorMA': round(self.average_ma(SENSOR), 2),
+            'radioMA': round(self.average_ma(RADIO), 2),
+        }
+
+    # Start counting again from now, keeping every component's state
+    def clear(self):
+        with self._lock:
+            now = time.ticks_ms()
+            self.samples = 0
+            for c in range(len(COMPONENTS)):
+                self._since[c] = now
+                self._mas[c] = 0
+                self._uams[c] = 0
+            for i in range(len(self._sec)):
+                self._sec[i] = 0
+                self._ms[i] = 0
+
+meter = Meter()
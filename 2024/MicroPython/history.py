@@ -0,0 +1,262 @@
+# Compressed in-RAM history of readings
+#
+# Measure keeps running statistics, but not the readings themselves.  At
+# the 5 second periodic cadence a day is 17280 readings, which as floats or
+# tuples would take megabytes -- far more than the Pico W has.  History
+# keeps them in a preallocated bytearray ring instead, about a byte and a
+# half each:
+#
+#   - values are stored as whole numbers: CO2 in ppm, temperature and
+#     humidity in tenths (TEMP_SCALE, RH_SCALE)
+#   - each reading is stored as the change from the one before, zig-zag
+#     encoded so small negative changes are small numbers too
+#   - timestamps (whole seconds) are stored as the change in the interval
+#     between readings, which at a steady cadence is always 0
+#   - the changes are written as variable-length codes a bit at a time
+#     (Exp-Golomb codes, each field with its own typical size), not byte
+#     varints.  Sensor noise alone moves CO2 by 10 ppm or so a reading, so
+#     whole-byte varints would never get below 2 bytes a reading, and a day
+#     wouldn't fit in 32KB.
+#
+# The ring is split into BLOCK_BYTES blocks.  Each starts with its first
+# reading in full, followed by the codes for the rest, so a block can be
+# decoded on its own.  When the ring is full the oldest block is cleared
+# for reuse, which drops its readings in one go.  Iterating forward decodes
+# each block in turn; reversed() goes through the blocks newest first,
+# noting where each reading's codes start on the way through a block and
+# then taking the changes off again from its last reading.  Appending takes
+# the same time however full we are and never allocates.
+#
+#     history = History(32768)
+#     history.append(time.time(), co2, tempF, rh)
+#     for (t, co2, temp, rh) in reversed(history):
+#         ...
+
+from array import array
+
+HISTORY_BYTES = 32768
+BLOCK_BYTES = 256
+TEMP_SCALE = 10
+RH_SCALE = 10
+
+# Block header: readings in the block, then its first reading's time,
+# interval since the reading before, CO2, temperature and humidity
+_HEADER = 16
+_FIELDS = ((0, 2), (2, 4), (6, 4), (10, 2), (12, 2), (14, 2))
+
+# Exp-Golomb order for the interval, CO2, temperature and humidity codes,
+# to suit how much each one usually changes
+_ORDER = (0, 3, 0, 1)
+
+# Full readings are kept as time, interval, co2, temperature, humidity
+_T = 0
+_D = 1
+_CO2 = 2
+_TEMP = 3
+_RH = 4
+
+def _zz(n):
+    return n << 1 if n >= 0 else ((-n) << 1) - 1
+
+def _unzz(z):
+    return (z >> 1) ^ -(z & 1)
+
+def _bits(n):
+    length = 0
+    while n:
+        n >>= 1
+        length += 1
+    return length
+
+class History:
+    def __init__(self, size=HISTORY_BYTES):
+        self.blocks = size // BLOCK_BYTES
+        if self.blocks < 2:
+            raise ValueError("history needs at least %d bytes" % (2 * BLOCK_BYTES))
+        self.size = self.blocks * BLOCK_BYTES
+        self._buf = bytearray(self.size)
+        self._newest = array("i", [0] * 5)
+        self._delta = array("i", [0] * 4)      # Interval, co2, temp, rh changes
+        self._code = array("i", [0] * 4)       # The same, zig-zag encoded
+        self._at = 0                            # Bit where the last decode ended
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self.dropped = 0        # Readings pushed out to make room
+        self._first = 0         # Oldest block
+        self._used = 0          # Blocks in use
+        self._bit = 0           # Next free bit in the newest block
+        for i in range(5):
+            self._newest[i] = 0
+
+    def __len__(self):
+        return self.count
+
+    # Bytes holding readings so far
+    def bytes_used(self):
+        if self._used == 0:
+            return 0
+        return (self._used - 1) * BLOCK_BYTES + _HEADER + (self._bit + 7) // 8
+
+    # Add a reading taken at t seconds
+    def append(self, t, co2, temp, rh):
+        newest = self._newest
+        t = int(t)
+        co2 = round(co2)
+        temp = round(temp * TEMP_SCALE)
+        rh = round(rh * RH_SCALE)
+        d = t - newest[_T] if self.count else 0
+        code = self._code
+        code[0] = _zz(d - newest[_D])
+        code[1] = _zz(co2 - newest[_CO2])
+        code[2] = _zz(temp - newest[_TEMP])
+        code[3] = _zz(rh - newest[_RH])
+        length = 0
+        for i in range(4):
+            length += 2 * _bits((code[i] >> _ORDER[i]) + 1) - 1 + _ORDER[i]
+        newest[_T] = t
+        newest[_D] = d
+        newest[_CO2] = co2
+        newest[_TEMP] = temp
+        newest[_RH] = rh
+        self.count += 1
+
+        if self._used and self._bit + length <= (BLOCK_BYTES - _HEADER) * 8:
+            base = ((self._first + self._used - 1) % self.blocks) * BLOCK_BYTES
+            self._set(base, 0, self._get(base, 0) + 1)
+            for i in range(4):
+                self._write(base, code[i], _ORDER[i])
+            return
+
+        # Start a new block with this reading in full, making room if need be
+        if self._used == self.blocks:
+            base = self._first * BLOCK_BYTES
+            self.count -= self._get(base, 0)
+            self.dropped += self._get(base, 0)
+            self._first = (self._first + 1) % self.blocks
+            self._used -= 1
+        base = ((self._first + self._used) % self.blocks) * BLOCK_BYTES
+        for i in range(BLOCK_BYTES):
+            self._buf[base + i] = 0
+        self._set(base, 0, 1)
+        for i in range(5):
+            self._set(base, i + 1, newest[i])
+        self._used += 1
+        self._bit = 0
+
+    # Readings as (t, co2, temp, rh), oldest first
+    def __iter__(self):
+        for b in range(self._used):
+            base = ((self._first + b) % self.blocks) * BLOCK_BYTES
+            (t, d, co2, temp, rh) = (self._get(base, 1), self._get(base, 2), self._get(base, 3),
+                                     self._get(base, 4), self._get(base, 5))
+            bit = 0
+            for i in range(self._get(base, 0)):
+                if i > 0:
+                    bit = self._decode(base, bit)
+                    delta = self._delta
+                    d += delta[0]
+                    t += d
+                    co2 += delta[1]
+                    temp += delta[2]
+                    rh += delta[3]
+                yield (t, co2, temp / TEMP_SCALE, rh / RH_SCALE)
+
+    # Readings as (t, co2, temp, rh), newest first
+    def __reversed__(self):
+        starts = array("H", [0] * ((BLOCK_BYTES - _HEADER) * 8 // sum(k + 1 for k in _ORDER) + 1))
+        for b in range(self._used - 1, -1, -1):
+            base = ((self._first + b) % self.blocks) * BLOCK_BYTES
+            (t, d, co2, temp, rh) = (self._get(base, 1), self._get(base, 2), self._get(base, 3),
+                                     self._get(base, 4), self._get(base, 5))
+            n = self._get(base, 0)
+            # Forward through the block to its last reading, noting where
+            # each reading's codes start
+            bit = 0
+            for i in range(1, n):
+                starts[i] = bit
+                bit = self._decode(base, bit)
+                delta = self._delta
+                d += delta[0]
+                t += d
+                co2 += delta[1]
+                temp += delta[2]
+                rh += delta[3]
+            # Then back again
+            for i in range(n - 1, -1, -1):
+                yield (t, co2, temp / TEMP_SCALE, rh / RH_SCALE)
+                if i > 0:
+                    self._decode(base, starts[i])
+                    delta = self._delta
+                    t -= d
+                    d -= delta[0]
+                    co2 -= delta[1]
+                    temp -= delta[2]
+                    rh -= delta[3]
+
+    # Time from the oldest reading to the newest, in seconds
+    def span(self):
+        if self.count == 0:
+            return 0
+        return self._newest[_T] - self._get(self._first * BLOCK_BYTES, 1)
+
+    # Header field i of the block at base, as a signed number
+    def _get(self, base, i):
+        (offset, size) = _FIELDS[i]
+        value = 0
+        for j in range(size):
+            value = (value << 8) | self._buf[base + offset + j]
+        if value >= 1 << (8 * size - 1):
+            value -= 1 << (8 * size)
+        return value
+
+    def _set(self, base, i, value):
+        (offset, size) = _FIELDS[i]
+        for j in range(size - 1, -1, -1):
+            self._buf[base + offset + j] = value & 0xFF
+            value >>= 8
+
+    # Write value as an order k Exp-Golomb code at the end of the block at
+    # base: (value >> k) + 1 in binary, after one 0 for each bit past the
+    # first, then the low k bits of value
+    def _write(self, base, value, k):
+        q = (value >> k) + 1
+        n = _bits(q)
+        self._bit += n - 1
+        self._put(base, q, n)
+        self._put(base, value & ((1 << k) - 1), k)
+
+    def _put(self, base, value, n):
+        buf = self._buf
+        base += _HEADER
+        bit = self._bit
+        for i in range(n - 1, -1, -1):
+            if (value >> i) & 1:
+                buf[base + (bit >> 3)] |= 0x80 >> (bit & 7)
+            bit += 1
+        self._bit = bit
+
+    # Read an order k Exp-Golomb code starting at bit of the block at base.
+    # Leaves where it ended in _at.
+    def _read(self, base, bit, k):
+        buf = self._buf
+        base += _HEADER
+        zeros = 0
+        while not buf[base + (bit >> 3)] & (0x80 >> (bit & 7)):
+            zeros += 1
+            bit += 1
+        value = 0
+        for i in range(zeros + 1 + k):
+            value = (value << 1) | ((buf[base + (bit >> 3)] >> (7 - (bit & 7))) & 1)
+            bit += 1
+        self._at = bit
+        return value - (1 << k)
+
+    # Decode one reading's changes at bit into _delta, returning where the
+    # next reading starts
+    def _decode(self, base, bit):
+        for i in range(4):
+            self._delta[i] = _unzz(self._read(base, bit, _ORDER[i]))
+            bit = self._at
+        return bit
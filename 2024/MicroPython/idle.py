@@ -0,0 +1,179 @@
+# Low-power idle between sensor samples
+#
+# The main loops used to wait with time.sleep(), which keeps the RP2040
+# fully clocked the whole time even though nothing happens until the next
+# sensor reading.  Idle.sleep() waits in the lowest-power way the current
+# situation allows:
+#
+#   SLEEP  plain time.sleep_ms(), as before
+#   LIGHT  machine.lightsleep(): clocks stopped, RAM and GPIO levels kept,
+#          so the stoplight stays lit and we carry on where we left off.
+#          PWM stops though, so dimmed LEDs rule it out, and USB serial
+#          doesn't survive it, so use SLEEP while working at the REPL.
+#   DEEP   machine.deepsleep() when nothing needs to keep running (the
+#          sensor is idle between duty-cycled readings and the radio is
+#          down), lightsleep otherwise.  On wake the badge resets, so the
+#          LEDs go dark while asleep and RAM is lost.
+#
+# Before a deep sleep every registered add-on is asked for its state as a
+# few bytes (Measure aggregates, the LED status, queued uploads, ...) and
+# those are written to a small file along with our own statistics.  On the
+# next boot resume() hands them back so init code can pick up seamlessly,
+# and deletes the file so a later power-on starts fresh.  It only does that
+# if machine.reset_cause() says we woke from a deep sleep -- which the rp2
+# port, waking by watchdog, reports as WDT_RESET -- so a badge switched off
+# and on again mid-sleep doesn't pick up stale state either.
+#
+# We also record how much sleep each idle period actually got compared to
+# what was asked for, since lightsleep can end early on an interrupt.
+
+import machine
+import os
+import struct
+import time
+import energy
+
+SLEEP = "sleep"
+LIGHT = "light"
+DEEP = "deep"
+KINDS = (SLEEP, LIGHT, DEEP)
+
+STATE_FILE = "idle.bin"
+
+# Reset causes that mean we woke from deepsleep()
+WOKE = (getattr(machine, "DEEPSLEEP_RESET", machine.WDT_RESET), machine.WDT_RESET)
+
+MIN_LIGHTSLEEP_MS = 50      # Not worth stopping the clocks for less
+MIN_DEEPSLEEP_MS = 5000     # Waking from deep sleep means a full reboot
+EARLY_MS = 10               # Waking this much early counts as early
+
+# Header: magic, requested ms, time.time() when we went to sleep, then
+# periods, requested and slept ms for each kind, and early wakes
+_MAGIC = b"IDLE"
+_HEADER = ">4sIi3I3I3II"
+
+class Idle:
+    def __init__(self, mode=LIGHT, statefile=STATE_FILE):
+        self.mode = mode
+        self.statefile = statefile
+        self.periods = [0, 0, 0]        # Idle periods of each kind
+        self.requested = [0, 0, 0]      # Time asked for, in ms
+        self.slept = [0, 0, 0]          # Time actually spent idle, in ms
+        self.early = 0                  # Periods that ended early
+        self.last_requested = 0
+        self.last_slept = 0
+        self._savers = []
+
+    # Ask for an add-on's state before each deep sleep.  save() returns
+    # bytes, which come back from resume() under the same name.
+    def register(self, name, save):
+        self._savers.append((name, save))
+
+    def _record(self, kind, requested, slept, tolerance=EARLY_MS):
+        self.periods[kind] += 1
+        self.requested[kind] += requested
+        self.slept[kind] += slept
+        if slept < requested - tolerance:
+            self.early += 1
+        self.last_requested = requested
+        self.last_slept = slept
+
+    # Wait for ms milliseconds.  light and deep say whether lightsleep and
+    # deepsleep are safe right now; we use the deepest the mode allows.
+    # Doesn't return if we deep sleep.
+    def sleep(self, ms, light=True, deep=False):
+        if ms <= 0:
+            return
+        if self.mode == DEEP and deep and ms >= MIN_DEEPSLEEP_MS:
+            self._deepsleep(ms)
+        start = time.ticks_ms()
+        if self.mode != SLEEP and light and ms >= MIN_LIGHTSLEEP_MS:
+            kind = 1
+            energy.meter.state(energy.CPU, energy.CPU_LIGHTSLEEP)
+            machine.lightsleep(ms)
+        else:
+            kind = 0
+            energy.meter.state(energy.CPU, energy.CPU_IDLE)
+            time.sleep_ms(ms)
+        energy.meter.state(energy.CPU, energy.CPU_ACTIVE)
+        self._record(kind, ms, time.ticks_diff(time.ticks_ms(), start))
+
+    def _deepsleep(self, ms):
+        header = struct.pack(_HEADER, _MAGIC, ms, int(time.time()),
+                             *[v & 0xFFFFFFFF for v in
+                               self.periods + self.requested + self.slept + [self.early]])
+        try:
+            with open(self.statefile, "wb") as f:
+                f.write(header)
+                for (name, save) in self._savers:
+                    data = save()
+                    f.write(struct.pack(">B", len(name)) + name.encode())
+                    f.write(struct.pack(">H", len(data)) + data)
+        except OSError as err:
+            # Without somewhere to keep our state a deep sleep would lose
+            # it, so settle for a light sleep
+            print("Can't save state for deep sleep:", err)
+            self.mode = LIGHT
+            return
+        energy.meter.state(energy.CPU, energy.CPU_DEEPSLEEP)
+        machine.deepsleep(ms)
+
+    # Call once at boot.  If we're waking from a deep sleep, returns a dict
+    # of each add-on's saved state by name; otherwise None.
+    def resume(self):
+        if machine.reset_cause() not in WOKE:
+            try:
+                os.remove(self.statefile)
+            except OSError:
+                pass
+            return None
+        try:
+            with open(self.statefile, "rb") as f:
+                blob = f.read()
+            os.remove(self.statefile)
+        except OSError:
+            return None
+        hsize = struct.calcsize(_HEADER)
+        if len(blob) < hsize or blob[:4] != _MAGIC:
+            return None
+        fields = struct.unpack_from(_HEADER, blob, 0)
+        requested = fields[1]
+        self.periods = list(fields[3:6])
+        self.requested = list(fields[6:9])
+        self.slept = list(fields[9:12])
+        self.early = fields[12]
+
+        # The RTC doesn't always survive the reset, so only trust it if the
+        # answer is plausible.  It only counts whole seconds.
+        slept = (int(time.time()) - fields[2]) * 1000
+        if slept < 0 or slept > 2 * requested + 60000:
+            slept = requested
+        self._record(2, requested, slept, 1000)
+
+        state = {}
+        pos = hsize
+        try:
+            while pos < len(blob):
+                n = blob[pos]
+                name = blob[pos + 1:pos + 1 + n].decode()
+                pos += 1 + n
+                size = struct.unpack_from(">H", blob, pos)[0]
+                state[name] = blob[pos + 2:pos + 2 + size]
+                pos += 2 + size
+        except (IndexError, ValueError):
+            pass        # Keep whatever we managed to read
+        return state
+
+    # Fraction of the requested idle time we actually got
+    def efficiency(self):
+        asked = sum(self.requested)
+        if asked == 0:
+            return 1.0
+        return sum(self.slept) / asked
+
+    def report(self):
+        print("Idle: %d periods (%s), asked for %d s, got %d s (%.1f%%), %d ended early" %
+              (sum(self.periods),
+               ", ".join("%s %d" % (k, n) for (k, n) in zip(KINDS, self.periods)),
+               sum(self.requested) // 1000, sum(self.slept) // 1000,
+               100 * self.efficiency(), self.early))
@@ -0,0 +1,179 @@
+# Main loop timing
+#
+# The badge main loops are meant to come round on a steady schedule, but
+# every add-on's update() runs inline -- I2C transfers, the sensor driver's
+# command delays, the odd upload -- so the loop can run late without us
+# ever knowing by how much.  The monitor below is told when each pass of the
+# loop starts and how long each add-on's update took, and keeps:
+#
+#   - the actual loop period, and how late each pass started compared with
+#     when it was due, as a histogram plus a count of missed deadlines
+#     (more than `slack_ms` late)
+#   - calls, total and worst time for each add-on's update, and how often
+#     it went over its budget.  The first overrun is flagged on the console.
+#
+# A pass is due `period_ms` after the previous one started, unless the loop
+# says otherwise with expect() just before it waits (for loops that idle for
+# however long suits them, like fauxbadge.py).
+#
+# Like the energy meter, everything lives in arrays allocated up front and
+# times are whole ms plus leftover us, so the bookkeeping never allocates.
+# And like it, the monitor has a lock: in dual-core mode (dualcore.py) the
+# UI loop on core0 updates the totals while the add-on on core1 reads them
+# for its telemetry.
+#
+# Main loops use the shared `monitor` instance:
+#
+#     import loopstats
+#     CO2 = loopstats.monitor.task("co2sao", 50)
+#     while True:
+#         loopstats.monitor.tick()
+#         started = loopstats.monitor.start()
+#         co2sao.update()
+#         loopstats.monitor.done(CO2, started)
+
+import _thread
+from array import array
+import time
+
+# Upper edges of the lateness histogram bins, in ms.  The first bin is for
+# passes that started on time (or early), the last for anything later than
+# the last edge.
+BINS_MS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+MAX_TASKS = 8       # Add-ons we can keep track of
+SLACK_MS = 5        # Later than this counts as a missed deadline
+
+class Monitor:
+    def __init__(self, period_ms=1000, slack_ms=SLACK_MS):
+        self.period_ms = period_ms
+        self.slack_ms = slack_ms
+        self.names = []
+        self._budget = array("i", [0] * MAX_TASKS)     # us
+        self._calls = array("i", [0] * MAX_TASKS)
+        self._ms = array("i", [0] * MAX_TASKS)         # Total time, ms
+        self._us = array("i", [0] * MAX_TASKS)         # Leftover us
+        self._worst = array("i", [0] * MAX_TASKS)      # us
+        self._over = array("i", [0] * MAX_TASKS)
+        self._hist = array("i", [0] * (len(BINS_MS) + 1))
+        self._lock = _thread.allocate_lock()
+        self.clear()
+
+    # Register an add-on's update with its time budget in ms.  Returns the
+    # handle to pass to done().
+    def task(self, name, budget_ms):
+        if name in self.names:
+            i = self.names.index(name)
+        elif len(self.names) < MAX_TASKS:
+            i = len(self.names)
+            self.names.append(name)
+        else:
+            raise ValueError("too many loop tasks")
+        self._budget[i] = budget_ms * 1000
+        return i
+
+    # Call at the top of every pass through the loop
+    def tick(self):
+        now = time.ticks_us()
+        with self._lock:
+            if self.passes > 0:
+                period = time.ticks_diff(now, self._last)
+                ms = self._period_us + period
+                self._period_ms += ms // 1000
+                self._period_us = ms % 1000
+                late = time.ticks_diff(now, self._due)
+                if late > self.worst_late:
+                    self.worst_late = late
+                if late > self.slack_ms * 1000:
+                    self.misses += 1
+                b = 0
+                while b < len(BINS_MS) and late > BINS_MS[b] * 1000:
+                    b += 1
+                self._hist[b] += 1
+            self.passes += 1
+            self._last = now
+            self._due = time.ticks_add(now, self.period_ms * 1000)
+
+    # The loop is about to wait, and the next pass is due ms from now
+    def expect(self, ms):
+        with self._lock:
+            self._due = time.ticks_add(time.ticks_us(), ms * 1000)
+            self.expected += 1
+
+    def start(self):
+        return time.ticks_us()
+
+    # Charge task i for the time since start() returned started
+    def done(self, i, started):
+        spent = time.ticks_diff(time.ticks_us(), started)
+        with self._lock:
+            self._calls[i] += 1
+            us = self._us[i] + spent
+            self._ms[i] += us // 1000
+            self._us[i] = us % 1000
+            if spent > self._worst[i]:
+                self._worst[i] = spent
+            over = spent > self._budget[i]
+            if over:
+                self._over[i] += 1
+        if over and self._over[i] == 1:
+            print("Loop: %s update took %d ms, over its %d ms budget" %
+                  (self.names[i], spent // 1000, self._budget[i] // 1000))
+
+    # Mean loop period in ms
+    def mean_period(self):
+        with self._lock:
+            return self._mean_period()
+
+    def _mean_period(self):
+        if self.passes < 2:
+            return 0.0
+        return (self._period_ms + self._period_us / 1000) / (self.passes - 1)
+
+    def report(self):
+        due = "due when expected" if self.expected else "due every %d ms" % self.period_ms
+        print("Loop: %d passes, mean period %.1f ms (%s), worst %d ms late, %d missed deadlines" %
+              (self.passes, self.mean_period(), due, self.worst_late // 1000, self.misses))
+        labels = ["on time"] + ["<%d ms" % edge for edge in BINS_MS[1:]] + [">%d ms" % BINS_MS[-1]]
+        print("  lateness: %s" % ", ".join("%s %d" % (label, n)
+                                           for (label, n) in zip(labels, self._hist) if n))
+        for (i, name) in enumerate(self.names):
+            calls = max(1, self._calls[i])
+            print("  %-8s %6d updates, mean %.2f ms, worst %.1f ms, budget %d ms, %d over budget" %
+                  (name, self._calls[i], (self._ms[i] + self._us[i] / 1000) / calls,
+                   self._worst[i] / 1000, self._budget[i] // 1000, self._over[i]))
+
+    # Totals for posting alongside the readings
+    def telemetry(self):
+        with self._lock:
+            fields = {
+                'loopMs': round(self._mean_period(), 1),
+                'loopWorstLateMs': self.worst_late // 1000,
+                'loopMisses': self.misses,
+            }
+            for (i, name) in enumerate(self.names):
+                fields[name + 'WorstMs'] = round(self._worst[i] / 1000, 1)
+                fields[name + 'Overruns'] = self._over[i]
+        return fields
+
+    # Start counting again from now, keeping the registered tasks
+    def clear(self):
+        with self._lock:
+            self.passes = 0
+            self.expected = 0           # Passes whose due time came from expect()
+            self.misses = 0
+            self.worst_late = 0
+            self._period_ms = 0
+            self._period_us = 0
+            self._last = 0
+            self._due = 0
+            for i in range(MAX_TASKS):
+                self._calls[i] = 0
+                self._ms[i] = 0
+                self._us[i] = 0
+                self._worst[i] = 0
+                self._over[i] = 0
+            for b in range(len(self._hist)):
+                self._hist[b] = 0
+
+monitor = Monitor()
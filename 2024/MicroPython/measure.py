@@ -1,11 +1,34 @@
+# Running statistics for a series of sensor readings: the latest value,
+# count, total, average, minimum, maximum and variance, without keeping the
+# readings themselves.
+#
+# Partial Measures -- from different sensors, cores, time windows or badges
+# -- can be combined with merge() (or +) into exactly what one Measure fed
+# every reading would hold, and pack() turns one into a fixed-size record of
+# RECORD_SIZE bytes for saving or sending, so nobody has to replay the raw
+# readings to get fleet-wide or whole-day numbers.
+#
+# The average and variance are updated a reading at a time with Welford's
+# method -- the variance kept as m2, the sum of squared differences from the
+# average -- and combined with Chan et al.'s formulas for merging, which
+# both stay accurate where a sum of squares, or even the total, would lose
+# too much to rounding.
+
+import struct
+
+# count, newminmax, then value, total, average, maxvalue, minvalue and m2
+_RECORD = ">IBdddddd"
+RECORD_SIZE = struct.calcsize(_RECORD)
+
 class Measure:
     def __init__(self):
         self.value = 0.0
         self.total = 0.0
         self.maxvalue = 0.0
         self.minvalue = 0.0
-        self.average = 0.0 
+        self.average = 0.0
         self.count = 0
+        self.m2 = 0.0
         self.newminmax = True
 
     def include(self,value):
@@ -21,17 +44,103 @@ class Measure:
             if value < self.minvalue:
                 self.minvalue = value
 
-        self.average = self.total / self.count
+        delta = value - self.average
+        self.average += delta / self.count
+        self.m2 += delta * (value - self.average)
+
+    # include() every value from a list, array or any other iterable, with
+    # the running totals kept in locals.  Ends up exactly where calling
+    # include() for each one would.
+    def include_many(self,values):
+        count = self.count
+        total = self.total
+        average = self.average
+        m2 = self.m2
+        lo = self.minvalue
+        hi = self.maxvalue
+        fresh = self.newminmax
+        value = self.value
+        for value in values:
+            count += 1
+            total += value
+            if fresh:
+                lo = hi = value
+                fresh = False
+            elif value > hi:
+                hi = value
+            elif value < lo:
+                lo = value
+            delta = value - average
+            average += delta / count
+            m2 += delta * (value - average)
+        self.count = count
+        self.total = total
+        self.average = average
+        self.m2 = m2
+        self.minvalue = lo
+        self.maxvalue = hi
+        self.newminmax = fresh
+        self.value = value
+
+    # Fold in another Measure's readings, as if they'd been include()d here
+    # after our own.  The latest value becomes other's, if it has one.
+    def merge(self,other):
+        if other.count == 0 and other.newminmax:
+            return self
+        if self.newminmax:
+            self.maxvalue = other.maxvalue
+            self.minvalue = other.minvalue
+            self.newminmax = other.newminmax
+        elif not other.newminmax:
+            if other.maxvalue > self.maxvalue:
+                self.maxvalue = other.maxvalue
+            if other.minvalue < self.minvalue:
+                self.minvalue = other.minvalue
+        count = self.count + other.count
+        if count:
+            delta = other.average - self.average
+            self.m2 += other.m2 + delta * delta * self.count * other.count / count
+            self.total += other.total
+            self.average += delta * other.count / count
+        self.count = count
+        if other.count:
+            self.value = other.value
+        return self
+
+    # A new Measure holding both, leaving the two alone
+    def __add__(self,other):
+        return Measure().merge(self).merge(other)
 
     def clear(self):
         self.value = self.total = self.average = 0.0
         self.count = 0
+        self.m2 = 0.0
         self.maxvalue = self.minvalue = 0.0
         self.newminmax = True
 
     def resetAverage(self):
         self.value = self.total = self.average = 0;
         self.count = 0
+        self.m2 = 0.0
+
+    # The whole state as RECORD_SIZE bytes
+    def pack(self):
+        return struct.pack(_RECORD, self.count, self.newminmax, self.value, self.total,
+                           self.average, self.maxvalue, self.minvalue, self.m2)
+
+    # Put back what pack() gave, from data at offset.  Returns the offset
+    # just past it.
+    def unpack_from(self,data,offset=0):
+        (self.count, newminmax, self.value, self.total, self.average,
+         self.maxvalue, self.minvalue, self.m2) = struct.unpack_from(_RECORD, data, offset)
+        self.newminmax = bool(newminmax)
+        return offset + RECORD_SIZE
+
+    @staticmethod
+    def unpacked(data,offset=0):
+        m = Measure()
+        m.unpack_from(data, offset)
+        return m
 
     def getCurrent(self):
         return self.value
@@ -49,4 +158,11 @@ class Measure:
         return self.count
 
     def getTotal(self):
-        return self.total
\ No newline at end of file
+        return self.total
+
+    # Population variance of the readings so far (dividing by the count)
+    def getVariance(self):
+        return self.m2 / self.count if self.count else 0.0
+
+    def getStdDev(self):
+        return self.getVariance() ** 0.5
@@ -0,0 +1,170 @@
+# Radio duty-cycling around batched uploads
+#
+# Keeping the CYW43 associated all the time costs far more power than the
+# SCD40 does, so instead of posting every reading as it arrives we queue
+# readings here and only bring the radio up when there's a full batch to send
+# or the oldest queued reading has waited long enough.  Between upload
+# windows the radio is either powered off entirely (the default) or, if we
+# want to stay reachable, left associated in the CYW43's power-save mode.
+#
+# Radio time is recorded for every window so we can see what each uploaded
+# sample actually cost us.
+#
+# Typical use, with a WiFi object from wifi.py:
+#
+#     radio = RadioManager(wifi, co2sao.postdweet, batch=10, max_delay=600)
+#     radio.queue((co2, tempF, rh))    # whenever there's a new reading
+#     radio.poll()                     # every time around the main loop
+
+import struct
+import time
+import energy
+from wifi import CONNECTED, FAILED
+
+# Radio states
+RADIO_DOWN = 0      # Off, or associated in power-save mode between windows
+RADIO_WAKING = 1    # Upload window open, waiting for association
+RADIO_UP = 2        # Associated at full power (only while sending)
+
+# Saved form of a queued (co2, tempF, rh) sample, see save()
+_SAMPLE = ">Hff"
+
+class RadioManager:
+    def __init__(self, wifi, send, batch=10, max_delay=600, keep_associated=False):
+        self.wifi = wifi
+        self.send = send                # Called as send(*sample) for each sample
+        self.batch = [None] * batch     # Outbound samples, oldest first
+        self.pending = 0
+        self.max_delay = max_delay * 1000   # Longest a sample waits, in ms
+        self.keep_associated = keep_associated
+        self.state = RADIO_DOWN
+        self.windows = 0                # Upload windows opened
+        self.failures = 0               # Windows where we couldn't connect
+        self.uploaded = 0               # Samples sent successfully
+        self.dropped = 0                # Samples lost to a full queue
+        self.radio_on_ms = 0            # Time spent with the radio up
+        self._oldest = 0
+        self._next_try = 0
+        self._up_since = 0
+
+    # Add a sample to the outbound batch.  If the batch is already full
+    # (because the network has been unreachable) the oldest sample is lost.
+    def queue(self, sample):
+        if self.pending == len(self.batch):
+            for i in range(1, self.pending):
+                self.batch[i - 1] = self.batch[i]
+            self.pending -= 1
+            self.dropped += 1
+        if self.pending == 0:
+            self._oldest = time.ticks_ms()
+        self.batch[self.pending] = sample
+        self.pending += 1
+
+    # True if it's time to open an upload window
+    def due(self):
+        if self.pending == 0:
+            return False
+        now = time.ticks_ms()
+        if time.ticks_diff(now, self._next_try) < 0:
+            return False
+        return (self.pending == len(self.batch) or
+                time.ticks_diff(now, self._oldest) >= self.max_delay)
+
+    # Called from the main loop.  Does nothing more than a couple of ticks
+    # comparisons unless an upload window is due or in progress.
+    def poll(self):
+        if self.state == RADIO_DOWN:
+            if self.due():
+                self._radio_up()
+            return self.state
+
+        status = self.wifi.poll()
+        if status == CONNECTED:
+            self.state = RADIO_UP
+            self._flush()
+            self._radio_down()
+        elif status == FAILED:
+            # Leave the batch queued and try again a full delay from now
+            self.failures += 1
+            self._next_try = time.ticks_add(time.ticks_ms(), self.max_delay)
+            self._radio_down()
+        return self.state
+
+    def _radio_up(self):
+        self.windows += 1
+        self._up_since = time.ticks_ms()
+        self.state = RADIO_WAKING
+        if self.keep_associated and self.wifi.isconnected():
+            self.wifi.wlan.config(pm=self.wifi.wlan.PM_PERFORMANCE)
+            energy.meter.state(energy.RADIO, energy.RADIO_ACTIVE)
+        else:
+            self.wifi.start()
+
+    def _radio_down(self):
+        if self.keep_associated and self.wifi.isconnected():
+            self.wifi.wlan.config(pm=self.wifi.wlan.PM_POWERSAVE)
+            energy.meter.state(energy.RADIO, energy.RADIO_POWERSAVE)
+        else:
+            self.wifi.stop()
+        self.radio_on_ms += time.ticks_diff(time.ticks_ms(), self._up_since)
+        self.state = RADIO_DOWN
+
+    # Send everything queued.  Anything that fails to send stays queued for
+    # the next window.
+    def _flush(self):
+        sent = 0
+        try:
+            while sent < self.pending:
+                self.send(*self.batch[sent])
+                sent += 1
+        except OSError as err:
+            print("Upload failed after %d of %d samples: %s" % (sent, self.pending, err))
+        for i in range(sent, self.pending):
+            self.batch[i - sent] = self.batch[i]
+        for i in range(self.pending - sent, self.pending):
+            self.batch[i] = None
+        self.pending -= sent
+        self.uploaded += sent
+        if self.pending:
+            self._oldest = time.ticks_ms()
+
+    # Milliseconds the main loop can idle before we need polling again
+    def idle_ms(self):
+        if self.state != RADIO_DOWN:
+            return 100      # Keep an eye on the association in progress
+        if self.pending == 0:
+            return self.max_delay
+        if self.pending == len(self.batch):
+            wait = 0
+        else:
+            wait = self.max_delay - time.ticks_diff(time.ticks_ms(), self._oldest)
+        return max(0, wait, time.ticks_diff(self._next_try, time.ticks_ms()))
+
+    # Queued samples as bytes, so they survive a deep sleep: the age of the
+    # oldest in ms, then each sample
+    def save(self):
+        data = struct.pack(">I", max(0, time.ticks_diff(time.ticks_ms(), self._oldest)))
+        for i in range(self.pending):
+            data += struct.pack(_SAMPLE, *self.batch[i])
+        return data
+
+    # Put back samples from save().  elapsed is how long we've been away.
+    def restore(self, data, elapsed=0):
+        size = struct.calcsize(_SAMPLE)
+        age = struct.unpack_from(">I", data, 0)[0] + elapsed
+        for pos in range(4, len(data) - size + 1, size):
+            self.queue(struct.unpack_from(_SAMPLE, data, pos))
+        if self.pending:
+            self._oldest = time.ticks_add(time.ticks_ms(), -age)
+
+    # Average radio-on time per uploaded sample, in milliseconds
+    def radio_ms_per_sample(self):
+        if self.uploaded == 0:
+            return 0.0
+        return self.radio_on_ms / self.uploaded
+
+    def report(self):
+        print("Radio: %d windows (%d failed), %d samples sent, %d dropped, %d queued" %
+              (self.windows, self.failures, self.uploaded, self.dropped, self.pending))
+        print("Radio on %d ms total, %.1f ms per uploaded sample" %
+              (self.radio_on_ms, self.radio_ms_per_sample()))
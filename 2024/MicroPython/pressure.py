@@ -0,0 +1,110 @@
+# Ambient pressure compensation for the SCD40
+#
+# The SCD40's CO2 reading depends on air pressure.  Out of the box we only
+# tell it our altitude (ALTITUDE), which fixes the pressure it assumes, but
+# the weather moves real pressure around by tens of hPa and every 10 hPa is
+# roughly a 1% CO2 error.  The sensor takes the actual pressure through
+# set_ambient_pressure(), even while it's measuring.
+#
+# PressureFeed takes readings from any barometric source -- a function
+# returning hPa (or None if there's no reading right now), such as LPS22
+# below for a barometer SAO on the badge bus -- smooths them with an
+# exponential moving average, and only passes the smoothed value on to the
+# sensor when it has moved more than `deadband` hPa from what we last sent,
+# or `max_age` seconds have gone by.  Pressure changes slowly, so that's
+# only a handful of I2C writes a day instead of one per reading.
+
+import time
+from micropython import const
+
+DEADBAND = 2.0      # hPa change that's worth telling the sensor about
+MAX_AGE = 3600      # Seconds after which we tell it again anyway
+SMOOTHING = 0.2     # Weight of each new reading in the moving average
+
+class PressureFeed:
+    def __init__(self, source, sensor, deadband=DEADBAND, max_age=MAX_AGE, smoothing=SMOOTHING):
+        self.source = source
+        self.sensor = sensor
+        self.deadband = deadband
+        self.max_age = max_age * 1000
+        self.smoothing = smoothing
+        self.value = None           # Smoothed pressure, hPa
+        self.sent = None            # Last value given to the sensor, hPa
+        self.reads = 0
+        self.writes = 0
+        self.failures = 0           # Readings the source couldn't give us
+        self._sent_at = 0
+
+    # Take a reading and update the sensor if it's due.  Returns True if
+    # the sensor was updated.
+    def update(self):
+        try:
+            reading = self.source()
+        except OSError:
+            reading = None
+        if reading is None:
+            self.failures += 1
+            return False
+        self.reads += 1
+        if self.value is None:
+            self.value = reading
+        else:
+            self.value += self.smoothing * (reading - self.value)
+
+        now = time.ticks_ms()
+        if (self.sent is not None and abs(self.value - self.sent) <= self.deadband and
+                time.ticks_diff(now, self._sent_at) < self.max_age):
+            return False
+        hpa = int(self.value + 0.5)
+        self.sensor.set_ambient_pressure(hpa)
+        self.sent = hpa
+        self._sent_at = now
+        self.writes += 1
+        return True
+
+    def report(self):
+        print("Pressure: %.1f hPa, %d readings, %d sent to sensor, %d missed" %
+              (self.value or 0, self.reads, self.writes, self.failures))
+
+# ST LPS22HB/LPS22HH barometer, read in one-shot mode
+LPS22_ADDRESSES = (0x5C, 0x5D)
+_LPS22_WHO_AM_I = const(0x0F)
+_LPS22_CTRL_REG2 = const(0x11)
+_LPS22_PRESS_OUT_XL = const(0x28)
+_LPS22_IDS = (0xB1, 0xB3)        # LPS22HB, LPS22HH
+
+class LPS22:
+    def __init__(self, i2c, address=LPS22_ADDRESSES[0]):
+        self.i2c = i2c
+        self.address = address
+        self._buffer = bytearray(3)
+        self._pending = False
+
+    # Find an LPS22 on the bus, or None
+    @staticmethod
+    def find(i2c):
+        try:
+            present = i2c.scan()
+        except OSError:
+            return None
+        for address in LPS22_ADDRESSES:
+            if address in present:
+                try:
+                    if i2c.readfrom_mem(address, _LPS22_WHO_AM_I, 1)[0] in _LPS22_IDS:
+                        return LPS22(i2c, address)
+                except OSError:
+                    pass
+        return None
+
+    # Pressure in hPa from the previous one-shot conversion, starting the
+    # next one.  The conversion takes a few tens of ms, so rather than wait
+    # for it we pick it up next time; the first call returns None.
+    def __call__(self):
+        reading = None
+        if self._pending:
+            self.i2c.readfrom_mem_into(self.address, _LPS22_PRESS_OUT_XL, self._buffer)
+            b = self._buffer
+            reading = (b[0] | (b[1] << 8) | (b[2] << 16)) / 4096
+        self.i2c.writeto_mem(self.address, _LPS22_CTRL_REG2, b"\x11")   # ONE_SHOT, IF_ADD_INC
+        self._pending = True
+        return reading
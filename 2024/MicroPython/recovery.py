@@ -0,0 +1,139 @@
+# I2C fault recovery for the CO2 sensor
+#
+# Without it, any hiccup on the sensor's bus -- a NACK, a reply that fails
+# its CRC, a bus left stuck by a badge bumped mid-transfer -- raises from
+# scd4x.py straight out of the badge's main loop, and that's the end of the
+# badge until someone resets it.  A Recovery handed to the SCD4X driver
+# gives it three levels of response, each counted:
+#
+#   - retry: NACKs and bad CRCs are nearly always one-offs, so the driver
+#     tries the whole command again, RETRIES times at most, waiting
+#     BACKOFF_MS before the first retry and twice as long before each one
+#     after that, up to BACKOFF_MAX_MS.
+#   - un-wedge: a device cut off in the middle of a byte can be left holding
+#     SDA low, waiting for the rest of its clocks, and the RP2040 then times
+#     out (ETIMEDOUT) on every transfer.  We take SCL over as a GPIO and
+#     clock it until SDA is let go -- 9 clocks gets any device to the end of
+#     its byte -- send a STOP and hand the pins back to the I2C peripheral.
+#     We find the bus and its pins from the way the rp2 port shows it, e.g.
+#     "I2C(0, freq=400000, scl=1, sda=0, timeout=50000)", looking through
+#     tracelog.TraceRecorder and dualcore.LockedI2C to the bus they wrap.
+#   - reinit: if a command still fails after all that, the driver raises
+#     RuntimeError as before.  co2sao.update() catches it, and after
+#     FAILURES failed updates in a row, or if the sensor stops delivering
+#     readings while it should be measuring (as after a brownout), puts the
+#     sensor back the way init() set it up and calls reinitialized().
+
+import time
+from machine import I2C, Pin
+
+RETRIES = 3
+BACKOFF_MS = 2
+BACKOFF_MAX_MS = 50
+FAILURES = 3
+CLOCKS = 9
+HALF_CLOCK_US = 5       # 100 kHz while clocking by hand
+
+_ETIMEDOUT = 110
+
+# (id, scl, sda, freq) of the bus under any wrappers, or None if we can't
+# tell, in which case we can't un-wedge it
+def bus_pins(bus):
+    while hasattr(bus, "i2c"):
+        bus = bus.i2c
+    shown = repr(bus)
+    if not (shown.startswith("I2C(") and shown.endswith(")")):
+        return None
+    fields = shown[4:-1].split(", ")
+    try:
+        found = {"id": int(fields[0])}
+        for field in fields[1:]:
+            (name, _, value) = field.partition("=")
+            found[name] = int(value)
+        return (found["id"], found["scl"], found["sda"], found["freq"])
+    except (KeyError, ValueError):
+        return None
+
+class Recovery:
+    def __init__(self, bus, retries=RETRIES, backoff_ms=BACKOFF_MS, backoff_max_ms=BACKOFF_MAX_MS):
+        self.pins = bus_pins(bus)
+        self.retries_allowed = retries
+        self.backoff_ms = backoff_ms
+        self.backoff_max_ms = backoff_max_ms
+        self.clear()
+
+    def clear(self):
+        self.io_errors = 0          # Transfers that failed
+        self.crc_errors = 0         # Replies that failed their CRC
+        self.retries = 0            # Commands tried again
+        self.backoff_total_ms = 0
+        self.unwedges = 0           # Times we clocked the bus free
+        self.failures = 0           # Commands that failed even so
+        self.reinits = 0            # Times the sensor was set up again
+
+    # Called by the driver when attempt (0 for the first try) of a command
+    # failed with err.  Returns whether to try again, having waited and
+    # un-wedged the bus if need be.
+    def retry(self, attempt, err):
+        if isinstance(err, OSError):
+            self.io_errors += 1
+        else:
+            self.crc_errors += 1
+        if attempt >= self.retries_allowed:
+            self.failures += 1
+            return False
+        if isinstance(err, OSError) and err.args and err.args[0] == _ETIMEDOUT:
+            self.unwedge()
+        wait = min(self.backoff_ms << attempt, self.backoff_max_ms)
+        time.sleep_ms(wait)
+        self.backoff_total_ms += wait
+        self.retries += 1
+        return True
+
+    # Clock SCL until whoever's holding SDA low lets go, then STOP and set
+    # the I2C peripheral up again.  Returns whether SDA was released.
+    def unwedge(self):
+        if self.pins is None:
+            return False
+        (id, scl_id, sda_id, freq) = self.pins
+        self.unwedges += 1
+        sda = Pin(sda_id, Pin.IN, Pin.PULL_UP)
+        scl = Pin(scl_id, Pin.OPEN_DRAIN, Pin.PULL_UP, value=1)
+        clocks = 0
+        while sda.value() == 0 and clocks < CLOCKS:
+            scl(0)
+            time.sleep_us(HALF_CLOCK_US)
+            scl(1)
+            time.sleep_us(HALF_CLOCK_US)
+            clocks += 1
+        released = sda.value() == 1
+        # STOP: SDA goes high while SCL is high
+        scl(0)
+        sda.init(Pin.OPEN_DRAIN, Pin.PULL_UP, value=0)
+        time.sleep_us(HALF_CLOCK_US)
+        scl(1)
+        time.sleep_us(HALF_CLOCK_US)
+        sda(1)
+        time.sleep_us(HALF_CLOCK_US)
+        # The rp2 port hands back the same bus object for the same id, so
+        # everyone holding it carries on as before
+        I2C(id, scl=Pin(scl_id), sda=Pin(sda_id), freq=freq)
+        return released
+
+    def reinitialized(self):
+        self.reinits += 1
+
+    def report(self):
+        print("I2C recovery: %d transfer errors, %d CRC errors, %d retries (%d ms backing off), "
+              "%d un-wedged, %d failed, %d sensor reinits" %
+              (self.io_errors, self.crc_errors, self.retries, self.backoff_total_ms,
+               self.unwedges, self.failures, self.reinits))
+
+    def telemetry(self):
+        return {
+            'i2cErrors': self.io_errors + self.crc_errors,
+            'i2cRetries': self.retries,
+            'i2cUnwedges': self.unwedges,
+            'i2cFailures': self.failures,
+            'sensorReinits': self.reinits,
+        }
@@ -34,6 +34,18 @@ from machine import I2C
 from micropython import const
 import struct
 
+try:
+    # Only used for type annotations, which MicroPython doesn't evaluate
+    from typing import Tuple, Union
+except ImportError:
+    pass
+
+try:
+    # Optional: report measurement mode changes for power accounting
+    import energy
+except ImportError:
+    energy = None
+
 __version__ = "v103"
 __repo__ = "https://github.com/peter-l5/MicroPython_SCD4X"
 
@@ -64,6 +76,9 @@ class SCD4X:
 
     :param ~machine.I2C i2c_bus: The I2C bus the SCD4X is connected to.
     :param int address: The I2C device address for the sensor. Default is :const:`0x62`
+    :param recovery: Optional :class:`recovery.Recovery` deciding whether, and after
+        how long, to retry a command that failed on the bus or its CRC check, and
+        counting failures. Without one the first failure raises.
 
     **Quickstart: Importing and using the SCD4X**
 
@@ -94,20 +109,25 @@ class SCD4X:
 
     """
 
-    def __init__(self, i2c_bus: I2C, address: int = SCD4X_DEFAULT_ADDR) -> None:
+    def __init__(self, i2c_bus: I2C, address: int = SCD4X_DEFAULT_ADDR, recovery=None) -> None:
         print("__init__ :", dir())
         print("address : %x" % address)
         print("i2c_bus : ", i2c_bus)
         self.address = address
         print(i2c_bus)
         self.i2c_device = i2c_bus
+        self.recovery = recovery
         self._buffer = bytearray(18)
         self._cmd = bytearray(2)
         self._crc_buffer = bytearray(2)
-
-        # cached readings
-        self._temperature = None
-        self._relative_humidity = None
+        # delay after the last command sent, or None if it can't simply be
+        # sent again to retry reading its reply
+        self._cmd_delay = None
+
+        # cached readings, kept as the sensor's raw 16-bit words and only
+        # converted when asked for
+        self._temp_word = None
+        self._humi_word = None
         self._co2 = None
 
         self.stop_periodic_measurement()
@@ -134,7 +154,40 @@ class SCD4X:
         """
         if self.data_ready:
             self._read_data()
-        return self._temperature
+        if self._temp_word is None:
+            return None
+        return -45 + 175 * (self._temp_word / 2**16)
+
+    @property
+    def temperature_f(self) -> float:
+        """Returns the current temperature in degrees Fahrenheit
+
+        .. note::
+            Between measurements, the most recent reading will be cached and returned.
+
+        """
+        if self.data_ready:
+            self._read_data()
+        if self._temp_word is None:
+            return None
+        return -49 + 315 * (self._temp_word / 2**16)
+
+    @property
+    def temperature_centi(self) -> int:
+        """Returns the current temperature in hundredths of a degree Celsius, as an
+        integer, rounded to the nearest. Needs no floating point, so on MicroPython the
+        conversion allocates nothing.
+
+        .. note::
+            Between measurements, the most recent reading will be cached and returned.
+
+        """
+        if self.data_ready:
+            self._read_data()
+        if self._temp_word is None:
+            return None
+        # 17500 / 2**16 reduced to 4375 / 2**14 keeps the product a small int
+        return ((4375 * self._temp_word + 8192) >> 14) - 4500
 
     @property
     def relative_humidity(self) -> float:
@@ -146,7 +199,26 @@ class SCD4X:
         """
         if self.data_ready:
             self._read_data()
-        return self._relative_humidity
+        if self._humi_word is None:
+            return None
+        return 100 * (self._humi_word / 2**16)
+
+    @property
+    def relative_humidity_centi(self) -> int:
+        """Returns the current relative humidity in hundredths of a percent, as an
+        integer, rounded to the nearest. Needs no floating point, so on MicroPython the
+        conversion allocates nothing.
+
+        .. note::
+            Between measurements, the most recent reading will be cached and returned.
+
+        """
+        if self.data_ready:
+            self._read_data()
+        if self._humi_word is None:
+            return None
+        # 10000 / 2**16 reduced to 625 / 2**12
+        return (625 * self._humi_word + 2048) >> 12
 
     def reinit(self) -> None:
         """Reinitializes the sensor by reloading user settings from EEPROM."""
@@ -200,14 +272,12 @@ class SCD4X:
             raise RuntimeError("Self test failed")
 
     def _read_data(self) -> None:
-        """Reads the temp/hum/co2 from the sensor and caches it"""
+        """Reads the temp/hum/co2 from the sensor and caches the raw words"""
         self._send_command(_SCD4X_READMEASUREMENT, cmd_delay=0.001)
         self._read_reply(self._buffer, 9)
         self._co2 = (self._buffer[0] << 8) | self._buffer[1]
-        temp = (self._buffer[3] << 8) | self._buffer[4]
-        self._temperature = -45 + 175 * (temp / 2**16)
-        humi = (self._buffer[6] << 8) | self._buffer[7]
-        self._relative_humidity = 100 * (humi / 2**16)
+        self._temp_word = (self._buffer[3] << 8) | self._buffer[4]
+        self._humi_word = (self._buffer[6] << 8) | self._buffer[7]
 
     @property
     def data_ready(self) -> bool:
@@ -233,6 +303,8 @@ class SCD4X:
     def stop_periodic_measurement(self) -> None:
         """Stop measurement mode"""
         self._send_command(_SCD4X_STOPPERIODICMEASUREMENT, cmd_delay=0.5)
+        if energy is not None:
+            energy.meter.state(energy.SENSOR, energy.SENSOR_IDLE)
 
     def start_periodic_measurement(self) -> None:
         """Put sensor into working mode, about 5s per measurement
@@ -252,6 +324,8 @@ class SCD4X:
 
         """
         self._send_command(_SCD4X_STARTPERIODICMEASUREMENT)
+        if energy is not None:
+            energy.meter.state(energy.SENSOR, energy.SENSOR_PERIODIC)
 
     def start_low_periodic_measurement(self) -> None:
         """Put sensor into low power working mode, about 30s per measurement. See
@@ -259,6 +333,8 @@ class SCD4X:
         for more details.
         """
         self._send_command(_SCD4X_STARTLOWPOWERPERIODICMEASUREMENT)
+        if energy is not None:
+            energy.meter.state(energy.SENSOR, energy.SENSOR_LOW_POWER)
 
     def persist_settings(self) -> None:
         """Save temperature offset, altitude offset, and selfcal enable settings to EEPROM"""
@@ -315,8 +391,8 @@ class SCD4X:
             raise AttributeError("Height must be less than or equal to 65535 metres")
         self._set_command_value(_SCD4X_SETALTITUDE, height)
 
-    def _check_buffer_crc(self, buf: bytearray) -> bool:
-        for i in range(0, len(buf), 3):
+    def _check_buffer_crc(self, buf: bytearray, num: int = None) -> bool:
+        for i in range(0, len(buf) if num is None else num, 3):
             self._crc_buffer[0] = buf[i]
             self._crc_buffer[1] = buf[i + 1]
             if self._crc8(self._crc_buffer) != buf[i + 2]:
@@ -326,14 +402,15 @@ class SCD4X:
     def _send_command(self, cmd: int, cmd_delay: float = 0) -> None:
         self._cmd[0] = (cmd >> 8) & 0xFF
         self._cmd[1] = cmd & 0xFF
-
-        try:
-            self.i2c_device.writeto(self.address, self._cmd)
-        except OSError as err:
-            raise RuntimeError(
-                "Could not communicate via I2C, some commands/settings "
-                "unavailable while in working mode"
-            ) from err
+        self._cmd_delay = cmd_delay
+
+        attempt = 0
+        while True:
+            try:
+                self.i2c_device.writeto(self.address, self._cmd)
+                break
+            except OSError as err:
+                attempt = self._failed(attempt, err)
         time.sleep(cmd_delay)
 
     def _set_command_value(self, cmd, value, cmd_delay=0):
@@ -342,12 +419,45 @@ class SCD4X:
         self._crc_buffer[0] = self._buffer[2] = (value >> 8) & 0xFF
         self._crc_buffer[1] = self._buffer[3] = value & 0xFF
         self._buffer[4] = self._crc8(self._crc_buffer)
-        self.i2c_device.writeto(self.address, self._buffer[:5])
+        self._cmd_delay = None
+        attempt = 0
+        while True:
+            try:
+                self.i2c_device.writeto(self.address, self._buffer[:5])
+                break
+            except OSError as err:
+                attempt = self._failed(attempt, err)
         time.sleep(cmd_delay)
 
     def _read_reply(self, buff, num):
-        self.i2c_device.readfrom_into(self.address, buff)
-        self._check_buffer_crc(self._buffer[0:num])
+        attempt = 0
+        while True:
+            try:
+                # The sensor only replies to a command once, so to try
+                # again we have to send the command again first
+                if attempt:
+                    self.i2c_device.writeto(self.address, self._cmd)
+                    time.sleep(self._cmd_delay)
+                self.i2c_device.readfrom_into(self.address, buff)
+                self._check_buffer_crc(self._buffer, num)
+                return
+            except (OSError, RuntimeError) as err:
+                # Commands sent with a value aren't sent again, so no retries
+                if self._cmd_delay is None and self.recovery is not None:
+                    attempt = self.recovery.retries_allowed
+                attempt = self._failed(attempt, err)
+
+    # Attempt (counting from 0) of a command failed with err: carry on with
+    # the next attempt if our recovery says so, or give up
+    def _failed(self, attempt, err):
+        if self.recovery is not None and self.recovery.retry(attempt, err):
+            return attempt + 1
+        if isinstance(err, OSError):
+            raise RuntimeError(
+                "Could not communicate via I2C, some commands/settings "
+                "unavailable while in working mode"
+            ) from err
+        raise err
 
     @staticmethod
     def _crc8(buffer: bytearray) -> int:
@@ -0,0 +1,155 @@
+# Glitch-free driver for the two-bit stoplight interface
+#
+# The stoplight board decodes the SAO's two GPIO lines into red, yellow and
+# green with NAND gates, so whatever combination is on those two lines is
+# what lights up -- even if only for a microsecond.  Setting the bits with
+# two separate Pin.value() calls means a change where both bits flip (off <->
+# yellow, green <-> red) briefly shows the wrong color in between.
+#
+# On the RP2040 we avoid that by going straight to the SIO block, whose
+# GPIO_OUT_XOR register flips any set of output pins in a single write, so
+# both bits change on exactly the same clock edge.  Anywhere else we fall
+# back to Pin.value(), clearing bits before setting them so a change between
+# two colors passes through off rather than through a third color.
+#
+# We can also dim the LEDs (e.g. at night) with PWM.  Both stoplight pins
+# need to be on the same PWM slice for that, which they are on the badge
+# (GPIO6/7) and on our Pico W test rig (GPIO14/15): the two channels of a
+# slice share a counter, so with equal duty cycles both bits switch together
+# and the decoder only ever sees the chosen color or off.  Both duty values
+# live in a single compare register, which we also update with one write.
+#
+# Every change is reported to the energy meter (see energy.py).
+
+import sys
+from machine import Pin, PWM
+try:
+    from machine import mem32
+except ImportError:
+    mem32 = None
+from micropython import const
+import energy
+
+# RP2040 single-cycle IO block (RP2040 datasheet section 2.3.1.7)
+_SIO_BASE = const(0xd0000000)
+_GPIO_OUT = const(0x010)
+_GPIO_OUT_XOR = const(0x01c)
+
+# RP2040 PWM block (RP2040 datasheet section 4.5.3), 0x14 bytes per slice
+_PWM_BASE = const(0x40050000)
+_PWM_CC = const(0x0c)
+_PWM_TOP = const(0x10)
+
+# Same encoding as the add-on itself
+OFF = 0
+GREEN = 1
+YELLOW = 3
+RED = 2
+
+DIM_FREQ = 1000     # PWM frequency used for dimming, in Hz
+
+def _have_sio():
+    return mem32 is not None and sys.platform == "rp2"
+
+class Stoplight:
+    def __init__(self, lsb, msb, use_sio=None):
+        self.lsb = lsb
+        self.msb = msb
+        self.status = OFF
+        self.brightness = 100
+        self.use_sio = _have_sio() if use_sio is None else use_sio
+        self._mask = (1 << lsb) | (1 << msb)
+        self._pin0 = Pin(lsb, Pin.OUT)
+        self._pin1 = Pin(msb, Pin.OUT)
+        self._pin0.value(0)
+        self._pin1.value(0)
+        self._pwm0 = self._pwm1 = None
+
+    # Both pins have to share a PWM slice for dimming to be glitch-free
+    def can_dim(self):
+        return (self.lsb >> 1) & 7 == (self.msb >> 1) & 7
+
+    # Show a new status.  Does nothing if the status hasn't changed.
+    def set(self, status):
+        if status != self.status:
+            self._write(status)
+            self.status = status
+            energy.meter.state(energy.LED, status, self.brightness)
+
+    # Set LED brightness as a percentage.  Anything below 100 switches both
+    # pins over to PWM; 100 puts them back to plain outputs.  Returns False if
+    # the pins can't be dimmed without glitches.
+    def dim(self, percent):
+        percent = max(1, min(100, percent))
+        if percent < 100 and not self.can_dim():
+            return False
+        self.brightness = percent
+        if (percent < 100) == (self._pwm0 is not None):
+            # Already in the right mode, so just adjust the duty cycle
+            self._write(self.status)
+            energy.meter.state(energy.LED, self.status, percent)
+            return True
+
+        # Switching between plain outputs and PWM changes each pin's function
+        # separately, so go dark first: the worst anyone sees is a blink.
+        self._write(OFF)
+        if percent < 100:
+            if self.use_sio:
+                mem32[self._slice_base() + _PWM_CC] = 0
+            self._pwm0 = PWM(self._pin0)
+            self._pwm1 = PWM(self._pin1)
+            self._pwm0.freq(DIM_FREQ)
+        else:
+            self._pwm0.deinit()
+            self._pwm1.deinit()
+            self._pwm0 = self._pwm1 = None
+            self._pin0 = Pin(self.lsb, Pin.OUT)
+            self._pin1 = Pin(self.msb, Pin.OUT)
+        self._write(self.status)
+        energy.meter.state(energy.LED, self.status, percent)
+        return True
+
+    def _write(self, status):
+        if self._pwm0 is not None:
+            self._set_duty(status)
+        elif self.use_sio:
+            bits = ((status & 1) << self.lsb) | (((status >> 1) & 1) << self.msb)
+            current = mem32[_SIO_BASE + _GPIO_OUT] & self._mask
+            mem32[_SIO_BASE + _GPIO_OUT_XOR] = current ^ bits
+        else:
+            # Clear first, then set: a color change may blink off but
+            # never shows a third color
+            if not status & 1:
+                self._pin0.value(0)
+            if not status & 2:
+                self._pin1.value(0)
+            if status & 1:
+                self._pin0.value(1)
+            if status & 2:
+                self._pin1.value(1)
+
+    def _slice_base(self):
+        return _PWM_BASE + ((self.lsb >> 1) & 7) * 0x14
+
+    def _set_duty(self, status):
+        if self.use_sio:
+            # One write to the slice's compare register sets both channels.
+            # Channel A is the even-numbered pin and sits in the low half.
+            slice_base = self._slice_base()
+            level = ((mem32[slice_base + _PWM_TOP] & 0xFFFF) + 1) * self.brightness // 100
+            level0 = level if status & 1 else 0
+            level1 = level if status & 2 else 0
+            if self.lsb & 1:
+                mem32[slice_base + _PWM_CC] = (level0 << 16) | level1
+            else:
+                mem32[slice_base + _PWM_CC] = (level1 << 16) | level0
+        else:
+            duty = 65535 * self.brightness // 100
+            if not status & 1:
+                self._pwm0.duty_u16(0)
+            if not status & 2:
+                self._pwm1.duty_u16(0)
+            if status & 1:
+                self._pwm0.duty_u16(duty)
+            if status & 2:
+                self._pwm1.duty_u16(duty)
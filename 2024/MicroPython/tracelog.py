@@ -0,0 +1,103 @@
+# Record raw SCD40 sessions for replay on Linux
+#
+# To tune thresholds, filters and sampling we want to run real data through
+# the add-on code over and over.  TraceRecorder sits between the add-on and
+# its I2C bus and passes everything straight through, but each time the
+# sensor's read_measurement reply goes by it appends the three raw words
+# (CO2, temperature, humidity, as the sensor sent them) and when they
+# arrived to a trace file.  Emulator/replay.py feeds a trace back through
+# the unchanged add-on code on a simulated bus under a virtual clock.
+#
+# The file is a small header -- magic and the time.time() the trace started
+# -- followed by one 10-byte record per reading: milliseconds since the
+# start, then the three words.  A day at one reading every 5 seconds is
+# under 200KB.  If the file already holds a trace (say we're waking from a
+# deep sleep) we append to it, carrying on its timeline.  Records are
+# buffered and written every FLUSH_EVERY readings to spare the flash, so
+# call flush() before anything that loses RAM.
+
+import struct
+import time
+
+TRACE_FILE = "co2trace.bin"
+FLUSH_EVERY = 12
+
+SCD4X_ADDRESS = 0x62
+_READ_MEASUREMENT = b"\xec\x05"
+
+_MAGIC = b"CO2T"
+_HEADER = ">4sI"
+_RECORD = ">IHHH"
+
+class TraceRecorder:
+    def __init__(self, i2c, path=TRACE_FILE, address=SCD4X_ADDRESS):
+        self.i2c = i2c
+        self.path = path
+        self.address = address
+        self.records = 0
+        self._pending = []
+        self._reading = False
+
+        # Carry on an existing trace, or start a new one
+        self._offset = 0
+        try:
+            with open(path, "rb") as f:
+                header = f.read(struct.calcsize(_HEADER))
+            if len(header) != struct.calcsize(_HEADER) or header[:4] != _MAGIC:
+                raise ValueError
+            started = struct.unpack(_HEADER, header)[1]
+            self._offset = max(0, int(time.time()) - started) * 1000
+        except (OSError, ValueError):
+            with open(path, "wb") as f:
+                f.write(struct.pack(_HEADER, _MAGIC, int(time.time())))
+        self._start = time.ticks_ms()
+
+    # Anything we don't need to watch goes straight to the bus
+    def __getattr__(self, name):
+        return getattr(self.i2c, name)
+
+    def writeto(self, addr, buf, stop=True):
+        self._reading = addr == self.address and buf[:2] == _READ_MEASUREMENT
+        return self.i2c.writeto(addr, buf, stop)
+
+    def readfrom_into(self, addr, buf, stop=True):
+        self.i2c.readfrom_into(addr, buf, stop)
+        if self._reading and addr == self.address and len(buf) >= 8:
+            self._reading = False
+            ms = self._offset + time.ticks_diff(time.ticks_ms(), self._start)
+            self._pending.append(struct.pack(_RECORD, ms, (buf[0] << 8) | buf[1],
+                                             (buf[3] << 8) | buf[4], (buf[6] << 8) | buf[7]))
+            self.records += 1
+            if len(self._pending) >= FLUSH_EVERY:
+                self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        try:
+            with open(self.path, "ab") as f:
+                for record in self._pending:
+                    f.write(record)
+        except OSError as err:
+            print("Can't write CO2 trace:", err)
+        self._pending = []
+
+# Read a trace file.  Returns (started, records) where started is the
+# time.time() the trace began and records is a list of (ms, co2 word,
+# temperature word, humidity word) tuples.
+def load(path):
+    with open(path, "rb") as f:
+        blob = f.read()
+    hsize = struct.calcsize(_HEADER)
+    if len(blob) < hsize or blob[:4] != _MAGIC:
+        raise ValueError("%s: not a CO2 trace" % path)
+    started = struct.unpack_from(_HEADER, blob, 0)[1]
+    rsize = struct.calcsize(_RECORD)
+    records = [struct.unpack_from(_RECORD, blob, pos)
+               for pos in range(hsize, len(blob) - rsize + 1, rsize)]
+    return (started, records)
+
+# Convert raw words to (co2 ppm, temperature C, relative humidity %), the
+# same way the sensor driver does
+def convert(record):
+    return (record[1], -45 + 175 * record[2] / 65536, 100 * record[3] / 65536)
@@ -0,0 +1,146 @@
+# Incremental CO2 trend estimation
+#
+# The stoplight only changes once CO2 actually crosses a threshold.  In a
+# crowded room it's more useful to know that CO2 is climbing and roughly when
+# it'll cross, so this keeps a least-squares straight-line fit over the last
+# few minutes of readings and predicts how long until a given level.
+#
+# Like Measure, a Trend only keeps running totals: the sums of t, y, t*t and
+# t*y over the samples in the window.  Adding a sample adds its terms, and
+# dropping the oldest sample subtracts its terms, so each update costs the
+# same no matter how big the window is.  The window's samples themselves are
+# kept in preallocated arrays so we know what to subtract later.
+#
+# Everything in include() is small-integer arithmetic, so it never allocates.
+# To keep the sums small, times are measured in seconds from the oldest
+# sample in the window (the sums are shifted along as that changes) and
+# readings are stored relative to the first reading we saw.  The limits
+# below keep every sum inside MicroPython's small-int range.  Only slope()
+# and the predictions use floating point, and only when asked.
+
+from array import array
+import time
+
+MAX_WINDOW = 900        # Longest window, in seconds
+MAX_SIZE = 128          # Most samples in a window
+MAX_DEVIATION = 8000    # Readings are clamped to this far from the reference
+
+class Trend:
+    def __init__(self, window=600, size=MAX_SIZE):
+        self.window = min(window, MAX_WINDOW)
+        self.size = min(size, MAX_SIZE)
+        self._t = array("i", [0] * self.size)     # Seconds since we started
+        self._y = array("i", [0] * self.size)     # ppm relative to _ref
+        self._head = 0          # Oldest sample
+        self._count = 0
+        self._ref = 0           # Reference reading
+        self._base = 0          # Time of oldest sample, origin for the sums
+        self._now = 0           # Seconds since we started
+        self._ms = 0            # Leftover milliseconds not yet in _now
+        self._last = None       # ticks_ms() of the last sample
+        self._st = 0
+        self._sy = 0
+        self._stt = 0
+        self._sty = 0
+
+    def _drop(self):
+        h = self._head
+        t = self._t[h] - self._base
+        y = self._y[h]
+        self._st -= t
+        self._sy -= y
+        self._stt -= t * t
+        self._sty -= t * y
+        self._head = h + 1 if h + 1 < self.size else 0
+        self._count -= 1
+
+    # Move the time origin of the sums forward by d seconds
+    def _rebase(self, d):
+        n = self._count
+        self._stt -= d * (2 * self._st - n * d)
+        self._sty -= d * self._sy
+        self._st -= n * d
+        self._base += d
+
+    # Add a reading, taken at ticks_ms() time now (default: right now)
+    def include(self, value, now=None):
+        if now is None:
+            now = time.ticks_ms()
+        if self._last is not None:
+            self._ms += time.ticks_diff(now, self._last)
+            self._now += self._ms // 1000
+            self._ms %= 1000
+        self._last = now
+
+        # Drop anything that's aged out of the window (or the oldest sample
+        # if we're out of room), then keep the origin at the oldest sample
+        while self._count and (self._count == self.size or
+                               self._now - self._t[self._head] > self.window):
+            self._drop()
+        if self._count == 0:
+            self._ref = int(value)
+            self._base = self._now
+            self._st = self._sy = self._stt = self._sty = 0
+        elif self._t[self._head] != self._base:
+            self._rebase(self._t[self._head] - self._base)
+
+        y = int(value) - self._ref
+        if y > MAX_DEVIATION:
+            y = MAX_DEVIATION
+        elif y < -MAX_DEVIATION:
+            y = -MAX_DEVIATION
+        t = self._now - self._base
+        i = self._head + self._count
+        if i >= self.size:
+            i -= self.size
+        self._t[i] = self._now
+        self._y[i] = y
+        self._count += 1
+        self._st += t
+        self._sy += y
+        self._stt += t * t
+        self._sty += t * y
+
+    def count(self):
+        return self._count
+
+    # Fitted rate of change in ppm per second, 0 until there's enough data
+    def _rate(self):
+        n = self._count
+        if n < 3:
+            return 0.0
+        d = float(n) * self._stt - float(self._st) * self._st
+        if d == 0:
+            return 0.0
+        return (float(n) * self._sty - float(self._st) * self._sy) / d
+
+    # Rate of change in ppm per minute
+    def slope(self):
+        return self._rate() * 60
+
+    # Value of the fitted line at the latest sample
+    def level(self):
+        n = self._count
+        if n == 0:
+            return 0.0
+        b = self._rate()
+        a = (self._sy - b * self._st) / n
+        return self._ref + a + b * (self._now - self._base)
+
+    # Predicted seconds until CO2 reaches target, 0 if it's already there,
+    # or None if it isn't heading that way
+    def seconds_to(self, target):
+        if self._count < 3:
+            return None
+        current = self.level()
+        if current >= target:
+            return 0
+        b = self._rate()
+        if b <= 0:
+            return None
+        return int((target - current) / b)
+
+    def clear(self):
+        self._count = 0
+        self._head = 0
+        self._last = None
@@ -0,0 +1,180 @@
+# Non-blocking Wi-Fi bring-up for the badge and the Pico W
+#
+# Our original badge_init() sat in a sleep(1) loop for up to ten seconds
+# waiting on wlan.status(), so nothing else -- in particular the CO2 sensor
+# and the stoplight -- could run until the network was either up or had
+# given up.  This module turns association into a small state machine that
+# the main loop polls each time around, so add-ons get started first and the
+# network comes up in the background.
+#
+# Once we've associated successfully we remember the BSSID and channel of the
+# access point we joined in a small cache file.  On later boots we connect
+# straight to that BSSID, which lets the CYW43 skip its scan and noticeably
+# shortens the time to association.  If the cached access point doesn't
+# answer we forget it and fall back to a normal connect by SSID.
+#
+# The CYW43 will tell us the channel we joined on (wlan.config("channel"))
+# but not the BSSID, so we find that with one scan, for the strongest access
+# point with our SSID on that channel.  A scan blocks for a couple of
+# seconds, so rather than run it from poll() we leave it to the main loop:
+# learn() does it when the loop is about to sit idle for at least SCAN_MS
+# anyway, and only once, after the first connect without a cache.
+#
+# Radio power state changes are reported to the energy meter (energy.py).
+
+import network
+import time
+import json
+import os
+import energy
+
+CACHE_FILE = "wifi.json"
+
+# How long to wait for association before giving up, in milliseconds
+CONNECT_TIMEOUT = 10000
+
+# Longest a scan takes, in milliseconds
+SCAN_MS = 2500
+
+# wlan.status() value once we're associated and have an IP address
+STAT_GOT_IP = 3
+
+# Connection states reported by poll()
+IDLE = 0
+CONNECTING = 1
+CONNECTED = 2
+FAILED = 3
+
+class WiFi:
+    def __init__(self, ssid, password, timeout=CONNECT_TIMEOUT, cachefile=CACHE_FILE):
+        self.ssid = ssid
+        self.password = password
+        self.timeout = timeout
+        self.cachefile = cachefile
+        self.wlan = network.WLAN(network.STA_IF)
+        self.state = IDLE
+        self.assoc_ms = 0        # Time taken by the most recent association
+        self.used_cache = False  # Whether that association used the cached BSSID
+        self.learning = None     # Channel we joined on, until learn() finds the BSSID
+        self._started = 0
+
+    # Kick off association and return immediately.  Uses the cached BSSID
+    # and channel if we have them for this SSID.
+    def start(self):
+        self.wlan.active(True)
+        energy.meter.state(energy.RADIO, energy.RADIO_CONNECTING)
+        self._connect(self._load_cache())
+
+    # Called from the main loop.  Cheap when nothing has changed, as it's
+    # just a wlan.status() call.  Returns the current connection state.
+    def poll(self):
+        if self.state == CONNECTED:
+            if self.wlan.status() != STAT_GOT_IP:
+                print("WiFi connection lost, reconnecting")
+                self.start()
+            return self.state
+        if self.state != CONNECTING:
+            return self.state
+
+        status = self.wlan.status()
+        elapsed = time.ticks_diff(time.ticks_ms(), self._started)
+        if status == STAT_GOT_IP:
+            self.assoc_ms = elapsed
+            self.state = CONNECTED
+            energy.meter.state(energy.RADIO, energy.RADIO_ACTIVE)
+            print("WiFi connected in %d ms%s, IP address: %s" %
+                  (elapsed, " (cached BSSID)" if self.used_cache else "",
+                   self.wlan.ifconfig()[0]))
+            if not self.used_cache:
+                try:
+                    self.learning = self.wlan.config("channel")
+                except (ValueError, OSError, TypeError):
+                    pass        # Then we can't tell which access point it was
+        elif status < 0 or elapsed > self.timeout:
+            if self.used_cache:
+                # Cached access point didn't work out, so forget it and
+                # try again the slow way
+                print("WiFi cached BSSID failed, connecting by SSID")
+                self._forget_cache()
+                self.wlan.disconnect()
+                self._connect(None)
+            else:
+                print("WiFi failed to connect (status %d)" % status)
+                self.state = FAILED
+        return self.state
+
+    # Drop the connection and power the radio down
+    def stop(self):
+        self.wlan.disconnect()
+        self.wlan.active(False)
+        self.state = IDLE
+        energy.meter.state(energy.RADIO, energy.RADIO_OFF)
+
+    def isconnected(self):
+        return self.state == CONNECTED
+
+    def _connect(self, cache):
+        self.used_cache = cache is not None
+        if self.used_cache:
+            bssid = bytes.fromhex(cache["bssid"])
+            try:
+                self.wlan.config(channel=cache["channel"])
+            except (ValueError, OSError, TypeError):
+                pass       # Not every port lets a station pick its channel
+            self.wlan.connect(self.ssid, self.password, bssid=bssid)
+        else:
+            self.wlan.connect(self.ssid, self.password)
+        self._started = time.ticks_ms()
+        self.state = CONNECTING
+
+    def _load_cache(self):
+        try:
+            with open(self.cachefile) as f:
+                cache = json.load(f)
+            if cache["ssid"] == self.ssid:
+                return cache
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    # Call when the main loop is about to wait ms.  If we still need the
+    # BSSID of the access point we joined and there's time, scan for it --
+    # powering the radio up just for the scan if it's down -- and cache it.
+    # Returns whether we scanned, in which case the wait is that much shorter.
+    def learn(self, ms):
+        if self.learning is None or ms < SCAN_MS:
+            return False
+        channel = self.learning
+        self.learning = None
+        was_active = self.wlan.active()
+        was = energy.meter.current(energy.RADIO)
+        if not was_active:
+            self.wlan.active(True)
+        energy.meter.state(energy.RADIO, energy.RADIO_CONNECTING)
+        best = None
+        try:
+            for (ssid, bssid, ch, rssi, security, hidden) in self.wlan.scan():
+                if ssid.decode() == self.ssid and ch == channel and (best is None or rssi > best[1]):
+                    best = (bssid, rssi)
+        except OSError:
+            pass
+        if not was_active:
+            self.wlan.active(False)
+        energy.meter.state(energy.RADIO, was)
+        if best is not None:
+            self._save_cache(best[0], channel)
+        return True
+
+    def _save_cache(self, bssid, channel):
+        try:
+            with open(self.cachefile, "w") as f:
+                json.dump({"ssid": self.ssid, "bssid": bytes(bssid).hex(),
+                           "channel": channel}, f)
+        except OSError:
+            pass
+
+    def _forget_cache(self):
+        try:
+            os.remove(self.cachefile)
+        except OSError:
+            pass